@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+"""
+Local stand-in for the AFIP web services used by the electronic invoice
+benchmarks and tests. It emulates WSAA (loginCms), WSFEv1 (FECAESolicitar,
+FECompUltimoAutorizado, FECompConsultar, FEDummy and the CAEA operations
+FECAEASolicitar, FECAEAConsultar, FECAEARegInformativo and
+FECAEASinMovimientoInformar) and WSFEXv1 (FEXAuthorize, FEXGetLast_CMP,
+FEXDummy) with configurable latency and error rate, keeps the last number of
+each point of sale and document type and the authorized vouchers like AFIP
+does, and counts the calls by operation (GET /stats returns them as json,
+POST /stats/reset clears them).
+
+The WSDL documents are not included, fetch them once from AFIP homologation:
+
+    python3 afip_standin.py --fetch-wsdl --wsdl-dir ./wsdl
+
+and then start the server:
+
+    python3 afip_standin.py --wsdl-dir ./wsdl --port 8080 --latency 150 --jitter 50 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+# path on the stand-in: (wsdl file, AFIP homologation wsdl url)
+SERVICES = {
+    '/ws/services/LoginCms': ('wsaa.wsdl', 'https://wsaahomo.afip.gov.ar/ws/services/LoginCms?wsdl'),
+    '/wsfev1/service.asmx': ('wsfev1.wsdl', 'https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL'),
+    '/wsfexv1/service.asmx': ('wsfexv1.wsdl', 'https://wswhomo.afip.gov.ar/wsfexv1/service.asmx?WSDL'),
+}
+
+WSAA_NS = 'http://wsaa.view.sua.dvadac.desein.afip.gov'
+WSFE_NS = 'http://ar.gov.afip.dif.FEV1/'
+WSFEX_NS = 'http://ar.gov.afip.dif.fexv1/'
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soap:Body>%s</soap:Body></soap:Envelope>')
+
+FAULT = (
+    '<soap:Fault><faultcode>soap:Server</faultcode>'
+    '<faultstring>%s</faultstring></soap:Fault>')
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def find_text(element, name, default=''):
+    for child in element.iter():
+        if local_name(child.tag) == name:
+            return child.text or default
+    return default
+
+
+def leaf_values(element):
+    """ Return the values of the direct children of element without children by tag """
+    return {local_name(child.tag): child.text or '' for child in element if not len(child)}
+
+
+def errors(code, msg):
+    return '<Errors><Err><Code>%s</Code><Msg>%s</Msg></Err></Errors>' % (code, escape(msg))
+
+
+class AfipStandIn(object):
+
+    def __init__(self, latency=0, jitter=0, error_rate=0.0, start_number=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.start_number = start_number
+        self.calls = Counter()
+        self.last_numbers = {}
+        # authorized vouchers by (pos, doc_type, number) and CAEA by (period, order)
+        self.vouchers = {}
+        self.caeas = {}
+        self.reported = []
+        self.lock = threading.Lock()
+
+    def wait(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def dispatch(self, body):
+        root = ElementTree.fromstring(body)
+        operation = None
+        for element in root.iter():
+            if local_name(element.tag) == 'Body':
+                operation = list(element)[0]
+                break
+        name = local_name(operation.tag)
+        with self.lock:
+            self.calls[name] += 1
+        self.wait()
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.calls['errors'] += 1
+            return 500, ENVELOPE % (FAULT % 'Stand-in simulated error')
+        method = getattr(self, 'op_%s' % name, None)
+        if not method:
+            return 500, ENVELOPE % (FAULT % ('Operation %s not emulated' % name))
+        return 200, ENVELOPE % method(operation)
+
+    def next_number(self, pos, doc_type, number=None):
+        """ Return the last number and, if number is the next one, advance it """
+        with self.lock:
+            last = self.last_numbers.get((pos, doc_type), self.start_number)
+            if number is not None and number == last + 1:
+                self.last_numbers[(pos, doc_type)] = number
+            return last
+
+    # WSAA
+
+    def op_loginCms(self, request):
+        now = datetime.now()
+        ticket = (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<loginTicketResponse version="1.0"><header>'
+            '<source>CN=wsaahomo, O=AFIP, C=AR, SERIALNUMBER=CUIT 33693450239</source>'
+            '<destination>SERIALNUMBER=CUIT 20000000000, CN=standin</destination>'
+            '<uniqueId>%s</uniqueId>'
+            '<generationTime>%s-03:00</generationTime>'
+            '<expirationTime>%s-03:00</expirationTime>'
+            '</header><credentials><token>STANDIN-TOKEN</token><sign>STANDIN-SIGN</sign>'
+            '</credentials></loginTicketResponse>') % (
+                random.randint(1, 2 ** 31),
+                (now - timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S.000'),
+                (now + timedelta(hours=12)).strftime('%Y-%m-%dT%H:%M:%S.000'))
+        return '<loginCmsResponse xmlns="%s"><loginCmsReturn>%s</loginCmsReturn></loginCmsResponse>' % (
+            WSAA_NS, escape(ticket))
+
+    # WSFEv1
+
+    def op_FEDummy(self, request):
+        return (
+            '<FEDummyResponse xmlns="%s"><FEDummyResult><AppServer>OK</AppServer>'
+            '<DbServer>OK</DbServer><AuthServer>OK</AuthServer></FEDummyResult>'
+            '</FEDummyResponse>') % WSFE_NS
+
+    def op_FECompUltimoAutorizado(self, request):
+        pos = int(find_text(request, 'PtoVta', 0))
+        doc_type = int(find_text(request, 'CbteTipo', 0))
+        return (
+            '<FECompUltimoAutorizadoResponse xmlns="%s"><FECompUltimoAutorizadoResult>'
+            '<PtoVta>%s</PtoVta><CbteTipo>%s</CbteTipo><CbteNro>%s</CbteNro>'
+            '</FECompUltimoAutorizadoResult></FECompUltimoAutorizadoResponse>') % (
+                WSFE_NS, pos, doc_type, self.next_number(pos, doc_type))
+
+    def op_FECAESolicitar(self, request):
+        pos = int(find_text(request, 'PtoVta', 0))
+        doc_type = int(find_text(request, 'CbteTipo', 0))
+        details = []
+        results = set()
+        cae_due = (datetime.now() + timedelta(days=10)).strftime('%Y%m%d')
+        for detail in request.iter():
+            if local_name(detail.tag) != 'FECAEDetRequest':
+                continue
+            number = int(find_text(detail, 'CbteDesde', 0))
+            last = self.next_number(pos, doc_type, number)
+            if number == last + 1:
+                result, cae, obs = 'A', '7%013d' % random.randint(0, 10 ** 13 - 1), ''
+            else:
+                result, cae, obs = 'R', '', (
+                    '<Observaciones><Obs><Code>10016</Code><Msg>El numero o fecha del comprobante no '
+                    'se corresponde con el proximo a autorizar. Consultar metodo '
+                    'FECompUltimoAutorizado.</Msg></Obs></Observaciones>')
+            results.add(result)
+            if cae:
+                with self.lock:
+                    self.vouchers[(pos, doc_type, number)] = dict(
+                        leaf_values(detail), PtoVta=str(pos), CbteTipo=str(doc_type), CodAutorizacion=cae,
+                        EmisionTipo='CAE', FchVto=cae_due, Resultado='A')
+            details.append((
+                '<FECAEDetResponse><Concepto>%s</Concepto><DocTipo>%s</DocTipo><DocNro>%s</DocNro>'
+                '<CbteDesde>%s</CbteDesde><CbteHasta>%s</CbteHasta><CbteFch>%s</CbteFch>'
+                '<Resultado>%s</Resultado>%s<CAE>%s</CAE><CAEFchVto>%s</CAEFchVto>'
+                '</FECAEDetResponse>') % (
+                    find_text(detail, 'Concepto'), find_text(detail, 'DocTipo'), find_text(detail, 'DocNro'),
+                    number, number, find_text(detail, 'CbteFch'), result, obs, cae, cae and cae_due or ''))
+        result = 'A' if results == {'A'} else 'R' if results == {'R'} else 'P'
+        return (
+            '<FECAESolicitarResponse xmlns="%s"><FECAESolicitarResult><FeCabResp>'
+            '<Cuit>%s</Cuit><PtoVta>%s</PtoVta><CbteTipo>%s</CbteTipo><FchProceso>%s</FchProceso>'
+            '<CantReg>%s</CantReg><Resultado>%s</Resultado><Reproceso>N</Reproceso></FeCabResp>'
+            '<FeDetResp>%s</FeDetResp></FECAESolicitarResult></FECAESolicitarResponse>') % (
+                WSFE_NS, find_text(request, 'Cuit'), pos, doc_type, datetime.now().strftime('%Y%m%d%H%M%S'),
+                len(details), result, ''.join(details))
+
+    def op_FECompConsultar(self, request):
+        pos = int(find_text(request, 'PtoVta', 0))
+        doc_type = int(find_text(request, 'CbteTipo', 0))
+        number = int(find_text(request, 'CbteNro', 0))
+        with self.lock:
+            voucher = self.vouchers.get((pos, doc_type, number))
+        if not voucher:
+            result = errors(602, 'No existen datos en nuestros registros para los parametros ingresados.')
+        else:
+            tags = [
+                'Concepto', 'DocTipo', 'DocNro', 'CbteDesde', 'CbteHasta', 'CbteFch', 'ImpTotal', 'ImpTotConc',
+                'ImpNeto', 'ImpOpEx', 'ImpTrib', 'ImpIVA', 'FchServDesde', 'FchServHasta', 'FchVtoPago', 'MonId',
+                'MonCotiz', 'Resultado', 'CodAutorizacion', 'EmisionTipo', 'FchVto', 'PtoVta', 'CbteTipo']
+            result = '<ResultGet>%s<FchProceso>%s</FchProceso></ResultGet>' % (''.join(
+                '<%s>%s</%s>' % (tag, escape(voucher[tag]), tag) for tag in tags if voucher.get(tag)),
+                datetime.now().strftime('%Y%m%d%H%M%S'))
+        return '<FECompConsultarResponse xmlns="%s"><FECompConsultarResult>%s</FECompConsultarResult>' \
+            '</FECompConsultarResponse>' % (WSFE_NS, result)
+
+    def caea_result(self, period, order, code):
+        year, month = int(period[:4]), int(period[4:])
+        date_from = datetime(year, month, 1 if order == 1 else 16)
+        date_to = (date_from + timedelta(days=31)).replace(day=1) - timedelta(days=1) if order == 2 else \
+            date_from.replace(day=15)
+        return (
+            '<ResultGet><CAEA>%s</CAEA><Periodo>%s</Periodo><Orden>%s</Orden><FchVigDesde>%s</FchVigDesde>'
+            '<FchVigHasta>%s</FchVigHasta><FchTopeInf>%s</FchTopeInf><FchProceso>%s</FchProceso>'
+            '</ResultGet>') % (
+                code, period, order, date_from.strftime('%Y%m%d'), date_to.strftime('%Y%m%d'),
+                (date_to + timedelta(days=8)).strftime('%Y%m%d'), datetime.now().strftime('%Y%m%d'))
+
+    def op_FECAEASolicitar(self, request):
+        period, order = find_text(request, 'Periodo'), int(find_text(request, 'Orden', 0))
+        with self.lock:
+            # like AFIP, a CAEA can be requested only once, then it is queried
+            exists = (period, order) in self.caeas
+            code = self.caeas.setdefault((period, order), '3%013d' % random.randint(0, 10 ** 13 - 1))
+        result = errors(15008, 'Existe un CAEA otorgado para el periodo y orden.') if exists else \
+            self.caea_result(period, order, code)
+        return '<FECAEASolicitarResponse xmlns="%s"><FECAEASolicitarResult>%s</FECAEASolicitarResult>' \
+            '</FECAEASolicitarResponse>' % (WSFE_NS, result)
+
+    def op_FECAEAConsultar(self, request):
+        period, order = find_text(request, 'Periodo'), int(find_text(request, 'Orden', 0))
+        with self.lock:
+            code = self.caeas.get((period, order))
+        result = code and self.caea_result(period, order, code) or errors(
+            602, 'No existen datos en nuestros registros para los parametros ingresados.')
+        return '<FECAEAConsultarResponse xmlns="%s"><FECAEAConsultarResult>%s</FECAEAConsultarResult>' \
+            '</FECAEAConsultarResponse>' % (WSFE_NS, result)
+
+    def op_FECAEARegInformativo(self, request):
+        pos = int(find_text(request, 'PtoVta', 0))
+        doc_type = int(find_text(request, 'CbteTipo', 0))
+        details = []
+        results = set()
+        for detail in request.iter():
+            if local_name(detail.tag) != 'FECAEADetRequest':
+                continue
+            number = int(find_text(detail, 'CbteDesde', 0))
+            caea = find_text(detail, 'CAEA')
+            with self.lock:
+                known = caea in self.caeas.values()
+            last = self.next_number(pos, doc_type, number if known else None)
+            if not known:
+                result, obs = 'R', '<Observaciones><Obs><Code>1006</Code><Msg>CAEA inexistente.</Msg></Obs>' \
+                    '</Observaciones>'
+            elif number != last + 1:
+                result, obs = 'R', (
+                    '<Observaciones><Obs><Code>10016</Code><Msg>El numero del comprobante no se corresponde '
+                    'con el proximo a informar.</Msg></Obs></Observaciones>')
+            else:
+                result, obs = 'A', ''
+                with self.lock:
+                    self.reported.append((pos, doc_type, number, caea))
+                    self.vouchers[(pos, doc_type, number)] = dict(
+                        leaf_values(detail), PtoVta=str(pos), CbteTipo=str(doc_type), CodAutorizacion=caea,
+                        EmisionTipo='CAEA', Resultado='A')
+            results.add(result)
+            details.append((
+                '<FECAEADetResponse><Concepto>%s</Concepto><DocTipo>%s</DocTipo><DocNro>%s</DocNro>'
+                '<CbteDesde>%s</CbteDesde><CbteHasta>%s</CbteHasta><CbteFch>%s</CbteFch>'
+                '<Resultado>%s</Resultado>%s<CAEA>%s</CAEA></FECAEADetResponse>') % (
+                    find_text(detail, 'Concepto'), find_text(detail, 'DocTipo'), find_text(detail, 'DocNro'),
+                    number, number, find_text(detail, 'CbteFch'), result, obs, caea))
+        result = 'A' if results == {'A'} else 'R' if results == {'R'} else 'P'
+        return (
+            '<FECAEARegInformativoResponse xmlns="%s"><FECAEARegInformativoResult><FeCabResp>'
+            '<Cuit>%s</Cuit><PtoVta>%s</PtoVta><CbteTipo>%s</CbteTipo><FchProceso>%s</FchProceso>'
+            '<CantReg>%s</CantReg><Resultado>%s</Resultado><Reproceso>N</Reproceso></FeCabResp>'
+            '<FeDetResp>%s</FeDetResp></FECAEARegInformativoResult></FECAEARegInformativoResponse>') % (
+                WSFE_NS, find_text(request, 'Cuit'), pos, doc_type, datetime.now().strftime('%Y%m%d%H%M%S'),
+                len(details), result, ''.join(details))
+
+    def op_FECAEASinMovimientoInformar(self, request):
+        pos = int(find_text(request, 'PtoVta', 0))
+        caea = find_text(request, 'CAEA')
+        with self.lock:
+            known = caea in self.caeas.values()
+            if known:
+                self.reported.append((pos, None, None, caea))
+        result = '<CAEA>%s</CAEA><FchProceso>%s</FchProceso><Resultado>A</Resultado><PtoVta>%s</PtoVta>' % (
+            caea, datetime.now().strftime('%Y%m%d'), pos) if known else errors(1006, 'CAEA inexistente.')
+        return (
+            '<FECAEASinMovimientoInformarResponse xmlns="%s"><FECAEASinMovimientoInformarResult>%s'
+            '</FECAEASinMovimientoInformarResult></FECAEASinMovimientoInformarResponse>') % (WSFE_NS, result)
+
+    # WSFEXv1
+
+    def op_FEXDummy(self, request):
+        return (
+            '<FEXDummyResponse xmlns="%s"><FEXDummyResult><AppServer>OK</AppServer>'
+            '<DbServer>OK</DbServer><AuthServer>OK</AuthServer></FEXDummyResult>'
+            '</FEXDummyResponse>') % WSFEX_NS
+
+    def op_FEXGetLast_CMP(self, request):
+        pos = int(find_text(request, 'Pto_venta', 0))
+        doc_type = int(find_text(request, 'Cbte_Tipo', 0))
+        return (
+            '<FEXGetLast_CMPResponse xmlns="%s"><FEXGetLast_CMPResult><FEXResult_LastCMP>'
+            '<Cbte_nro>%s</Cbte_nro><Cbte_fecha>%s</Cbte_fecha></FEXResult_LastCMP>'
+            '<FEXErr><ErrCode>0</ErrCode><ErrMsg>OK</ErrMsg></FEXErr>'
+            '<FEXEvents><EventCode>0</EventCode><EventMsg>Ok</EventMsg></FEXEvents>'
+            '</FEXGetLast_CMPResult></FEXGetLast_CMPResponse>') % (
+                WSFEX_NS, self.next_number(pos, doc_type), datetime.now().strftime('%Y%m%d'))
+
+    def op_FEXAuthorize(self, request):
+        pos = int(find_text(request, 'Punto_vta', 0))
+        doc_type = int(find_text(request, 'Cbte_Tipo', 0))
+        number = int(find_text(request, 'Cbte_nro', 0))
+        last = self.next_number(pos, doc_type, number)
+        if number == last + 1:
+            result, cae, err = 'A', '7%013d' % random.randint(0, 10 ** 13 - 1), '<ErrCode>0</ErrCode><ErrMsg>OK</ErrMsg>'
+        else:
+            result, cae, err = 'R', '', '<ErrCode>1663</ErrCode><ErrMsg>Numero de comprobante invalido</ErrMsg>'
+        return (
+            '<FEXAuthorizeResponse xmlns="%s"><FEXAuthorizeResult><FEXResultAuth>'
+            '<Id>%s</Id><Cuit>%s</Cuit><Cbte_tipo>%s</Cbte_tipo><Punto_vta>%s</Punto_vta>'
+            '<Cbte_nro>%s</Cbte_nro><Cae>%s</Cae><Fch_venc_Cae>%s</Fch_venc_Cae>'
+            '<Fch_cbte>%s</Fch_cbte><Resultado>%s</Resultado><Reproceso>N</Reproceso>'
+            '<Motivos_Obs></Motivos_Obs></FEXResultAuth><FEXErr>%s</FEXErr>'
+            '<FEXEvents><EventCode>0</EventCode><EventMsg>Ok</EventMsg></FEXEvents>'
+            '</FEXAuthorizeResult></FEXAuthorizeResponse>') % (
+                WSFEX_NS, find_text(request, 'Id'), find_text(request, 'Cuit'), doc_type, pos, number, cae,
+                cae and (datetime.now() + timedelta(days=10)).strftime('%Y%m%d') or '',
+                find_text(request, 'Fecha_cbte'), result, err)
+
+
+def make_handler(standin, wsdl_dir):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body, content_type='text/xml; charset=utf-8'):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/stats':
+                with standin.lock:
+                    stats = dict(standin.calls)
+                return self.reply(200, json.dumps(stats), 'application/json')
+            if path not in SERVICES:
+                return self.reply(404, 'Not found', 'text/plain')
+            with standin.lock:
+                standin.calls['wsdl'] += 1
+            with open('%s/%s' % (wsdl_dir, SERVICES[path][0]), encoding='utf-8') as wsdl_file:
+                wsdl = wsdl_file.read()
+            # point the service address to the stand-in
+            location = 'http://%s%s' % (self.headers.get('Host'), path)
+            wsdl = re.sub(r'location="https?://[^"]*"', 'location="%s"' % location, wsdl)
+            self.reply(200, wsdl)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/stats/reset':
+                with standin.lock:
+                    standin.calls.clear()
+                return self.reply(200, '{}', 'application/json')
+            status, response = standin.dispatch(body)
+            self.reply(status, response)
+
+    return Handler
+
+
+def fetch_wsdl(wsdl_dir):
+    for path, (filename, url) in SERVICES.items():
+        print('Downloading %s' % url)
+        with urllib.request.urlopen(url) as response, open('%s/%s' % (wsdl_dir, filename), 'wb') as wsdl_file:
+            wsdl_file.write(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AFIP web services stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--wsdl-dir', default='wsdl')
+    parser.add_argument('--fetch-wsdl', action='store_true', help='download WSDL documents from AFIP and exit')
+    parser.add_argument('--latency', type=float, default=0, help='response latency in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='latency jitter in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='ratio of calls answered with a SOAP fault')
+    parser.add_argument('--start-number', type=int, default=0, help='last number of every point of sale')
+    args = parser.parse_args()
+    if args.fetch_wsdl:
+        return fetch_wsdl(args.wsdl_dir)
+    standin = AfipStandIn(args.latency, args.jitter, args.error_rate, args.start_number)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(standin, args.wsdl_dir))
+    print('AFIP stand-in listening on http://%s:%s' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+"""
+Benchmark of the electronic invoice pipeline (get_connection, authenticate,
+connect and do_pyafipws_request_cae) against the local AFIP stand-in (see
+afip_standin.py). Invoices are created on a company with l10n_ar_afipws_fe
+installed, spread across N benchmark journals, and posted requesting the CAE.
+It reports throughput, latency percentiles by invoice and by method and the
+SOAP calls made by invoice.
+
+IMPORTANT: CAE requests commit the transaction, run it only on a disposable
+database.
+
+    python3 bench_cae.py -c odoo.conf -d bench --standin http://127.0.0.1:8080 \
+        --invoices 1,100,10000 --journals 4 --mode single
+"""
+import argparse
+import functools
+import json
+import os
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+import odoo
+from odoo import api, SUPERUSER_ID
+from OpenSSL import crypto
+
+TIMED_METHODS = [
+    ('res.company', 'get_connection'),
+    ('res.company', 'authenticate'),
+    ('afipws.connection', 'connect'),
+    ('account.move', 'do_pyafipws_request_cae'),
+]
+
+samples = defaultdict(list)
+authorized = {}
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(percent / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def timed(name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            samples[name].append(time.perf_counter() - start)
+    return wrapper
+
+
+def patch_registry(env, standin):
+    """ Point the webservices to the stand-in and time the pipeline methods """
+    connection_cls = env.registry['afipws.connection']
+    paths = {
+        'wsfe': '/wsfev1/service.asmx?WSDL',
+        'wsfex': '/wsfexv1/service.asmx?WSDL',
+    }
+    connection_cls.get_afip_login_url = lambda self, environment_type: standin + '/ws/services/LoginCms'
+    connection_cls.get_afip_ws_url = lambda self, afip_ws, environment_type: (
+        afip_ws in paths and standin + paths[afip_ws] or False)
+
+    for model, method in TIMED_METHODS:
+        cls = env.registry[model]
+        setattr(cls, method, timed(method, getattr(cls, method)))
+
+    move_cls = env.registry['account.move']
+    write_cae = move_cls._pyafipws_write_cae
+
+    @functools.wraps(write_cae)
+    def _pyafipws_write_cae(self, *args, **kwargs):
+        res = write_cae(self, *args, **kwargs)
+        authorized[self.id] = time.perf_counter()
+        return res
+    move_cls._pyafipws_write_cae = _pyafipws_write_cae
+
+
+def create_certificate(directory):
+    """ Self signed certificate for WSAA, the stand-in doesn't validate it """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'afip-standin'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(365 * 24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    key_path = os.path.join(directory, 'standin.key')
+    cert_path = os.path.join(directory, 'standin.crt')
+    with open(key_path, 'wb') as key_file:
+        key_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    with open(cert_path, 'wb') as cert_file:
+        cert_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    odoo.tools.config['afip_homo_pkey_file'] = key_path
+    odoo.tools.config['afip_homo_cert_file'] = cert_path
+
+
+def standin_stats(standin, reset=False):
+    url = urllib.parse.urljoin(standin, '/stats/reset' if reset else '/stats')
+    with urllib.request.urlopen(url, data=reset and b'' or None) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def setup(env, args):
+    """ Configure the database and return the benchmark company, journals, partner and product """
+    set_param = env['ir.config_parameter'].sudo().set_param
+    set_param('afip.ws.env.type', 'homologation')
+    set_param('l10n_ar_afipws_fe.cae_batch', args.mode == 'batch' and 'True' or '')
+    set_param('l10n_ar_afipws_fe.cae_async', args.mode == 'queue' and 'True' or '')
+    set_param('l10n_ar_afipws_fe.cae_queue_workers', str(args.workers))
+
+    company = args.company and env['res.company'].browse(args.company) or env.company
+    journals = env['account.journal']
+    for number in range(1, args.journals + 1):
+        code = 'BE%02d' % number
+        journal = journals.search([('company_id', '=', company.id), ('code', '=', code)])
+        if not journal:
+            journal = journals.create({
+                'name': 'Benchmark POS %s' % number,
+                'code': code,
+                'type': 'sale',
+                'company_id': company.id,
+                'l10n_latam_use_documents': True,
+                'l10n_ar_afip_pos_system': 'RAW_MAW',
+                'l10n_ar_afip_pos_number': args.first_pos + number - 1,
+                'l10n_ar_afip_pos_partner_id': company.partner_id.id,
+            })
+        journals |= journal
+
+    partner = env['res.partner'].browse(args.partner) if args.partner else env['res.partner'].search([
+        ('vat', '!=', False),
+        ('l10n_ar_afip_responsibility_type_id.code', '=', '1'),
+        ('id', '!=', company.partner_id.id),
+    ], limit=1)
+    product = env['product.product'].browse(args.product) if args.product else env['product.product'].search([
+        ('sale_ok', '=', True),
+        ('taxes_id.company_id', '=', company.id),
+    ], limit=1)
+    env.cr.commit()
+    return company, journals, partner, product
+
+
+def create_invoices(env, company, journals, partner, product, count):
+    moves = env['account.move']
+    for start in range(0, count, 500):
+        vals_list = [{
+            'type': 'out_invoice',
+            'company_id': company.id,
+            'journal_id': journals[index % len(journals)].id,
+            'partner_id': partner.id,
+            'invoice_line_ids': [(0, 0, {
+                'product_id': product.id,
+                'quantity': 1,
+                'price_unit': 100.0 + index % 100,
+            })],
+        } for index in range(start, min(start + 500, count))]
+        moves |= moves.with_context(default_type='out_invoice').create(vals_list)
+        env.cr.commit()
+    return moves
+
+
+def run_scenario(env, args, company, journals, partner, product, count):
+    samples.clear()
+    authorized.clear()
+    moves = create_invoices(env, company, journals, partner, product, count)
+    standin_stats(args.standin, reset=True)
+    started = {}
+
+    start = time.perf_counter()
+    if args.mode == 'single':
+        for move in moves:
+            started[move.id] = time.perf_counter()
+            move.post()
+    else:
+        for journal in journals:
+            journal_moves = moves.filtered(lambda x: x.journal_id == journal)
+            for move in journal_moves:
+                started[move.id] = time.perf_counter()
+            journal_moves.post()
+            env.cr.commit()
+        if args.mode == 'queue':
+            queue = env['afipws.cae_queue']
+            while queue.search_count([('state', '=', 'pending'), ('move_id', 'in', moves.ids)]):
+                queue._cron_process_queue()
+                env.cr.commit()
+                env.clear()
+    env.cr.commit()
+    elapsed = time.perf_counter() - start
+
+    calls = standin_stats(args.standin)
+    errors = calls.pop('errors', 0)
+    latencies = [authorized[move_id] - started[move_id] for move_id in started if move_id in authorized]
+
+    print('\n== %s invoices, %s journals, mode %s ==' % (count, len(journals), args.mode))
+    print('authorized: %s/%s in %.2fs (%.2f invoices/s)' % (
+        len(latencies), count, elapsed, len(latencies) / elapsed if elapsed else 0.0))
+    print('invoice latency: p50 %.1fms p95 %.1fms p99 %.1fms' % tuple(
+        percentile(latencies, percent) * 1000 for percent in (50, 95, 99)))
+    print('SOAP calls per invoice: %.2f (%s)' % (
+        sum(calls.values()) / float(count), ', '.join('%s=%s' % item for item in sorted(calls.items()))))
+    print('SOAP errors: %s' % errors)
+    for name, values in sorted(samples.items()):
+        print('%-25s calls %6s  p50 %8.1fms  p95 %8.1fms  p99 %8.1fms' % ((name, len(values)) + tuple(
+            percentile(values, percent) * 1000 for percent in (50, 95, 99))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Electronic invoice pipeline benchmark')
+    parser.add_argument('-c', '--config', required=True, help='odoo configuration file')
+    parser.add_argument('-d', '--database', required=True, help='disposable database')
+    parser.add_argument('--standin', default='http://127.0.0.1:8080', help='AFIP stand-in url')
+    parser.add_argument('--invoices', default='1,100,10000', help='comma separated scenarios')
+    parser.add_argument('--journals', type=int, default=1)
+    parser.add_argument('--first-pos', type=int, default=9001, help='point of sale of the first journal')
+    parser.add_argument('--mode', choices=['single', 'batch', 'queue'], default='single')
+    parser.add_argument('--workers', type=int, default=1, help='queue workers (queue mode)')
+    parser.add_argument('--company', type=int)
+    parser.add_argument('--partner', type=int)
+    parser.add_argument('--product', type=int)
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    create_certificate(tempfile.mkdtemp(prefix='afip-standin-'))
+    registry = odoo.registry(args.database)
+    with api.Environment.manage(), registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        patch_registry(env, args.standin.rstrip('/'))
+        company, journals, partner, product = setup(env, args)
+        for count in [int(value) for value in args.invoices.split(',')]:
+            run_scenario(env, args, company, journals, partner, product, count)
+
+
+if __name__ == '__main__':
+    main()
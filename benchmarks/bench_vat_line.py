@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+"""
+Benchmark of the account_ar_vat_line queries (VAT ledger search, pivot
+grouping and TXT files invoices) with and without the indexes created by
+l10n_ar_reports. The fixture clones the posted invoices of the database (with
+their journal items and taxes) until it reaches the requested number of move
+lines, spreading them on the last --days days. Each query is run with EXPLAIN
+ANALYZE without the indexes (before) and after creating them.
+
+Everything is done on one transaction that is rolled back at the end unless
+--commit is given. Run it on a **disposable** database with l10n_ar_reports
+installed and some posted invoices with VAT (demo data of l10n_ar is enough):
+
+    python3 bench_vat_line.py -c odoo.conf -d bench --lines 1000000 --output plans.json
+"""
+import argparse
+import json
+import statistics
+from datetime import date, timedelta
+
+import odoo
+from odoo import api, SUPERUSER_ID
+
+INVOICE_TYPES = ('out_invoice', 'in_invoice', 'out_refund', 'in_refund')
+
+
+def columns(cr, table, exclude=('id',)):
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = %s ORDER BY ordinal_position""", (table,))
+    return [x[0] for x in cr.fetchall() if x[0] not in exclude]
+
+
+def create_fixture(env, args):
+    """
+    Clone the posted invoices (templates) until there are args.lines
+    benchmark move lines. Clones are named "BENCH/<template id>/<number>" so
+    that their lines and taxes can be copied with plain SQL
+    """
+    cr = env.cr
+    cr.execute("""
+        SELECT am.id, count(aml.id) FROM account_move am
+        JOIN account_move_line aml ON aml.move_id = am.id
+        WHERE am.state = 'posted' AND am.type IN %s AND am.name NOT LIKE 'BENCH/%%'
+        GROUP BY am.id ORDER BY am.id LIMIT %s""", (INVOICE_TYPES, args.templates))
+    templates = cr.fetchall()
+    if not templates:
+        raise SystemExit('There are no posted invoices to clone')
+    lines_by_copy = sum(x[1] for x in templates)
+    copies = -(-args.lines // lines_by_copy)
+    first_date = date.today() - timedelta(days=args.days)
+
+    move_columns = columns(cr, 'account_move')
+    line_columns = columns(cr, 'account_move_line')
+    overrides = {
+        'name': "'BENCH/' || t.id || '/' || s",
+        'date': "%(first_date)s::date + (s %% %(days)s)",
+        'invoice_date': "%(first_date)s::date + (s %% %(days)s)",
+    }
+    move_select = ', '.join(overrides.get(x, 't.%s' % x) for x in move_columns)
+    line_overrides = {
+        'move_id': 'm.id',
+        'date': 'm.date',
+        'name': "'BENCH/' || l.id",
+    }
+    line_select = ', '.join(line_overrides.get(x, 'l.%s' % x) for x in line_columns)
+
+    print('cloning %s invoices (%s lines) %s times' % (len(templates), lines_by_copy, copies))
+    for start in range(1, copies + 1, args.batch):
+        stop = min(start + args.batch - 1, copies)
+        cr.execute("SELECT coalesce(max(id), 0) FROM account_move")
+        last_move_id = cr.fetchone()[0]
+        cr.execute("SELECT coalesce(max(id), 0) FROM account_move_line")
+        last_line_id = cr.fetchone()[0]
+        cr.execute("""
+            INSERT INTO account_move (%s)
+            SELECT %s FROM account_move t, generate_series(%%(start)s, %%(stop)s) s
+            WHERE t.id IN %%(templates)s""" % (', '.join(move_columns), move_select), {
+            'start': start, 'stop': stop, 'first_date': first_date, 'days': args.days,
+            'templates': tuple(x[0] for x in templates)})
+        cr.execute("""
+            INSERT INTO account_move_line (%s)
+            SELECT %s FROM account_move m
+            JOIN account_move_line l ON l.move_id = split_part(m.name, '/', 2)::integer
+            WHERE m.id > %%s AND m.name LIKE 'BENCH/%%%%'""" % (', '.join(line_columns), line_select),
+            (last_move_id,))
+        cr.execute("""
+            INSERT INTO account_move_line_account_tax_rel (account_move_line_id, account_tax_id)
+            SELECT l.id, r.account_tax_id FROM account_move_line l
+            JOIN account_move_line_account_tax_rel r
+                ON r.account_move_line_id = split_part(l.name, '/', 2)::integer
+            WHERE l.id > %s AND l.name LIKE 'BENCH/%%'""", (last_line_id,))
+        print('  %s/%s copies' % (stop, copies))
+    cr.execute("ANALYZE account_move")
+    cr.execute("ANALYZE account_move_line")
+    cr.execute("ANALYZE account_move_line_account_tax_rel")
+
+
+def get_queries(env, args):
+    """ The queries the VAT ledger and the VAT lines pivot make """
+    vat_line = env['account.ar.vat.line']
+    cr = env.cr
+    cr.execute("""
+        SELECT journal_id FROM account_move WHERE name LIKE 'BENCH/%%' AND type = %s
+        GROUP BY journal_id""", (args.type,))
+    journal_ids = [x[0] for x in cr.fetchall()] or [0]
+    date_to = date.today()
+    date_from = date_to.replace(day=1)
+    ledger_domain = [
+        ('state', '!=', 'draft'),
+        ('journal_id', 'in', journal_ids),
+        ('date', '>=', date_from),
+        ('date', '<=', date_to),
+    ]
+    query = vat_line._where_calc(ledger_domain)
+    from_clause, where_clause, params = query.get_sql()
+    ledger = env['account.vat.ledger'].new({
+        'type': args.type == 'out_invoice' and 'sale' or 'purchase',
+        'journal_ids': [(6, 0, journal_ids)],
+        'date_from': date_from,
+        'date_to': date_to,
+    })
+    txt_query, txt_params = ledger._get_txt_invoices_query()
+    return [
+        ('ledger search', 'SELECT "account_ar_vat_line".id FROM %s WHERE %s ORDER BY %s' % (
+            from_clause, where_clause, vat_line._generate_order_by(None, query).replace(' ORDER BY ', '')),
+            params),
+        ('ledger txt invoices', txt_query, txt_params),
+        ('pivot by journal', """
+            SELECT journal_id, sum(base_21), sum(vat_21), sum(total) FROM account_ar_vat_line
+            WHERE date >= %s AND date <= %s GROUP BY journal_id""", [date_from, date_to]),
+        ('single invoice', 'SELECT * FROM account_ar_vat_line WHERE move_id = %s', [get_any_move(cr)]),
+    ]
+
+
+def get_any_move(cr):
+    cr.execute("SELECT max(id) FROM account_move WHERE name LIKE 'BENCH/%'")
+    return cr.fetchone()[0]
+
+
+def explain(cr, sql, params, repeat):
+    """ Return the median execution time (ms) and the last plan """
+    timings, plan = [], None
+    for _x in range(repeat):
+        cr.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+        plan = cr.fetchone()[0][0]
+        timings.append(plan['Execution Time'])
+    return statistics.median(timings), plan
+
+
+def drop_indexes(env):
+    cr = env.cr
+    for name, _table, _definition in env['account.ar.vat.line']._source_indexes:
+        cr.execute('DROP INDEX IF EXISTS %s' % name)
+    cr.execute('DROP INDEX IF EXISTS account_move_line_account_tax_rel_ar_vat_line_index')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='account_ar_vat_line queries benchmark')
+    parser.add_argument('-c', '--config', required=True, help='odoo configuration file')
+    parser.add_argument('-d', '--database', required=True, help='disposable database')
+    parser.add_argument('--lines', type=int, default=1000000, help='benchmark move lines to create')
+    parser.add_argument('--templates', type=int, default=50, help='posted invoices to clone')
+    parser.add_argument('--days', type=int, default=730, help='days to spread the invoices on')
+    parser.add_argument('--batch', type=int, default=500, help='copies by insert')
+    parser.add_argument('--type', choices=['out_invoice', 'in_invoice'], default='out_invoice')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each query')
+    parser.add_argument('--output', help='json file to save the plans to')
+    parser.add_argument('--commit', action='store_true', help='keep the fixture and the indexes')
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    registry = odoo.registry(args.database)
+    with api.Environment.manage(), registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        vat_line = env['account.ar.vat.line']
+        if vat_line._is_materialized():
+            raise SystemExit('account_ar_vat_line is materialized, benchmark it as a view')
+        drop_indexes(env)
+        create_fixture(env, args)
+        queries = get_queries(env, args)
+
+        results = {}
+        for stage in ('before', 'after'):
+            if stage == 'after':
+                vat_line._create_source_indexes()
+                cr.execute("ANALYZE account_move")
+                cr.execute("ANALYZE account_move_line")
+            for name, sql, params in queries:
+                results.setdefault(name, {})[stage] = explain(cr, sql, params, args.repeat)
+
+        print('\n%-22s %12s %12s %8s' % ('query', 'before (ms)', 'after (ms)', 'speedup'))
+        for name, stages in results.items():
+            before, after = stages['before'][0], stages['after'][0]
+            print('%-22s %12.1f %12.1f %7.1fx' % (name, before, after, after and before / after or 0.0))
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump({name: {stage: {'execution_time': timing, 'plan': plan}
+                                  for stage, (timing, plan) in stages.items()}
+                           for name, stages in results.items()}, output, indent=2)
+            print('plans saved to %s' % args.output)
+
+        if args.commit:
+            cr.commit()
+        else:
+            cr.rollback()
+
+
+if __name__ == '__main__':
+    main()
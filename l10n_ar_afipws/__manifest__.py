@@ -1,6 +1,6 @@
 {
     'name': 'Modulo Base para los Web Services de AFIP',
-    'version': '13.0.1.1.0',
+    'version': '13.0.1.8.0',
     'category': 'Localization/Argentina',
     'sequence': 14,
     'author': 'ADHOC SA, Moldeo Interactive,Odoo Community Association (OCA)',
@@ -20,10 +20,14 @@
         'views/afipws_certificate_view.xml',
         'views/afipws_certificate_alias_view.xml',
         'views/afipws_connection_view.xml',
+        'views/afipws_circuit_view.xml',
+        'views/afipws_call_stat_view.xml',
+        'views/afipws_profile_view.xml',
         'views/res_config_settings.xml',
         'security/ir.model.access.csv',
         'security/security.xml',
         'data/ir.actions.url_data.xml',
+        'data/ir_cron_data.xml',
     ],
     'demo': [
         'demo/certificate_demo.xml',
@@ -0,0 +1,41 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """
+    Merge the statistics without company saved more than once for the same
+    day, webservice, operation and result, so that the new unique index can
+    be created
+    """
+    cr.execute("SELECT to_regclass('afipws_call_stat')")
+    if not cr.fetchone()[0]:
+        return
+    cr.execute("""
+        CREATE TEMP TABLE afipws_call_stat_merge AS
+        SELECT min(id) AS id, sum(count) AS count, sum(retries) AS retries,
+            sum(duration_total) AS duration_total, max(duration_max) AS duration_max,
+            sum(request_bytes) AS request_bytes, sum(response_bytes) AS response_bytes
+        FROM afipws_call_stat
+        GROUP BY date, afip_ws, operation, coalesce(company_id, 0), result
+        HAVING count(*) > 1""")
+    cr.execute("""
+        UPDATE afipws_call_stat s
+        SET count = m.count, retries = m.retries, duration_total = m.duration_total,
+            duration_max = m.duration_max, request_bytes = m.request_bytes,
+            response_bytes = m.response_bytes
+        FROM afipws_call_stat_merge m
+        WHERE s.id = m.id""")
+    cr.execute("""
+        DELETE FROM afipws_call_stat s
+        USING afipws_call_stat_merge m, afipws_call_stat k
+        WHERE k.id = m.id AND s.id != k.id AND s.date = k.date AND s.afip_ws = k.afip_ws
+            AND s.operation = k.operation AND coalesce(s.company_id, 0) = coalesce(k.company_id, 0)
+            AND s.result = k.result""")
+    _logger.info('%s duplicated AFIP ws calls statistics merged' % cr.rowcount)
+    cr.execute('DROP TABLE afipws_call_stat_merge')
@@ -0,0 +1,26 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """
+    Start the totals of the AFIP ws calls with the statistics still kept, so
+    that the exported counters don't go down
+    """
+    cr.execute("""
+        INSERT INTO afipws_call_stat_total (
+            afip_ws, operation, company_id, result, count, retries, duration_total,
+            duration_max, request_bytes, response_bytes,
+            create_uid, create_date, write_uid, write_date)
+        SELECT afip_ws, operation, company_id, result, sum(count), sum(retries),
+            sum(duration_total), max(duration_max), sum(request_bytes), sum(response_bytes),
+            1, now() at time zone 'UTC', 1, now() at time zone 'UTC'
+        FROM afipws_call_stat
+        GROUP BY afip_ws, operation, company_id, result
+        ON CONFLICT DO NOTHING""")
+    _logger.info('%s AFIP ws calls totals created' % cr.rowcount)
@@ -5,6 +5,10 @@
 from . import afipws_certificate_alias
 from . import afipws_certificate
 from . import afipws_connection
+from . import afipws_circuit
+from . import afipws_call_stat
+from . import afipws_profile
 from . import res_company
 from . import res_config_settings
-from . import res_partner
\ No newline at end of file
+from . import res_partner
+from . import res_users
\ No newline at end of file
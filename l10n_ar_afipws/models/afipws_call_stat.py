@@ -0,0 +1,363 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models, api, registry, tools, SUPERUSER_ID
+from .afipws_circuit import _register_call_result
+from .afipws_profile import profile_stage
+from collections import deque
+from datetime import date, timedelta
+import logging
+import os
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from pysimplesoap.client import SoapFault
+except ImportError:
+    SoapFault = None
+
+# last calls made by this process and aggregated values not yet saved, by
+# (dbname, date, afip_ws, operation, company_id, result)
+_recent_calls = deque(maxlen=1000)
+_pending_stats = {}
+_stats_lock = threading.Lock()
+_last_flush = {}
+
+
+class AfipwsCallStat(models.Model):
+    """
+    Statistics of the calls to AFIP webservices by day, webservice,
+    operation, company and result. Every SOAP call of the connected objects is
+    timed (see _instrument), kept on an in memory ring buffer of the process
+    and aggregated here each "afip.ws.stats.flush_interval" seconds. Daily
+    rows are deleted after "afip.ws.stats.days", the totals since install are
+    kept on afipws.call_stat.total. A scheduled action exports them in
+    Prometheus text format to the file set on "afip.ws.stats.prometheus_file"
+    (if any).
+    """
+    _name = "afipws.call_stat"
+    _description = "AFIP webservice calls statistics"
+    _rec_name = "operation"
+    _order = "date desc, afip_ws, operation"
+
+    date = fields.Date(
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    afip_ws = fields.Char(
+        'AFIP WS',
+        required=True,
+        readonly=True,
+    )
+    operation = fields.Char(
+        required=True,
+        readonly=True,
+    )
+    company_id = fields.Many2one(
+        'res.company',
+        'Company',
+        readonly=True,
+    )
+    result = fields.Selection(
+        [('ok', 'OK'), ('fault', 'SOAP Fault'), ('error', 'Error')],
+        required=True,
+        readonly=True,
+    )
+    count = fields.Integer(
+        'Calls',
+        readonly=True,
+        group_operator='sum',
+    )
+    retries = fields.Integer(
+        readonly=True,
+        group_operator='sum',
+    )
+    duration_total = fields.Float(
+        'Total Duration (s)',
+        readonly=True,
+        group_operator='sum',
+    )
+    duration_max = fields.Float(
+        'Max Duration (s)',
+        readonly=True,
+        group_operator='max',
+    )
+    request_bytes = fields.Integer(
+        readonly=True,
+        group_operator='sum',
+    )
+    response_bytes = fields.Integer(
+        readonly=True,
+        group_operator='sum',
+    )
+
+    def init(self):
+        # company is optional and a unique constraint doesn't consider null
+        # values as equal, so we use an unique index with coalesce (the
+        # conflict target of _flush must match it)
+        self._cr.execute('ALTER TABLE afipws_call_stat DROP CONSTRAINT IF EXISTS afipws_call_stat_stat_uniq')
+        tools.create_unique_index(
+            self._cr, 'afipws_call_stat_stat_uniq_index', self._table,
+            ['date', 'afip_ws', 'operation', 'coalesce(company_id, 0)', 'result'])
+
+    @api.model
+    def _instrument(self, ws, afip_ws, company, environment_type=False):
+        """
+        Time every SOAP call made by the pysimplesoap client of the connected
+        object ws. Callers that retry a call can set "_afipws_retry" on ws
+        with the attempt number.
+        If environment_type is given the result of each call is also
+        registered on the circuit of the webservice (see afipws.circuit):
+        SOAP faults are answers of AFIP so only transport errors count as
+        failures. Probes (ws._afipws_circuit_probe) register their own result
+        """
+        client = getattr(ws, 'client', None)
+        if not client or getattr(client, '_afipws_instrumented', False):
+            return
+        dbname = self._cr.dbname
+        company_id = company.id if len(company) == 1 else False
+        flush_interval = int(self.env['ir.config_parameter'].sudo().get_param(
+            'afip.ws.stats.flush_interval', 60))
+        call = client.call
+
+        def instrumented_call(method, *args, **kwargs):
+            start = time.time()
+            result = 'ok'
+            try:
+                with profile_stage(method):
+                    return call(method, *args, **kwargs)
+            except Exception as error:
+                result = 'fault' if SoapFault and isinstance(error, SoapFault) else 'error'
+                if environment_type and not getattr(ws, '_afipws_circuit_probe', False):
+                    _register_call_result(
+                        dbname, afip_ws, environment_type, error=repr(error) if result == 'error' else False)
+                raise
+            else:
+                if environment_type and not getattr(ws, '_afipws_circuit_probe', False):
+                    _register_call_result(dbname, afip_ws, environment_type)
+            finally:
+                _record_call(dbname, {
+                    'time': start,
+                    'afip_ws': afip_ws,
+                    'operation': method,
+                    'company_id': company_id,
+                    'result': result,
+                    'duration': time.time() - start,
+                    'request_bytes': len(getattr(client, 'xml_request', None) or b''),
+                    'response_bytes': len(getattr(client, 'xml_response', None) or b''),
+                    'retry': getattr(ws, '_afipws_retry', 0),
+                }, flush_interval)
+
+        client.call = instrumented_call
+        client._afipws_instrumented = True
+
+    @api.model
+    def get_recent_calls(self, limit=100):
+        """ Return the last calls made by this process (most recent first) """
+        dbname = self._cr.dbname
+        with _stats_lock:
+            calls = [dict(call) for db, call in reversed(_recent_calls) if db == dbname]
+        return calls[:limit]
+
+    @api.model
+    def _flush(self, stats):
+        for (stat_date, afip_ws, operation, company_id, result), values in stats.items():
+            self._cr.execute("""
+                INSERT INTO afipws_call_stat (
+                    date, afip_ws, operation, company_id, result, count, retries,
+                    duration_total, duration_max, request_bytes, response_bytes,
+                    create_uid, create_date, write_uid, write_date)
+                VALUES (%(date)s, %(afip_ws)s, %(operation)s, %(company_id)s, %(result)s,
+                    %(count)s, %(retries)s, %(duration_total)s, %(duration_max)s,
+                    %(request_bytes)s, %(response_bytes)s,
+                    %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC')
+                ON CONFLICT (date, afip_ws, operation, (coalesce(company_id, 0)), result) DO UPDATE
+                SET count = afipws_call_stat.count + EXCLUDED.count,
+                    retries = afipws_call_stat.retries + EXCLUDED.retries,
+                    duration_total = afipws_call_stat.duration_total + EXCLUDED.duration_total,
+                    duration_max = greatest(afipws_call_stat.duration_max, EXCLUDED.duration_max),
+                    request_bytes = afipws_call_stat.request_bytes + EXCLUDED.request_bytes,
+                    response_bytes = afipws_call_stat.response_bytes + EXCLUDED.response_bytes,
+                    write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date""", dict(
+                values, date=stat_date, afip_ws=afip_ws, operation=operation,
+                company_id=company_id, result=result, uid=self.env.uid))
+        self.env['afipws.call_stat.total']._flush(stats)
+
+    @api.model
+    def _cron_export(self):
+        """ Delete old statistics and export the totals in Prometheus text format """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        _flush_pending(self._cr.dbname)
+        days = int(get_param('afip.ws.stats.days', 90))
+        if days > 0:
+            self.search([('date', '<', fields.Date.context_today(self) - timedelta(days=days))]).unlink()
+
+        path = get_param('afip.ws.stats.prometheus_file')
+        if not path:
+            return
+        # counters must never go down, so they are taken from the totals that
+        # are not deleted with the daily rows
+        self._cr.execute("""
+            SELECT afip_ws, operation, coalesce(company_id, 0), result, count, retries,
+                duration_total, duration_max, request_bytes, response_bytes
+            FROM afipws_call_stat_total
+            ORDER BY afip_ws, operation, company_id, result""")
+        metrics = [
+            ('afip_ws_calls_total', 'counter', 'AFIP webservice calls', 4),
+            ('afip_ws_retries_total', 'counter', 'AFIP webservice calls that were retries', 5),
+            ('afip_ws_call_duration_seconds_sum', 'counter', 'Total duration of AFIP webservice calls', 6),
+            ('afip_ws_call_duration_seconds_max', 'gauge', 'Max duration of an AFIP webservice call', 7),
+            ('afip_ws_request_bytes_total', 'counter', 'Bytes sent to AFIP webservices', 8),
+            ('afip_ws_response_bytes_total', 'counter', 'Bytes received from AFIP webservices', 9),
+        ]
+        rows = self._cr.fetchall()
+        lines = []
+        for name, metric_type, description, column in metrics:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for row in rows:
+                labels = [_escape_label(value) for value in (self._cr.dbname,) + row[:4]]
+                lines.append('%s{db="%s",service="%s",operation="%s",company="%s",result="%s"} %s' % (
+                    name, *labels, row[column] or 0))
+        # write and rename so that collectors never read a partial file
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as metrics_file:
+                metrics_file.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, path)
+        except OSError as error:
+            _logger.warning('Could not write AFIP ws metrics to %s: %s' % (path, error))
+
+
+class AfipwsCallStatTotal(models.Model):
+    """
+    Totals of the calls to AFIP webservices since install by webservice,
+    operation, company and result. They are updated with the daily statistics
+    (see afipws.call_stat _flush) but never deleted, so that the exported
+    counters are monotonic
+    """
+    _name = "afipws.call_stat.total"
+    _description = "AFIP webservice calls totals"
+    _rec_name = "operation"
+    _order = "afip_ws, operation"
+
+    afip_ws = fields.Char(
+        'AFIP WS',
+        required=True,
+        readonly=True,
+    )
+    operation = fields.Char(
+        required=True,
+        readonly=True,
+    )
+    company_id = fields.Many2one(
+        'res.company',
+        'Company',
+        readonly=True,
+    )
+    result = fields.Selection(
+        [('ok', 'OK'), ('fault', 'SOAP Fault'), ('error', 'Error')],
+        required=True,
+        readonly=True,
+    )
+    count = fields.Integer(
+        'Calls',
+        readonly=True,
+    )
+    retries = fields.Integer(
+        readonly=True,
+    )
+    duration_total = fields.Float(
+        'Total Duration (s)',
+        readonly=True,
+    )
+    duration_max = fields.Float(
+        'Max Duration (s)',
+        readonly=True,
+        group_operator='max',
+    )
+    request_bytes = fields.Integer(
+        readonly=True,
+    )
+    response_bytes = fields.Integer(
+        readonly=True,
+    )
+
+    def init(self):
+        # see afipws.call_stat init
+        tools.create_unique_index(
+            self._cr, 'afipws_call_stat_total_uniq_index', self._table,
+            ['afip_ws', 'operation', 'coalesce(company_id, 0)', 'result'])
+
+    @api.model
+    def _flush(self, stats):
+        totals = {}
+        for (_stat_date, afip_ws, operation, company_id, result), values in stats.items():
+            total = totals.setdefault((afip_ws, operation, company_id, result), dict.fromkeys(values, 0))
+            for name, value in values.items():
+                total[name] = max(total[name], value) if name == 'duration_max' else total[name] + value
+        for (afip_ws, operation, company_id, result), values in totals.items():
+            self._cr.execute("""
+                INSERT INTO afipws_call_stat_total (
+                    afip_ws, operation, company_id, result, count, retries,
+                    duration_total, duration_max, request_bytes, response_bytes,
+                    create_uid, create_date, write_uid, write_date)
+                VALUES (%(afip_ws)s, %(operation)s, %(company_id)s, %(result)s,
+                    %(count)s, %(retries)s, %(duration_total)s, %(duration_max)s,
+                    %(request_bytes)s, %(response_bytes)s,
+                    %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC')
+                ON CONFLICT (afip_ws, operation, (coalesce(company_id, 0)), result) DO UPDATE
+                SET count = afipws_call_stat_total.count + EXCLUDED.count,
+                    retries = afipws_call_stat_total.retries + EXCLUDED.retries,
+                    duration_total = afipws_call_stat_total.duration_total + EXCLUDED.duration_total,
+                    duration_max = greatest(afipws_call_stat_total.duration_max, EXCLUDED.duration_max),
+                    request_bytes = afipws_call_stat_total.request_bytes + EXCLUDED.request_bytes,
+                    response_bytes = afipws_call_stat_total.response_bytes + EXCLUDED.response_bytes,
+                    write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date""", dict(
+                values, afip_ws=afip_ws, operation=operation, company_id=company_id,
+                result=result, uid=self.env.uid))
+
+
+def _escape_label(value):
+    """ Escape a Prometheus label value """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _record_call(dbname, call, flush_interval):
+    with _stats_lock:
+        _recent_calls.append((dbname, call))
+        key = (
+            date.fromtimestamp(call['time']), call['afip_ws'], call['operation'],
+            call['company_id'], call['result'])
+        stats = _pending_stats.setdefault(dbname, {}).setdefault(key, {
+            'count': 0, 'retries': 0, 'duration_total': 0.0, 'duration_max': 0.0,
+            'request_bytes': 0, 'response_bytes': 0})
+        stats['count'] += 1
+        stats['retries'] += call['retry'] and 1 or 0
+        stats['duration_total'] += call['duration']
+        stats['duration_max'] = max(stats['duration_max'], call['duration'])
+        stats['request_bytes'] += call['request_bytes']
+        stats['response_bytes'] += call['response_bytes']
+    _logger.debug('AFIP ws call %s' % call)
+    _flush_pending(dbname, flush_interval)
+
+
+def _flush_pending(dbname, flush_interval=0):
+    """ Save the aggregated values of dbname on a new cursor, at most once each flush_interval seconds """
+    with _stats_lock:
+        now = time.time()
+        if now - _last_flush.setdefault(dbname, now) < flush_interval:
+            return
+        _last_flush[dbname] = now
+        stats = _pending_stats.pop(dbname, {})
+    if not stats:
+        return
+    try:
+        with api.Environment.manage(), registry(dbname).cursor() as cr:
+            api.Environment(cr, SUPERUSER_ID, {})['afipws.call_stat']._flush(stats)
+    except Exception as error:
+        _logger.warning('Could not save AFIP ws calls statistics: %s' % error)
@@ -74,6 +74,23 @@ class AfipwsCertificate(models.Model):
             else:
                 rec.request_file = False
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super().create(vals_list)
+        # keys and certificates are cached by company (see res.company)
+        self.clear_caches()
+        return res
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     def action_to_draft(self):
         if self.alias_id.state != 'confirmed':
             raise UserError(_('Certificate Alias must be confirmed first!'))
@@ -152,6 +152,23 @@ class AfipwsCertificateAlias(models.Model):
             self.city = self.company_id.city
             self.company_cuit = self.company_id.vat
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super().create(vals_list)
+        # keys and certificates are cached by company (see res.company)
+        self.clear_caches()
+        return res
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     def action_confirm(self):
         if not self.key:
             self.generate_key()
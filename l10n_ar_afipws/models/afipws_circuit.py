@@ -0,0 +1,222 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models, api, registry, SUPERUSER_ID, _
+from odoo.exceptions import UserError
+from contextlib import contextmanager
+from datetime import timedelta
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# last result registered by this process by (dbname, afip_ws, environment_type)
+_last_results = {}
+
+
+class AfipwsCircuit(models.Model):
+    """
+    Circuit breaker by AFIP webservice and environment, shared by all the
+    workers through this table. After "afip.ws.circuit.threshold" consecutive
+    failures reaching the service the circuit opens and using the webservice
+    fails right away instead of waiting for the socket timeout. Once
+    "afip.ws.circuit.cooldown" seconds passed one worker probes the service
+    with Dummy and closes the circuit if it answers.
+    The result of every call is registered by the instrumented clients (see
+    afipws.call_stat _instrument). Results and probes are read and written on
+    a new cursor so they see the last state and are kept even if the current
+    transaction is rolled back.
+    """
+    _name = "afipws.circuit"
+    _description = "AFIP webservice circuit breaker"
+    _rec_name = "afip_ws"
+    _order = "afip_ws, type"
+
+    afip_ws = fields.Char(
+        'AFIP WS',
+        required=True,
+        readonly=True,
+    )
+    type = fields.Selection(
+        [('production', 'Production'), ('homologation', 'Homologation')],
+        'Type',
+        required=True,
+        readonly=True,
+    )
+    state = fields.Selection(
+        [('closed', 'Closed'), ('open', 'Open')],
+        required=True,
+        readonly=True,
+        default='closed',
+        help="* Closed: the service is available.\n* Open: the service is "
+        "failing, calls fail right away until a probe succeeds",
+    )
+    failures = fields.Integer(
+        'Consecutive Failures',
+        readonly=True,
+    )
+    last_failure = fields.Datetime(
+        readonly=True,
+    )
+    next_probe = fields.Datetime(
+        readonly=True,
+    )
+    last_error = fields.Text(
+        readonly=True,
+    )
+
+    _sql_constraints = [
+        ('afip_ws_type_uniq', 'unique(afip_ws, type)',
+         'There is already a circuit for this webservice and environment'),
+    ]
+
+    @api.model
+    def _get_circuit_params(self):
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (
+            int(get_param('afip.ws.circuit.threshold', 5)),
+            int(get_param('afip.ws.circuit.cooldown', 60)))
+
+    @api.model
+    @contextmanager
+    def _circuit_cursor(self):
+        """
+        Cursor to read the last state of the circuits and write them: a new
+        one unless the current cursor is already dedicated to it (context key
+        "afipws_circuit_cursor")
+        """
+        if self._context.get('afipws_circuit_cursor'):
+            yield self._cr
+        else:
+            with self.pool.cursor() as cr:
+                yield cr
+
+    @api.model
+    def is_available(self, afip_ws, environment_type):
+        """
+        Return False while the circuit of the webservice is open and it is
+        not time to probe it yet, so that batch jobs can pause instead of
+        failing on each call
+        """
+        self._cr.execute("""
+            SELECT state, next_probe FROM afipws_circuit
+            WHERE afip_ws = %s AND type = %s""", (afip_ws, environment_type))
+        row = self._cr.fetchone()
+        return not row or row[0] == 'closed' or not row[1] or row[1] <= fields.Datetime.now()
+
+    @api.model
+    def _check(self, afip_ws, environment_type):
+        """
+        Called before using the webservice. Raise an error if the circuit is
+        open, unless it is time to probe it and no other worker is already
+        doing it. In that case return True and the caller should probe the
+        service and register the result
+        """
+        self._cr.execute("""
+            SELECT state FROM afipws_circuit
+            WHERE afip_ws = %s AND type = %s""", (afip_ws, environment_type))
+        row = self._cr.fetchone()
+        if not row or row[0] == 'closed':
+            return False
+        _threshold, cooldown = self._get_circuit_params()
+        now = fields.Datetime.now()
+        # we use a new cursor to see the last state, only one worker gets the
+        # probe and the others keep failing fast
+        with self._circuit_cursor() as cr:
+            cr.execute("""
+                UPDATE afipws_circuit SET next_probe = %s
+                WHERE afip_ws = %s AND type = %s AND state = 'open' AND next_probe <= %s
+                RETURNING id""", (now + timedelta(seconds=cooldown), afip_ws, environment_type, now))
+            if cr.fetchone():
+                _logger.info('Probing AFIP service %s (%s)' % (afip_ws, environment_type))
+                return True
+            cr.execute("""
+                SELECT state, last_error FROM afipws_circuit
+                WHERE afip_ws = %s AND type = %s""", (afip_ws, environment_type))
+            state, last_error = cr.fetchone()
+        if state == 'closed':
+            return False
+        raise UserError(_(
+            'AFIP service %s is not available, please try again in a few '
+            'minutes.\nLast error: %s') % (afip_ws, last_error))
+
+    @api.model
+    def _register_result(self, afip_ws, environment_type, error=False):
+        if error:
+            self._register_failure(afip_ws, environment_type, error)
+        else:
+            self._register_success(afip_ws, environment_type)
+
+    @api.model
+    def _register_failure(self, afip_ws, environment_type, error):
+        threshold, cooldown = self._get_circuit_params()
+        now = fields.Datetime.now()
+        values = {
+            'afip_ws': afip_ws,
+            'type': environment_type,
+            'error': str(error),
+            'now': now,
+            'next_probe': now + timedelta(seconds=cooldown),
+            'uid': self.env.uid,
+        }
+        with self._circuit_cursor() as cr:
+            cr.execute("""
+                INSERT INTO afipws_circuit (
+                    afip_ws, type, state, failures, last_failure, last_error,
+                    create_uid, create_date, write_uid, write_date)
+                VALUES (%(afip_ws)s, %(type)s, 'closed', 1, %(now)s, %(error)s,
+                    %(uid)s, %(now)s, %(uid)s, %(now)s)
+                ON CONFLICT (afip_ws, type) DO UPDATE
+                SET failures = afipws_circuit.failures + 1,
+                    last_failure = EXCLUDED.last_failure,
+                    last_error = EXCLUDED.last_error,
+                    write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date
+                RETURNING failures, state""", values)
+            failures, state = cr.fetchone()
+            if failures >= threshold:
+                cr.execute("""
+                    UPDATE afipws_circuit SET state = 'open', next_probe = %(next_probe)s
+                    WHERE afip_ws = %(afip_ws)s AND type = %(type)s""", values)
+                if state == 'closed':
+                    _logger.warning(
+                        'AFIP service %s (%s) not available after %s failures, '
+                        'circuit opened: %s' % (afip_ws, environment_type, failures, error))
+
+    @api.model
+    def _register_success(self, afip_ws, environment_type):
+        # on the usual case nothing matches and nothing is locked nor written
+        with self._circuit_cursor() as cr:
+            cr.execute("""
+                UPDATE afipws_circuit
+                SET state = 'closed', failures = 0, next_probe = NULL,
+                    write_uid = %s, write_date = %s
+                WHERE afip_ws = %s AND type = %s AND (failures > 0 OR state = 'open')
+                RETURNING id""", (
+                self.env.uid, fields.Datetime.now(), afip_ws, environment_type))
+            if not cr.fetchone():
+                return
+        _logger.info('AFIP service %s (%s) available' % (afip_ws, environment_type))
+
+    def action_close(self):
+        self.write({'state': 'closed', 'failures': 0, 'next_probe': False})
+
+
+def _register_call_result(dbname, afip_ws, environment_type, error=False):
+    """
+    Register the result of a call made by an instrumented client (see
+    afipws.call_stat _instrument). While the calls of this process succeed
+    nothing is registered, a cursor is only used for failures and for the
+    first success after them (or the first one of the process)
+    """
+    key = (dbname, afip_ws, environment_type)
+    if not error and _last_results.get(key) == 'ok':
+        return
+    _last_results[key] = error and 'error' or 'ok'
+    try:
+        with api.Environment.manage(), registry(dbname).cursor() as cr:
+            api.Environment(cr, SUPERUSER_ID, {'afipws_circuit_cursor': True})[
+                'afipws.circuit']._register_result(afip_ws, environment_type, error=error)
+    except Exception as exc:
+        # we try again on next call
+        _last_results.pop(key, None)
+        _logger.warning('Could not register AFIP service %s status: %s' % (afip_ws, exc))
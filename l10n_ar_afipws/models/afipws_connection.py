@@ -4,10 +4,32 @@
 ##############################################################################
 from odoo import fields, models, api, _
 from odoo.exceptions import UserError, RedirectWarning
+from collections import OrderedDict
+from datetime import timedelta
+import odoo.tools as tools
 import logging
+import os
+import shutil
+import threading
+import time
 
 _logger = logging.getLogger(__name__)
 
+# Worker local pool of already connected pyafipws objects. Conectar downloads
+# and parses the WSDL so we keep the connected objects and only refresh
+# token and sign when the access ticket changes. Keys include an owner, the
+# thread or a slot handed out by the caller (see _get_ws_pool_owner), so that
+# an object is never used by two requests at the same time.
+# key: (dbname, company_id, afip_ws, type, owner), value: (ws, last_use)
+_ws_pool = OrderedDict()
+_ws_pool_lock = threading.Lock()
+
+# Last time this worker registered the use of each connection, so that
+# last_used is written at most every _TOUCH_INTERVAL seconds.
+# key: (dbname, connection_id), value: time
+_last_touch = {}
+_TOUCH_INTERVAL = 300
+
 
 class AfipwsConnection(models.Model):
 
@@ -43,6 +65,23 @@ class AfipwsConnection(models.Model):
         'Expiration Time',
         readonly=True
     )
+    certificate_fingerprint = fields.Char(
+        readonly=True,
+        help='SHA-256 fingerprint of the certificate used to get this access '
+        'ticket',
+    )
+    last_used = fields.Datetime(
+        readonly=True,
+        help='Last time the access ticket was used (updated every few minutes)',
+    )
+    renewal_failures = fields.Integer(
+        readonly=True,
+    )
+    next_renewal = fields.Datetime(
+        readonly=True,
+        help='After a failed renewal, the ticket is not renewed again until '
+        'this time',
+    )
     afip_login_url = fields.Char(
         'AFIP Login URL',
         compute='_compute_afip_urls',
@@ -114,6 +153,91 @@ class AfipwsConnection(models.Model):
                     "personaServiceA5?wsdl")
         return afip_ws_url
 
+    @api.model
+    def _cron_renew_connections(self):
+        """
+        Renew the expired access tickets of every company, webservice and
+        environment used on the last "afip.ws.renew.lookback" hours (24 by
+        default), so that posting an invoice doesn't need to wait for the
+        login.
+        AFIP refuses a new ticket while the previous one is still valid, so
+        the renewal is only attempted once the last ticket expired. If it
+        fails (for eg. because another system with the same certificate got
+        a ticket that is still valid) it is not attempted again for
+        "afip.ws.renew.retry.delay" seconds (300 by default), doubled on each
+        failure up to "afip.ws.renew.max.retry.delay" (3600 by default).
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        lookback = int(get_param('afip.ws.renew.lookback', 24))
+        delay = int(get_param('afip.ws.renew.retry.delay', 300))
+        max_delay = int(get_param('afip.ws.renew.max.retry.delay', 3600))
+        now = fields.Datetime.now()
+
+        # last connection of each company, webservice and environment with
+        # any of its tickets used recently
+        self._cr.execute("""
+            SELECT DISTINCT ON (c.company_id, c.afip_ws, c.type) c.id
+            FROM afipws_connection c
+            WHERE EXISTS (
+                SELECT 1 FROM afipws_connection u
+                WHERE u.company_id = c.company_id AND u.afip_ws = c.afip_ws
+                    AND u.type = c.type AND u.last_used >= %s)
+            ORDER BY c.company_id, c.afip_ws, c.type, c.expirationtime DESC""", (
+            now - timedelta(hours=lookback),))
+        connections = self.browse([row[0] for row in self._cr.fetchall()])
+
+        for connection in connections:
+            company = connection.company_id
+            if connection.expirationtime > now or \
+               (connection.next_renewal and connection.next_renewal > now) or \
+               connection.type != company._get_environment_type():
+                continue
+            _logger.info(
+                'Renewing connection for company %s, environment type %s and '
+                'ws %s' % (company.name, connection.type, connection.afip_ws))
+            try:
+                company._create_connection(connection.afip_ws, connection.type)
+            except Exception as error:
+                failures = connection.renewal_failures + 1
+                connection.write({
+                    'renewal_failures': failures,
+                    'next_renewal': now + timedelta(
+                        seconds=min(delay * 2 ** (failures - 1), max_delay)),
+                })
+                log = _logger.info if self._is_valid_ticket_error(error) else _logger.warning
+                log('Could not renew connection for company %s and ws %s (attempt %s): %s' % (
+                    company.name, connection.afip_ws, failures, error))
+
+    @api.model
+    def _is_valid_ticket_error(self, error):
+        """ Return True if AFIP refused a new ticket because there is one still valid """
+        return 'ya posee un TA valido' in str(error)
+
+    def _touch(self):
+        """
+        Register that the access ticket is being used, so that the renew cron
+        only renews the tickets of services really in use. It is written on a
+        new cursor at most every few minutes by worker, and skipped if another
+        transaction is already writing it
+        """
+        connection_id = self._origin.id
+        if not connection_id:
+            return
+        touch_key = (self._cr.dbname, connection_id)
+        now = time.time()
+        if now - _last_touch.get(touch_key, 0) < _TOUCH_INTERVAL:
+            return
+        for key, last_touch in list(_last_touch.items()):
+            if now - last_touch >= _TOUCH_INTERVAL:
+                _last_touch.pop(key, None)
+        _last_touch[touch_key] = now
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE afipws_connection SET last_used = %s
+                WHERE id IN (
+                    SELECT id FROM afipws_connection WHERE id = %s
+                    FOR UPDATE SKIP LOCKED)""", (fields.Datetime.now(), connection_id))
+
     def check_afip_ws(self, afip_ws):
         # TODO tal vez cambiar nombre cuando veamos si devuelve otra cosa
         self.ensure_one()
@@ -128,6 +252,42 @@ class AfipwsConnection(models.Model):
         Method to be called
         """
         self.ensure_one()
+        with self.env['afipws.profile']._stage('connect'):
+            # fail fast if the service is down (see afipws.circuit)
+            probe = self.env['afipws.circuit'].sudo()._check(self.afip_ws, self.type)
+            self._touch()
+            pool_key = (
+                self._cr.dbname, self.company_id.id, self.afip_ws, self.type,
+                self._get_ws_pool_owner())
+            ws = self._get_pooled_ws(pool_key)
+            if not ws:
+                with self.env['afipws.profile']._stage('load WSDL'):
+                    ws = self._connect_ws()
+                self._pool_ws(pool_key, ws)
+
+            cuit = self.company_id.partner_id.ensure_vat()
+            ws.Cuit = cuit
+            ws.Token = self.token
+            ws.Sign = self.sign
+            # TODO till this this PR is accepted
+            ws.Obs = ''
+            ws.Errores = []
+            # attempt number of retried calls, for statistics
+            ws._afipws_retry = 0
+            if probe:
+                self._probe_ws(ws)
+
+            _logger.info(
+                'Connection getted with url "%s", cuit "%s"' % (
+                    self.afip_ws_url, ws.Cuit))
+        return ws
+
+    def _connect_ws(self):
+        """
+        Get a new pyafipws object connected to the webservice. It should only
+        be called from connect
+        """
+        self.ensure_one()
         _logger.info(
             'Getting connection to ws %s from libraries on '
             'connection id %s' % (self.afip_ws, self.id))
@@ -143,18 +303,21 @@ class AfipwsConnection(models.Model):
         if not ws:
             raise UserError(_('AFIP Webservice %s not implemented yet' % (
                 self.afip_ws)))
-        # TODO implementar cache y proxy
+        # TODO implementar proxy
         # create the proxy and get the configuration system parameters:
         # cfg = self.pool.get('ir.config_parameter').sudo()
-        # cache = cfg.get_param(cr, uid, 'pyafipws.cache', context=context)
         # proxy = cfg.get_param(cr, uid, 'pyafipws.proxy', context=context)
+        cache = self._get_ws_cache_dir()
 
         wsdl = self.afip_ws_url
 
         # connect to the webservice and call to the test method
         try:
-            ws.Conectar("", wsdl or "", "")
+            ws.Conectar(
+                cache, wsdl or "", "", timeout=self._get_ws_timeout(self.afip_ws))
         except Exception as error:
+            self.env['afipws.circuit'].sudo()._register_failure(
+                self.afip_ws, self.type, repr(error))
             if 'ExpatError' in repr(error) or 'mismatched tag' in repr(error) or \
                'Conexión reinicializada por la máquina remota' in repr(error) or \
                "module 'httplib2' has no attribute 'SSLHandshakeError'" in repr(error):
@@ -163,20 +326,190 @@ class AfipwsConnection(models.Model):
                 raise RedirectWarning(msg, action.id, _('Go and find data manually'))
             raise UserError(
                 'There was a connection problem to AFIP. Contact your Odoo Provider. Error\n\n%s' % repr(error))
+        self.env['afipws.call_stat']._instrument(ws, self.afip_ws, self.company_id, self.type)
+        return ws
 
-        cuit = self.company_id.partner_id.ensure_vat()
-        ws.Cuit = cuit
-        ws.Token = self.token
-        ws.Sign = self.sign
-        # TODO till this this PR is accepted
-        ws.Obs = ''
-        ws.Errores = []
+    def _probe_ws(self, ws):
+        """
+        Check with Dummy if the service is available again and register the
+        result on its circuit
+        """
+        self.ensure_one()
+        error = False
+        # the instrumented client must not register the call by itself
+        ws._afipws_circuit_probe = True
+        try:
+            ws.Dummy()
+            if ws.AppServerStatus != 'OK':
+                error = 'Dummy: AppServer %s, DbServer %s, AuthServer %s' % (
+                    ws.AppServerStatus, ws.DbServerStatus, ws.AuthServerStatus)
+        except Exception as exc:
+            error = repr(exc)
+        finally:
+            ws._afipws_circuit_probe = False
+        self.env['afipws.circuit'].sudo()._register_result(
+            self.afip_ws, self.type, error=error)
+        if error:
+            raise UserError(_(
+                'AFIP service %s is not available, please try again in a few '
+                'minutes.\nLast error: %s') % (self.afip_ws, error))
 
-        _logger.info(
-            'Connection getted with url "%s", cuit "%s"' % (
-                wsdl, ws.Cuit))
+    @api.model
+    def _get_ws_cache_dir(self):
+        """
+        Return the directory where pysimplesoap keeps the downloaded WSDL/XSD
+        files and the pickled parsed service description, so that new workers
+        don't need to download them from AFIP. It is a folder of the base
+        cache directory (see _get_ws_cache_base_dir) for each period of
+        "afip.ws.cache.ttl" seconds (one day by default, 0 to keep the files),
+        so that files are downloaded and parsed again on each period without
+        removing files other workers could be reading. Folders of past
+        periods are removed by _cron_clean_ws_cache
+        """
+        cache_dir = self._get_ws_cache_base_dir()
+        ttl = self._get_ws_cache_ttl()
+        if not cache_dir or ttl <= 0:
+            return cache_dir
+        cache_dir = os.path.join(cache_dir, '%d' % (time.time() // ttl))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as error:
+            _logger.warning(
+                'Could not create afip ws cache dir %s, error: %s' % (
+                    cache_dir, error))
+            return ""
+        return cache_dir
+
+    @api.model
+    def _get_ws_cache_base_dir(self):
+        """
+        Return the base cache directory, taken from:
+        * "afip.ws.cache.dir" parameter
+        * "afip_ws_cache_dir" key on odoo conf file
+        * "afipws_cache" folder on odoo data dir
+        """
+        cache_dir = self.env['ir.config_parameter'].sudo().get_param('afip.ws.cache.dir') or tools.config.get(
+            'afip_ws_cache_dir') or os.path.join(
+                tools.config['data_dir'], 'afipws_cache')
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as error:
+            _logger.warning(
+                'Could not create afip ws cache dir %s, error: %s' % (
+                    cache_dir, error))
+            return ""
+        return cache_dir
+
+    @api.model
+    def _get_ws_cache_ttl(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param('afip.ws.cache.ttl', 86400))
+
+    @api.model
+    def _cron_clean_ws_cache(self):
+        """
+        Remove the cache folders of the periods before the previous one (a
+        worker could still be reading the previous one) and the files that
+        were kept on the base folder by previous versions
+        """
+        cache_dir = self._get_ws_cache_base_dir()
+        ttl = self._get_ws_cache_ttl()
+        if not cache_dir or ttl <= 0:
+            return
+        current = int(time.time() // ttl)
+        for entry in os.scandir(cache_dir):
+            try:
+                if entry.is_dir() and entry.name.isdigit() and int(entry.name) < current - 1:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                elif entry.is_file() and entry.stat().st_mtime < time.time() - 2 * ttl:
+                    os.remove(entry.path)
+            except OSError:
+                # another worker could have removed it
+                continue
+
+    @api.model
+    def _get_ws_timeout(self, afip_ws):
+        """
+        Return the socket timeout (in seconds) for afip_ws, from system
+        parameter "afip.ws.timeout.<afip_ws>" or "afip.ws.timeout"
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return int(get_param('afip.ws.timeout.%s' % afip_ws) or get_param('afip.ws.timeout', 30))
+
+    @api.model
+    def _get_ws_retry_params(self, afip_ws):
+        """
+        Return how many times a failed call to afip_ws is retried and the
+        delay (in seconds) before the first retry, doubled on each one. Only
+        calls that are safe to repeat are retried
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (
+            int(get_param('afip.ws.retries.%s' % afip_ws) or get_param('afip.ws.retries', 2)),
+            float(get_param('afip.ws.retry.delay', 1)),
+        )
+
+    @api.model
+    def _get_ws_pool_params(self):
+        """ Return max size and idle timeout (in seconds) of the pool of connected objects """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (
+            int(get_param('afip.ws.pool.size', 32)),
+            int(get_param('afip.ws.pool.timeout', 600)),
+        )
+
+    @api.model
+    def _get_ws_pool_owner(self):
+        """
+        Return who owns the pooled objects used on this request. Short lived
+        threads (for eg. the ones processing the CAE queue lanes) pass a slot
+        on "afipws_pool_slot" context key, only used by one thread at a time,
+        so that the next threads reuse the objects. Otherwise the current
+        thread is the owner
+        """
+        slot = self._context.get('afipws_pool_slot')
+        if slot is not None:
+            return ('slot', slot)
+        return ('thread', threading.get_ident())
+
+    @api.model
+    def _get_pooled_ws(self, pool_key):
+        _size, timeout = self._get_ws_pool_params()
+        now = time.time()
+        with _ws_pool_lock:
+            # drop idle objects (the pool is ordered by last use)
+            while _ws_pool:
+                oldest_key, (oldest_ws, last_use) = next(iter(_ws_pool.items()))
+                if now - last_use <= timeout:
+                    break
+                del _ws_pool[oldest_key]
+            # and the objects of threads that are gone
+            alive = {thread.ident for thread in threading.enumerate()}
+            for key in [key for key in _ws_pool if key[4][0] == 'thread' and key[4][1] not in alive]:
+                del _ws_pool[key]
+            ws, _last_use = _ws_pool.pop(pool_key, (False, False))
+            if ws:
+                _ws_pool[pool_key] = (ws, now)
         return ws
 
+    @api.model
+    def _pool_ws(self, pool_key, ws):
+        size, _timeout = self._get_ws_pool_params()
+        if size <= 0:
+            return
+        with _ws_pool_lock:
+            _ws_pool[pool_key] = (ws, time.time())
+            while len(_ws_pool) > size:
+                _ws_pool.popitem(last=False)
+
+    @api.model
+    def _clear_ws_pool(self, afip_ws=None):
+        """ Discard connected objects of this database (optionally only for the given afip_ws) """
+        dbname = self._cr.dbname
+        with _ws_pool_lock:
+            for pool_key in list(_ws_pool):
+                if pool_key[0] == dbname and (not afip_ws or pool_key[2] == afip_ws):
+                    del _ws_pool[pool_key]
+
     @api.model
     def _get_ws(self, afip_ws):
         """
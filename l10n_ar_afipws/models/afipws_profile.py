@@ -0,0 +1,207 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models, api
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+# profiling session running on this thread (if any)
+_profile = threading.local()
+
+
+class AfipwsProfile(models.Model):
+    """
+    Timings and SQL queries count of each stage of an operation (for eg.
+    posting invoices and requesting their CAE). A session is only recorded if
+    the user has "Profile AFIP Operations" set or the context has
+    "afipws_profile" and it is saved on a new cursor so that it is kept even
+    if the operation fails. Stages are nested, each one is saved with its
+    path (for eg. "post / do_pyafipws_request_cae / CAESolicitar").
+    """
+    _name = "afipws.profile"
+    _description = "AFIP operations profile"
+    _order = "id desc"
+
+    name = fields.Char(
+        required=True,
+        readonly=True,
+    )
+    date = fields.Datetime(
+        required=True,
+        readonly=True,
+        default=fields.Datetime.now,
+    )
+    user_id = fields.Many2one(
+        'res.users',
+        'User',
+        readonly=True,
+    )
+    res_model = fields.Char(
+        'Model',
+        readonly=True,
+    )
+    res_ids = fields.Char(
+        'Records',
+        readonly=True,
+    )
+    duration = fields.Float(
+        'Duration (s)',
+        readonly=True,
+        digits=(16, 4),
+    )
+    query_count = fields.Integer(
+        'Queries',
+        readonly=True,
+    )
+    error = fields.Text(
+        readonly=True,
+    )
+    line_ids = fields.One2many(
+        'afipws.profile.line',
+        'profile_id',
+        'Stages',
+        readonly=True,
+    )
+
+    @api.model
+    def _is_enabled(self):
+        return bool(self._context.get('afipws_profile') or self.env.user.afipws_profile)
+
+    @api.model
+    @contextmanager
+    def _session(self, name, records=None):
+        """
+        Profile the code run inside the with block if enabled and no other
+        session is running on this thread (in that case it is profiled as a
+        stage of the running session)
+        """
+        if getattr(_profile, 'session', None) is not None:
+            with self._stage(name):
+                yield
+            return
+        if not self._is_enabled():
+            yield
+            return
+        session = _profile.session = {
+            'cr': self._cr, 'stack': [], 'stages': {}}
+        start, queries = time.time(), _query_count(self._cr)
+        error = False
+        try:
+            yield
+        except Exception as exc:
+            error = repr(exc)
+            raise
+        finally:
+            _profile.session = None
+            self._save_session(name, records, session, dict(
+                duration=time.time() - start,
+                query_count=_query_count(self._cr) - queries,
+                error=error))
+
+    @api.model
+    @contextmanager
+    def _stage(self, name):
+        """ Time the code run inside the with block if a session is running """
+        with profile_stage(name):
+            yield
+
+    @api.model
+    def _save_session(self, name, records, session, values):
+        lines = [(0, 0, dict(stage, name=path)) for path, stage in session['stages'].items()]
+        try:
+            with self.pool.cursor() as cr:
+                profile = self.with_env(self.env(cr=cr)).sudo().create(dict(
+                    values,
+                    name=name,
+                    user_id=self.env.uid,
+                    res_model=records is not None and records._name or False,
+                    res_ids=records is not None and ','.join(str(x) for x in records.ids) or False,
+                    line_ids=lines,
+                ))
+                _logger.info('AFIP operation "%s" profiled on afipws.profile %s' % (name, profile.id))
+        except Exception as error:
+            _logger.warning('Could not save AFIP operation profile: %s' % error)
+
+
+class AfipwsProfileLine(models.Model):
+    _name = "afipws.profile.line"
+    _description = "AFIP operations profile stage"
+    _order = "profile_id, sequence"
+
+    profile_id = fields.Many2one(
+        'afipws.profile',
+        'Profile',
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete='cascade',
+    )
+    sequence = fields.Integer(
+        readonly=True,
+    )
+    name = fields.Char(
+        'Stage',
+        required=True,
+        readonly=True,
+    )
+    level = fields.Integer(
+        readonly=True,
+    )
+    calls = fields.Integer(
+        readonly=True,
+    )
+    duration = fields.Float(
+        'Duration (s)',
+        readonly=True,
+        digits=(16, 4),
+    )
+    query_count = fields.Integer(
+        'Queries',
+        readonly=True,
+    )
+
+
+def _query_count(cr):
+    """
+    Queries made by this thread on any cursor if odoo counts them (http
+    requests), else the ones made on cr
+    """
+    thread = threading.current_thread()
+    if hasattr(thread, 'query_count'):
+        return thread.query_count
+    return cr.sql_log_count
+
+
+@contextmanager
+def profile_stage(name):
+    """
+    Time the code run inside the with block as a stage of the session running
+    on this thread, if any. It can be used where we don't have an env (for
+    eg. on the instrumented SOAP calls)
+    """
+    session = getattr(_profile, 'session', None)
+    if session is None:
+        yield
+        return
+    stack = session['stack']
+    stack.append(name)
+    stage = session['stages'].setdefault(' / '.join(stack), {
+        'sequence': len(session['stages']),
+        'level': len(stack) - 1,
+        'calls': 0,
+        'duration': 0.0,
+        'query_count': 0,
+    })
+    start, queries = time.time(), _query_count(session['cr'])
+    try:
+        yield
+    finally:
+        stage['calls'] += 1
+        stage['duration'] += time.time() - start
+        stage['query_count'] += _query_count(session['cr']) - queries
+        stack.pop()
@@ -0,0 +1,17 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models
+
+
+class ResUsers(models.Model):
+
+    _inherit = 'res.users'
+
+    afipws_profile = fields.Boolean(
+        'Profile AFIP Operations',
+        help='If set, the timings and queries of each stage of the AFIP '
+        'operations of this user (for eg. invoice posting) are recorded on '
+        '"Profiles" menu. It slows down the operations a little',
+    )
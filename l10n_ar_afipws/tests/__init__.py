@@ -0,0 +1,7 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from . import test_circuit
+from . import test_ws_cache
+from . import test_call_stat
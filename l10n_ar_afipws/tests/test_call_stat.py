@@ -0,0 +1,48 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields
+from odoo.tests.common import TransactionCase, tagged
+from datetime import timedelta
+import os
+import tempfile
+
+
+@tagged('post_install', '-at_install')
+class TestCallStat(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        # pending statistics are saved on new cursors
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = os.path.join(self.tmp_dir.name, 'afipws.prom')
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('afip.ws.stats.days', 30)
+        set_param('afip.ws.stats.prometheus_file', self.path)
+        self.stat = self.env['afipws.call_stat']
+
+    def _flush(self, stat_date, count):
+        self.stat._flush({(stat_date, 'wsfe', 'FEStandInTest', False, 'ok'): {
+            'count': count, 'retries': 0, 'duration_total': count * 0.5, 'duration_max': 0.5,
+            'request_bytes': 100 * count, 'response_bytes': 200 * count}})
+
+    def _get_calls(self):
+        self.stat._cron_export()
+        with open(self.path) as metrics_file:
+            for line in metrics_file:
+                if line.startswith('afip_ws_calls_total{') and 'operation="FEStandInTest"' in line:
+                    return int(line.split()[-1])
+
+    def test_counters_after_retention(self):
+        today = fields.Date.context_today(self.stat)
+        self._flush(today - timedelta(days=40), 3)
+        self._flush(today, 2)
+        self.assertEqual(self._get_calls(), 5)
+        # old daily rows were deleted but the totals are kept
+        self.assertEqual(self.stat.search_count([('operation', '=', 'FEStandInTest')]), 1)
+        self._flush(today, 1)
+        self.assertEqual(self._get_calls(), 6)
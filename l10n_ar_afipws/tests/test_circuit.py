@@ -0,0 +1,123 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase, tagged
+from odoo.addons.l10n_ar_afipws.models import afipws_circuit
+from datetime import timedelta
+from unittest.mock import patch
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.error = None
+
+    def call(self, method, *args, **kwargs):
+        if self.error:
+            raise self.error
+        return {}
+
+
+class FakeWs(object):
+
+    def __init__(self):
+        self.client = FakeClient()
+
+
+@tagged('post_install', '-at_install')
+class TestCircuit(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        # results are registered on new cursors, we keep them on the test one
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        self.circuit = self.env['afipws.circuit'].with_context(afipws_circuit_cursor=True)
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('afip.ws.circuit.threshold', 3)
+        set_param('afip.ws.circuit.cooldown', 60)
+        afipws_circuit._last_results.clear()
+
+    def _get_circuit(self):
+        self.circuit.invalidate_cache()
+        return self.circuit.search([('afip_ws', '=', 'wsfe'), ('type', '=', 'homologation')])
+
+    def _allow_probe(self):
+        circuit = self._get_circuit()
+        circuit.next_probe = fields.Datetime.now() - timedelta(seconds=1)
+        circuit.flush()
+
+    def _fail(self, times=1):
+        for _attempt in range(times):
+            self.circuit._register_failure('wsfe', 'homologation', 'timed out')
+
+    def test_open_after_threshold(self):
+        self._fail(2)
+        circuit = self._get_circuit()
+        self.assertEqual((circuit.state, circuit.failures), ('closed', 2))
+        self.assertFalse(self.circuit._check('wsfe', 'homologation'))
+
+        self._fail()
+        self.assertEqual(self._get_circuit().state, 'open')
+        self.assertFalse(self.circuit.is_available('wsfe', 'homologation'))
+        with self.assertRaises(UserError):
+            self.circuit._check('wsfe', 'homologation')
+
+    def test_success_resets_failures(self):
+        self._fail(2)
+        self.circuit._register_success('wsfe', 'homologation')
+        self.assertEqual(self._get_circuit().failures, 0)
+        # failures must be consecutive to open the circuit
+        self._fail(2)
+        self.assertEqual(self._get_circuit().state, 'closed')
+
+    def test_probe(self):
+        self._fail(3)
+        self._allow_probe()
+        self.assertTrue(self.circuit.is_available('wsfe', 'homologation'))
+        # only one caller gets the probe, the others keep failing fast
+        self.assertTrue(self.circuit._check('wsfe', 'homologation'))
+        with self.assertRaises(UserError):
+            self.circuit._check('wsfe', 'homologation')
+
+        # a failed probe keeps it open until next cooldown
+        self._fail()
+        circuit = self._get_circuit()
+        self.assertEqual(circuit.state, 'open')
+        self.assertGreater(circuit.next_probe, fields.Datetime.now())
+
+        self._allow_probe()
+        self.assertTrue(self.circuit._check('wsfe', 'homologation'))
+        self.circuit._register_success('wsfe', 'homologation')
+        circuit = self._get_circuit()
+        self.assertEqual((circuit.state, circuit.failures), ('closed', 0))
+        self.assertFalse(self.circuit._check('wsfe', 'homologation'))
+
+    def test_instrumented_calls(self):
+        ws = FakeWs()
+        self.env['afipws.call_stat']._instrument(ws, 'wsfe', self.env.company, 'homologation')
+        ws.client.error = OSError('timed out')
+        for _attempt in range(2):
+            with self.assertRaises(OSError):
+                ws.client.call('FECAESolicitar')
+        self.assertEqual(self._get_circuit().failures, 2)
+
+        # any answer of AFIP, even a SOAP fault, resets the failures
+        ws.client.error = None
+        ws.client.call('FEParamGetTiposCbte')
+        self.assertEqual(self._get_circuit().failures, 0)
+
+        # while the calls succeed nothing is registered
+        with patch.object(afipws_circuit, 'registry') as registry:
+            ws.client.call('FEParamGetTiposCbte')
+        registry.assert_not_called()
+
+        # probes register their own result
+        ws.client.error = OSError('timed out')
+        ws._afipws_circuit_probe = True
+        with self.assertRaises(OSError):
+            ws.client.call('FEDummy')
+        self.assertEqual(self._get_circuit().failures, 0)
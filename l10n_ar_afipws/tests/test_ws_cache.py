@@ -0,0 +1,45 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo.tests.common import TransactionCase, tagged
+import os
+import tempfile
+import time
+
+
+@tagged('post_install', '-at_install')
+class TestWsCache(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('afip.ws.cache.dir', self.tmp_dir.name)
+        set_param('afip.ws.cache.ttl', 3600)
+        self.connection = self.env['afipws.connection']
+
+    def test_cache_dir_by_period(self):
+        cache_dir = self.connection._get_ws_cache_dir()
+        self.assertEqual(os.path.dirname(cache_dir), self.tmp_dir.name)
+        self.assertEqual(os.path.basename(cache_dir), '%d' % (time.time() // 3600))
+        self.assertTrue(os.path.isdir(cache_dir))
+
+        self.env['ir.config_parameter'].sudo().set_param('afip.ws.cache.ttl', 0)
+        self.assertEqual(self.connection._get_ws_cache_dir(), self.tmp_dir.name)
+
+    def test_clean_cache(self):
+        current = int(time.time() // 3600)
+        for period in [current - 3, current - 1, current]:
+            os.makedirs(os.path.join(self.tmp_dir.name, str(period)))
+        old_file = os.path.join(self.tmp_dir.name, 'old.pkl')
+        new_file = os.path.join(self.tmp_dir.name, 'new.pkl')
+        for path in [old_file, new_file]:
+            open(path, 'w').close()
+        os.utime(old_file, (time.time() - 3 * 3600, time.time() - 3 * 3600))
+
+        self.connection._cron_clean_ws_cache()
+        # the previous period could still be in use
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), sorted(
+            [str(current - 1), str(current), 'new.pkl']))
@@ -1,6 +1,6 @@
 {
     "name": "Factura Electrónica Argentina",
-    'version': '13.0.1.2.0',
+    'version': '13.0.1.6.0',
     'category': 'Localization/Argentina',
     'sequence': 14,
     'author': 'ADHOC SA, Moldeo Interactive,Odoo Community Association (OCA)',
@@ -19,6 +19,11 @@
         'views/report_invoice.xml',
         'views/res_config_settings.xml',
         'views/menuitem.xml',
+        'views/afipws_cae_queue_views.xml',
+        'views/afipws_last_number_views.xml',
+        'views/afipws_caea_views.xml',
+        'security/ir.model.access.csv',
+        'data/ir_cron_data.xml',
     ],
     'demo': [
     ],
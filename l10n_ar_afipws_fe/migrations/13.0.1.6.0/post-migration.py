@@ -0,0 +1,36 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import api, SUPERUSER_ID
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """ Move the XML stored on account_move to afipws.xml_log and drop the columns """
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'account_move' AND column_name IN ('afip_xml_request', 'afip_xml_response')""")
+    if len(cr.fetchall()) != 2:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    xml_log = env['afipws.xml_log']
+    cr.execute("""
+        SELECT id FROM account_move
+        WHERE afip_xml_request IS NOT NULL OR afip_xml_response IS NOT NULL
+        ORDER BY id""")
+    move_ids = [row[0] for row in cr.fetchall()]
+    _logger.info('Moving AFIP XML of %s invoices to afipws.xml_log' % len(move_ids))
+    for start in range(0, len(move_ids), 1000):
+        cr.execute("""
+            SELECT id, afip_xml_request, afip_xml_response FROM account_move
+            WHERE id IN %s""", (tuple(move_ids[start:start + 1000]),))
+        xml_log.create([{
+            'move_id': move_id,
+            'request_data': xml_log._compress(request),
+            'response_data': xml_log._compress(response),
+        } for move_id, request, response in cr.fetchall()])
+        env.clear()
+    cr.execute('ALTER TABLE account_move DROP COLUMN afip_xml_request, DROP COLUMN afip_xml_response')
@@ -5,4 +5,8 @@
 from . import account_move
 from . import afipws_connection
 from . import account_journal
-from . import res_config_settings
\ No newline at end of file
+from . import res_config_settings
+from . import afipws_cae_queue
+from . import afipws_last_number
+from . import afipws_caea
+from . import afipws_xml_log
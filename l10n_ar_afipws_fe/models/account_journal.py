@@ -4,6 +4,8 @@
 ##############################################################################
 from odoo import models, api, fields, _
 import logging
+import socket
+import time
 from odoo.exceptions import UserError
 
 _logger = logging.getLogger(__name__)
@@ -13,6 +15,12 @@ class AccountJournal(models.Model):
     _inherit = 'account.journal'
 
     afip_ws = fields.Selection(selection='_get_afip_ws', compute='_compute_afip_ws', string='AFIP WS')
+    afip_caea = fields.Boolean(
+        'Use CAEA',
+        help='Authorize invoices with the anticipated authorization code (CAEA) of the fortnight, without '
+        'calling AFIP when posting. Invoices are reported to AFIP in background. The point of sale must be '
+        'enabled for CAEA on AFIP',
+    )
 
     def _get_afip_ws(self):
         return [('wsfe', _('Domestic market -without detail- RG2485 (WSFEv1)')),
@@ -50,6 +58,7 @@ class AccountJournal(models.Model):
         for sequence in self.l10n_ar_sequence_ids:
             last = self.get_pyafipws_last_invoice(sequence.l10n_latam_document_type_id)['result']
             sequence.sudo().number_next_actual = last + 1
+            self._set_pyafipws_last_number(sequence.l10n_latam_document_type_id, last, force=True)
             # next_by_ws = int(
             #     journal_document_type.get_pyafipws_last_invoice(
             #     )['result']) + 1
@@ -62,26 +71,36 @@ class AccountJournal(models.Model):
 
         if not afip_ws:
             return (_('No AFIP WS selected on point of sale %s') % (self.name))
+        if afip_ws not in ("wsfe", "wsmtxca", "wsfex", "wsbfe"):
+            return(_('AFIP WS %s not implemented') % afip_ws)
         ws = company.get_connection(afip_ws).connect()
-        # call the webservice method to get the last invoice at AFIP:
-
-        try:
-            if afip_ws in ("wsfe", "wsmtxca"):
-                last = ws.CompUltimoAutorizado(document_type.code, self.l10n_ar_afip_pos_number)
-            elif afip_ws in ["wsfex", 'wsbfe']:
-                last = ws.GetLastCMP(document_type.code, self.l10n_ar_afip_pos_number)
-            else:
-                return(_('AFIP WS %s not implemented') % afip_ws)
-        except ValueError as error:
-            _logger.warning('exception in get_pyafipws_last_invoice: %s' % (
-                str(error)))
-            if 'The read operation timed out' in str(error):
-                raise UserError(_(
-                    'Servicio AFIP Ocupado reintente en unos minutos'))
-            else:
-                raise UserError(_(
-                    'Hubo un error al conectarse a AFIP, contacte a su'
-                    ' proveedor de Odoo para mas información'))
+        # call the webservice method to get the last invoice at AFIP, it is
+        # only a query so we can retry it
+        retries, delay = self.env['afipws.connection']._get_ws_retry_params(afip_ws)
+        for attempt in range(retries + 1):
+            ws._afipws_retry = attempt
+            try:
+                if afip_ws in ("wsfe", "wsmtxca"):
+                    last = ws.CompUltimoAutorizado(document_type.code, self.l10n_ar_afip_pos_number)
+                else:
+                    last = ws.GetLastCMP(document_type.code, self.l10n_ar_afip_pos_number)
+                # pyafipws could catch the error
+                if last in (None, '') and ws.Excepcion and not ws.ErrMsg:
+                    raise ValueError(ws.Excepcion)
+                break
+            except (ValueError, OSError) as error:
+                _logger.warning('exception in get_pyafipws_last_invoice: %s' % (
+                    str(error)))
+                if attempt < retries:
+                    time.sleep(delay * 2 ** attempt)
+                    continue
+                if isinstance(error, socket.timeout) or 'timed out' in str(error):
+                    raise UserError(_(
+                        'Servicio AFIP Ocupado reintente en unos minutos'))
+                else:
+                    raise UserError(_(
+                        'Hubo un error al conectarse a AFIP, contacte a su'
+                        ' proveedor de Odoo para mas información'))
 
         msg = " - ".join([ws.Excepcion, ws.ErrMsg, ws.Obs])
 
@@ -96,6 +115,51 @@ class AccountJournal(models.Model):
         title = _('Last Invoice %s\n' % last)
         return {'msg': (title + msg), 'result': int(last)}
 
+    @api.model
+    def _get_pyafipws_number_error_codes(self):
+        """
+        AFIP error codes, by webservice, returned when the voucher number is
+        not the next one to authorize. The last authorized number is only
+        stored for this webservices as we can detect when it is outdated
+        """
+        return {
+            # El numero o fecha del comprobante no se corresponde con el
+            # proximo a autorizar
+            'wsfe': ['10016'],
+        }
+
+    def _get_pyafipws_last_number(self, document_type, resync=False):
+        """
+        Return the last number authorized on AFIP for document_type. When
+        possible it is taken from afipws.last_number (locked until the end of
+        the transaction) and AFIP is only queried on cold start or if resync
+        """
+        self.ensure_one()
+        if self.afip_ws not in self._get_pyafipws_number_error_codes():
+            return int(self.get_pyafipws_last_invoice(document_type)['result'])
+        number = None
+        if not resync:
+            number = self.env['afipws.last_number'].sudo()._lock_number(self, document_type)
+        if number is None:
+            number = int(self.get_pyafipws_last_invoice(document_type)['result'])
+            self._set_pyafipws_last_number(document_type, number, force=True)
+        return number
+
+    def _set_pyafipws_last_number(self, document_type, number, force=False):
+        self.ensure_one()
+        if self.afip_ws in self._get_pyafipws_number_error_codes():
+            self.env['afipws.last_number'].sudo()._set_number(
+                self, document_type, number, force=force)
+
+    def _is_pyafipws_number_error(self, ws):
+        """ Return True if the request was rejected because the voucher number is not the next one """
+        self.ensure_one()
+        if ws.CAE:
+            return False
+        msg = " ".join([ws.Obs or "", ws.ErrMsg or ""])
+        return any(
+            code in msg for code in self._get_pyafipws_number_error_codes().get(self.afip_ws, []))
+
     def test_pyafipws_dummy(self):
         """
         AFIP Description: Método Dummy para verificación de funcionamiento de
@@ -189,6 +253,18 @@ class AccountJournal(models.Model):
             '\n '.join(ret), ".\n".join([ws.Excepcion, ws.ErrMsg, ws.Obs])))
         raise UserError(msg)
 
+    def action_request_caea(self):
+        """ Request CAEA for current fortnight """
+        self.ensure_one()
+        caea = self.env['afipws.caea'].request_caea(
+            self.company_id, fields.Date.context_today(self))
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'afipws.caea',
+            'res_id': caea.id,
+            'view_mode': 'form',
+        }
+
     def action_get_connection(self):
         self.ensure_one()
         afip_ws = self.afip_ws
@@ -6,17 +6,27 @@ from odoo import fields, models, api, _
 from odoo.exceptions import UserError
 from odoo.tools import float_repr
 import base64
+import http.client
 import json
 import logging
-import sys
+import time
 import traceback
 from datetime import datetime
+from xml.etree import ElementTree
 _logger = logging.getLogger(__name__)
 
 try:
     from pysimplesoap.client import SoapFault
 except ImportError:
     _logger.debug('Can not `from pyafipws.soap import SoapFault`.')
+try:
+    from httplib2 import HttpLib2Error
+except ImportError:
+    HttpLib2Error = None
+
+# errors raised when the request doesn't reach AFIP or we don't get its answer
+# (socket errors and timeouts are OSError)
+TRANSPORT_ERRORS = (OSError, http.client.HTTPException) + (HttpLib2Error and (HttpLib2Error,) or ())
 
 
 class AccountMove(models.Model):
@@ -52,11 +62,11 @@ class AccountMove(models.Model):
     )
     afip_xml_request = fields.Text(
         string='AFIP XML Request',
-        copy=False,
+        compute='_compute_afip_xml',
     )
     afip_xml_response = fields.Text(
         string='AFIP XML Response',
-        copy=False,
+        compute='_compute_afip_xml',
     )
     afip_result = fields.Selection([
         ('', 'n/a'),
@@ -69,6 +79,25 @@ class AccountMove(models.Model):
         copy=False,
         help="AFIP request result"
     )
+    afip_caea_id = fields.Many2one(
+        'afipws.caea',
+        'CAEA',
+        copy=False,
+        readonly=True,
+        index=True,
+    )
+    afip_caea_reported = fields.Boolean(
+        'CAEA Reported',
+        copy=False,
+        readonly=True,
+        help='The invoice authorized with CAEA was already reported to AFIP',
+    )
+    afip_auth_pending = fields.Boolean(
+        'Pending AFIP authorization',
+        copy=False,
+        readonly=True,
+        help='The invoice is waiting on the queue for the CAE request',
+    )
     validation_type = fields.Char(
         'Validation Type',
         compute='_compute_validation_type',
@@ -82,20 +111,31 @@ class AccountMove(models.Model):
 
     @api.depends('journal_id', 'afip_auth_code')
     def _compute_validation_type(self):
+        to_validate = self.filtered(lambda x: x.journal_id.afip_ws and not x.afip_auth_code)
+        (self - to_validate).validation_type = False
+        if not to_validate:
+            return
+        environment_type = self.env['res.company']._get_environment_type()
+        # environment and certificates are resolved once by company
+        for company in to_validate.mapped('company_id'):
+            validation_type = environment_type
+            # if we are on homologation env and we dont have certificates
+            # we validate only locally
+            if validation_type == 'homologation':
+                try:
+                    company._get_certificate_fingerprint(validation_type)
+                except Exception:
+                    validation_type = False
+            to_validate.filtered(lambda x: x.company_id == company).validation_type = validation_type
+
+    def _compute_afip_xml(self):
+        """ XML of the last AFIP call, only loaded when the fields are read """
+        xml_log = self.env['afipws.xml_log'].sudo()
+        logs = xml_log._get_last_logs(self)
         for rec in self:
-            if rec.journal_id.afip_ws and not rec.afip_auth_code:
-                validation_type = self.env[
-                    'res.company']._get_environment_type()
-                # if we are on homologation env and we dont have certificates
-                # we validate only locally
-                if validation_type == 'homologation':
-                    try:
-                        rec.company_id.get_key_and_certificate(validation_type)
-                    except Exception:
-                        validation_type = False
-                rec.validation_type = validation_type
-            else:
-                rec.validation_type = False
+            log = logs.get(rec.id)
+            rec.afip_xml_request = log and xml_log._decompress(log.request_data)
+            rec.afip_xml_response = log and xml_log._decompress(log.response_data)
 
     @api.depends('afip_auth_code')
     def _compute_qr_code(self):
@@ -144,12 +184,30 @@ class AccountMove(models.Model):
         The last thing we do is request the cae because if an error occurs
         after cae requested, the invoice has been already validated on afip
         """
-        res = super().post()
-        self.do_pyafipws_request_cae()
+        # timings of each stage if profiling is enabled (see afipws.profile)
+        profile = self.env['afipws.profile']
+        with profile._session('post', self):
+            with profile._stage('odoo post'):
+                res = super().post()
+            if self._context.get('afip_cae_sync') or not self.env['ir.config_parameter'].sudo().get_param(
+                    'l10n_ar_afipws_fe.cae_async'):
+                with profile._stage('do_pyafipws_request_cae'):
+                    self.do_pyafipws_request_cae()
+            else:
+                # invoices that would be validated against AFIP are requested in
+                # background, the others (no ws or only local validation) now
+                to_enqueue = self.filtered(
+                    lambda x: not x.afip_auth_code and x.journal_id.afip_ws and x.validation_type and
+                    not x.journal_id.afip_caea)
+                with profile._stage('do_pyafipws_request_cae'):
+                    (self - to_enqueue).do_pyafipws_request_cae()
+                self.env['afipws.cae_queue'].sudo().enqueue(to_enqueue)
         return res
 
     def do_pyafipws_request_cae(self):
         "Request to AFIP the invoices' Authorization Electronic Code (CAE)"
+        batch = self.env['ir.config_parameter'].sudo().get_param('l10n_ar_afipws_fe.cae_batch')
+        batches = {}
         for inv in self:
             # Ignore invoices with cae (do not check date)
             if inv.afip_auth_code:
@@ -182,219 +240,421 @@ class AccountMove(models.Model):
                 inv.message_post(body=msg)
                 continue
 
-            # get the electronic invoice type, point of sale and afip_ws:
-            commercial_partner = inv.commercial_partner_id
-            country = commercial_partner.country_id
-            journal = inv.journal_id
-            pos_number = journal.l10n_ar_afip_pos_number
-            doc_afip_code = inv.l10n_latam_document_type_id.code
+            # with CAEA we authorize locally and report the invoice later
+            if inv.journal_id.afip_caea:
+                inv._pyafipws_assign_caea()
+                continue
 
-            # authenticate against AFIP:
-            ws = inv.company_id.get_connection(afip_ws).connect()
+            # wsfe can authorize many vouchers of the same point of sale and
+            # document type on a single FECAESolicitar call
+            if batch and afip_ws == 'wsfe':
+                key = (inv.company_id, inv.journal_id, inv.l10n_latam_document_type_id)
+                batches[key] = batches.get(key, self.browse()) | inv
+                continue
 
-            if afip_ws == 'wsfex':
-                if not country:
-                    raise UserError(_(
-                        'For WS "%s" country is required on partner' % (
-                            afip_ws)))
-                elif not country.code:
-                    raise UserError(_(
-                        'For WS "%s" country code is mandatory'
-                        'Country: %s' % (
-                            afip_ws, country.name)))
-                elif not country.l10n_ar_afip_code:
-                    raise UserError(_(
-                        'For WS "%s" country afip code is mandatory'
-                        'Country: %s' % (
-                            afip_ws, country.name)))
+            inv._do_pyafipws_request_cae()
+
+        for invoices in batches.values():
+            invoices._do_pyafipws_request_cae_batch()
+
+    def _pyafipws_assign_caea(self):
+        """
+        Authorize the invoice with the CAEA of its fortnight, without calling
+        AFIP. The invoice is reported later by the "AFIP WS: Report CAEA
+        invoices" scheduled action
+        """
+        self.ensure_one()
+        caea = self.env['afipws.caea'].sudo()._get_caea(self.company_id, self.invoice_date)
+        self.write({
+            'afip_auth_mode': 'CAEA',
+            'afip_auth_code': caea.name,
+            'afip_auth_code_due': caea.date_to,
+            'afip_caea_id': caea.id,
+            'afip_result': '',
+        })
+
+    def _pyafipws_report_caea_invoices(self):
+        """
+        Report to AFIP (FECAEARegInformativo) the invoices authorized with
+        CAEA. Invoices are reported in number order for each journal and
+        document type, committing every invoice, and a journal and document
+        type stops on the first error so it is retried on next run
+        """
+        lanes = {}
+        for inv in self.filtered(lambda x: x.afip_caea_id and not x.afip_caea_reported):
+            lanes.setdefault((inv.journal_id, inv.l10n_latam_document_type_id), self.browse())
+            lanes[(inv.journal_id, inv.l10n_latam_document_type_id)] |= inv
+
+        for invoices in lanes.values():
+            invoices = invoices.sorted(key=lambda x: self._l10n_ar_get_document_number_parts(
+                x.l10n_latam_document_number, x.l10n_latam_document_type_id.code)['invoice_number'])
+            ws = invoices[0].company_id.get_connection('wsfe').connect()
+            for inv in invoices:
+                try:
+                    inv._pyafipws_report_caea(ws)
+                    self.env.cr.commit()
+                except Exception as error:
+                    self.env.cr.rollback()
+                    _logger.warning('Could not report CAEA invoice %s: %s' % (inv.display_name, error))
+                    inv.afip_message = str(error)
+                    self.env.cr.commit()
+                    break
 
-            ws_next_invoice_number = int(
-                inv.journal_id.get_pyafipws_last_invoice(inv.l10n_latam_document_type_id)['result']) + 1
+    def _pyafipws_report_caea(self, ws):
+        self.ensure_one()
+        invoice_number = self._l10n_ar_get_document_number_parts(
+            self.l10n_latam_document_number, self.l10n_latam_document_type_id.code)['invoice_number']
+        self._pyafipws_create_invoice(ws, 'wsfe', invoice_number, caea=self.afip_auth_code)
+        ws.CAEARegInformativo()
+        msg = u"\n".join([ws.Obs or "", ws.ErrMsg or ""])
+        if ws.Resultado != 'A':
+            raise UserError(_('AFIP Validation Error. %s' % msg))
+        _logger.info('CAEA invoice %s reported. Resultado %s' % (self.display_name, ws.Resultado))
+        self.write({
+            'afip_caea_reported': True,
+            'afip_result': ws.Resultado,
+            'afip_message': msg,
+        })
+        self.env['afipws.xml_log'].sudo().log(self, ws.XmlRequest, ws.XmlResponse)
+
+    def _do_pyafipws_request_cae(self, ws=None):
+        """ Request the CAE for the invoice, using ws if already connected """
+        self.ensure_one()
+        journal = self.journal_id
+        document_type = self.l10n_latam_document_type_id
+        afip_ws = journal.afip_ws
+
+        profile = self.env['afipws.profile']
+        # authenticate against AFIP:
+        ws = ws or self.company_id.get_connection(afip_ws).connect()
+
+        # if the stored last number is outdated we sync it and try again
+        for resync in [False, True]:
+            with profile._stage('last number'):
+                last_number = journal._get_pyafipws_last_number(
+                    document_type, resync=resync)
+            # the last voucher on AFIP could be this invoice if we lost the
+            # answer (or the transaction) after it was authorized, we check it
+            # after a numbering error or when retrying (afip_cae_recover).
+            # The stored last number is only advanced once the CAE is written
+            # so, when retrying, the lost voucher would be the next one
+            if resync or self._context.get('afip_cae_recover'):
+                recover_number = last_number
+                if not resync and afip_ws in journal._get_pyafipws_number_error_codes():
+                    recover_number += 1
+                if recover_number and self._pyafipws_recover_cae(ws, afip_ws, recover_number):
+                    self._cr.commit()
+                    return
+            ws_next_invoice_number = last_number + 1
+            with profile._stage('CrearFactura'):
+                self._pyafipws_create_invoice(ws, afip_ws, ws_next_invoice_number)
+            with profile._stage('request authorization'):
+                vto = self._pyafipws_request_authorization(
+                    ws, afip_ws, invoice_number=ws_next_invoice_number)
+            if resync or not journal._is_pyafipws_number_error(ws):
+                break
+        with profile._stage('write CAE'):
+            self._pyafipws_write_cae(ws, vto)
+            journal._set_pyafipws_last_number(document_type, ws_next_invoice_number)
+        # si obtuvimos el cae hacemos el commit porque estoya no se puede
+        # volver atras
+        # otra alternativa seria escribir con otro cursor el cae y que
+        # la factura no quede validada total si tiene cae no se vuelve a
+        # solicitar. Lo mismo podriamos usar para grabar los mensajes de
+        # afip de respuesta
+        self._cr.commit()
+
+    def _do_pyafipws_request_cae_batch(self):
+        """
+        Request the CAE for invoices that share company, journal and document
+        type. A contiguous range of numbers is reserved after the last
+        authorized one and the invoices are sent in chunks of
+        "l10n_ar_afipws_fe.cae_batch_size" (250 by default, the usual
+        FECompTotXRequest value) on a single FECAESolicitar call each.
+        AFIP process the vouchers in order, the ones authorized before a
+        rejection are kept and, if the rejection is a numbering error, the
+        last number is synced and the rest are sent again.
+        """
+        journal = self.mapped('journal_id')
+        document_type = self.mapped('l10n_latam_document_type_id')
+        journal.ensure_one()
+        document_type.ensure_one()
+        afip_ws = journal.afip_ws
+
+        ws = self[0].company_id.get_connection(afip_ws).connect()
+        # old pyafipws versions does not implement the batch methods
+        if len(self) == 1 or not hasattr(ws, 'CAESolicitarX'):
+            for inv in self:
+                inv._do_pyafipws_request_cae(ws=ws)
+            return
+
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'l10n_ar_afipws_fe.cae_batch_size', 250))
+        for chunk_start in range(0, len(self), batch_size):
+            invoices = self[chunk_start:chunk_start + batch_size]
+            resync = False
+            while invoices:
+                next_number = journal._get_pyafipws_last_number(
+                    document_type, resync=resync) + 1
+
+                ws.IniciarFacturasX()
+                for invoice_number, inv in enumerate(invoices, next_number):
+                    inv._pyafipws_create_invoice(ws, afip_ws, invoice_number)
+                    ws.AgregarFacturaX()
+
+                msg = False
+                try:
+                    ws.CAESolicitarX()
+                except SoapFault as fault:
+                    msg = 'Falla SOAP %s: %s' % (
+                        fault.faultcode, fault.faultstring)
+                except Exception as e:
+                    msg = e
+                if msg:
+                    _logger.info(_('AFIP Validation Error. %s' % msg) + ' XML Request: %s XML Response: %s' % (
+                        ws.XmlRequest, ws.XmlResponse))
+                    raise UserError(_('AFIP Validation Error. %s' % msg))
+
+                # we keep the vouchers authorized before the first rejected
+                # one (if any)
+                rejected = None
+                for index, inv in enumerate(invoices):
+                    ws.LeerFacturaX(index)
+                    if not ws.CAE or ws.Resultado != 'A':
+                        rejected = index
+                        break
+                    inv._pyafipws_write_cae(ws, ws.Vencimiento)
+                    journal._set_pyafipws_last_number(document_type, next_number + index)
+                # same as on single request, once we have the CAE we can not
+                # go back
+                self._cr.commit()
+                if rejected is None:
+                    break
+                # if the stored last number is outdated we sync it and send
+                # again the ones not authorized
+                if resync or not journal._is_pyafipws_number_error(ws):
+                    raise UserError(_('AFIP Validation Error on invoice %s. %s') % (
+                        invoices[rejected].display_name, u"\n".join([ws.Obs or "", ws.ErrMsg or ""])))
+                invoices = invoices[rejected:]
+                resync = True
+
+    def _pyafipws_create_invoice(self, ws, afip_ws, invoice_number, caea=False):
+        """
+        Create the invoice internally in the pyafipws helper using
+        invoice_number as the voucher number. If caea is given (only wsfe) the
+        invoice is created to be reported as authorized with that CAEA
+        """
+        self.ensure_one()
+        # get the electronic invoice type, point of sale and afip_ws:
+        commercial_partner = self.commercial_partner_id
+        country = commercial_partner.country_id
+        journal = self.journal_id
+        pos_number = journal.l10n_ar_afip_pos_number
+        doc_afip_code = self.l10n_latam_document_type_id.code
+
+        if afip_ws == 'wsfex':
+            if not country:
+                raise UserError(_(
+                    'For WS "%s" country is required on partner' % (
+                        afip_ws)))
+            elif not country.code:
+                raise UserError(_(
+                    'For WS "%s" country code is mandatory'
+                    'Country: %s' % (
+                        afip_ws, country.name)))
+            elif not country.l10n_ar_afip_code:
+                raise UserError(_(
+                    'For WS "%s" country afip code is mandatory'
+                    'Country: %s' % (
+                        afip_ws, country.name)))
+
+        partner_id_code = commercial_partner.l10n_latam_identification_type_id.l10n_ar_afip_code
+        tipo_doc = partner_id_code or '99'
+        nro_doc = \
+            partner_id_code and commercial_partner.vat or "0"
+        cbt_desde = cbt_hasta = cbte_nro = invoice_number
+        concepto = tipo_expo = int(self.l10n_ar_afip_concept)
 
-            partner_id_code = commercial_partner.l10n_latam_identification_type_id.l10n_ar_afip_code
-            tipo_doc = partner_id_code or '99'
-            nro_doc = \
-                partner_id_code and commercial_partner.vat or "0"
-            cbt_desde = cbt_hasta = cbte_nro = ws_next_invoice_number
-            concepto = tipo_expo = int(inv.l10n_ar_afip_concept)
+        fecha_cbte = self.invoice_date
+        if afip_ws != 'wsmtxca':
+            fecha_cbte = self.invoice_date.strftime('%Y%m%d')
+
+        mipyme_fce = int(doc_afip_code) in [201, 206, 211]
+        # due date only for concept "services" and mipyme_fce
+        if int(concepto) != 1 and int(doc_afip_code) not in [202, 203, 207, 208, 212, 213] or mipyme_fce:
+            fecha_venc_pago = self.invoice_date_due or self.invoice_date
+            if afip_ws != 'wsmtxca':
+                fecha_venc_pago = fecha_venc_pago.strftime('%Y%m%d')
+        else:
+            fecha_venc_pago = None
 
-            fecha_cbte = inv.invoice_date
+        # fecha de servicio solo si no es 1
+        if int(concepto) != 1:
+            fecha_serv_desde = self.l10n_ar_afip_service_start
+            fecha_serv_hasta = self.l10n_ar_afip_service_end
             if afip_ws != 'wsmtxca':
-                fecha_cbte = inv.invoice_date.strftime('%Y%m%d')
-
-            mipyme_fce = int(doc_afip_code) in [201, 206, 211]
-            # due date only for concept "services" and mipyme_fce
-            if int(concepto) != 1 and int(doc_afip_code) not in [202, 203, 207, 208, 212, 213] or mipyme_fce:
-                fecha_venc_pago = inv.invoice_date_due or inv.invoice_date
-                if afip_ws != 'wsmtxca':
-                    fecha_venc_pago = fecha_venc_pago.strftime('%Y%m%d')
+                fecha_serv_desde = fecha_serv_desde.strftime('%Y%m%d')
+                fecha_serv_hasta = fecha_serv_hasta.strftime('%Y%m%d')
+        else:
+            fecha_serv_desde = fecha_serv_hasta = None
+
+        profile = self.env['afipws.profile']
+        with profile._stage('_l10n_ar_get_amounts'):
+            amounts = self._l10n_ar_get_amounts()
+        # invoice amount totals:
+        imp_total = str("%.2f" % self.amount_total)
+        # ImpTotConc es el iva no gravado
+        imp_tot_conc = str("%.2f" % amounts['vat_untaxed_base_amount'])
+        # tal vez haya una mejor forma, la idea es que para facturas c
+        # no se pasa iva. Probamos hacer que vat_taxable_amount
+        # incorpore a los imp cod 0, pero en ese caso termina reportando
+        # iva y no lo queremos
+        if self.l10n_latam_document_type_id.l10n_ar_letter == 'C':
+            imp_neto = str("%.2f" % self.amount_untaxed)
+        else:
+            imp_neto = str("%.2f" % amounts['vat_taxable_amount'])
+        imp_iva = str("%.2f" % amounts['vat_amount'])
+        # se usaba para wsca..
+        # imp_subtotal = str("%.2f" % self.amount_untaxed)
+        imp_trib = str("%.2f" % amounts['not_vat_taxes_amount'])
+        imp_op_ex = str("%.2f" % amounts['vat_exempt_base_amount'])
+        moneda_id = self.currency_id.l10n_ar_afip_code
+        moneda_ctz = self.l10n_ar_currency_rate
+
+        CbteAsoc = self.get_related_invoices_data()
+
+        # create the invoice internally in the helper
+        if afip_ws == 'wsfe':
+            ws.CrearFactura(
+                concepto, tipo_doc, nro_doc, doc_afip_code, pos_number,
+                cbt_desde, cbt_hasta, imp_total, imp_tot_conc, imp_neto,
+                imp_iva,
+                imp_trib, imp_op_ex, fecha_cbte, fecha_venc_pago,
+                fecha_serv_desde, fecha_serv_hasta,
+                moneda_id, moneda_ctz, **(caea and {'caea': caea} or {})
+            )
+        # elif afip_ws == 'wsmtxca':
+        #     obs_generales = self.comment
+        #     ws.CrearFactura(
+        #         concepto, tipo_doc, nro_doc, doc_afip_code, pos_number,
+        #         cbt_desde, cbt_hasta, imp_total, imp_tot_conc, imp_neto,
+        #         imp_subtotal,   # difference with wsfe
+        #         imp_trib, imp_op_ex, fecha_cbte, fecha_venc_pago,
+        #         fecha_serv_desde, fecha_serv_hasta,
+        #         moneda_id, moneda_ctz,
+        #         obs_generales   # difference with wsfe
+        #     )
+        elif afip_ws == 'wsfex':
+            # # foreign trade data: export permit, country code, etc.:
+            if self.invoice_incoterm_id:
+                incoterms = self.invoice_incoterm_id.code
+                incoterms_ds = self.invoice_incoterm_id.name
+                # máximo de 20 caracteres admite
+                incoterms_ds = incoterms_ds and incoterms_ds[:20]
             else:
-                fecha_venc_pago = None
-
-            # fecha de servicio solo si no es 1
-            if int(concepto) != 1:
-                fecha_serv_desde = inv.l10n_ar_afip_service_start
-                fecha_serv_hasta = inv.l10n_ar_afip_service_end
-                if afip_ws != 'wsmtxca':
-                    fecha_serv_desde = fecha_serv_desde.strftime('%Y%m%d')
-                    fecha_serv_hasta = fecha_serv_hasta.strftime('%Y%m%d')
+                incoterms = incoterms_ds = None
+            # por lo que verificamos, se pide permiso existente solo
+            # si es tipo expo 1 y es factura (codigo 19), para todo el
+            # resto pasamos cadena vacia
+            if int(doc_afip_code) == 19 and tipo_expo == 1:
+                # TODO investigar si hay que pasar si ("S")
+                permiso_existente = "N"
             else:
-                fecha_serv_desde = fecha_serv_hasta = None
-
-            amounts = inv._l10n_ar_get_amounts()
-            # invoice amount totals:
-            imp_total = str("%.2f" % inv.amount_total)
-            # ImpTotConc es el iva no gravado
-            imp_tot_conc = str("%.2f" % amounts['vat_untaxed_base_amount'])
-            # tal vez haya una mejor forma, la idea es que para facturas c
-            # no se pasa iva. Probamos hacer que vat_taxable_amount
-            # incorpore a los imp cod 0, pero en ese caso termina reportando
-            # iva y no lo queremos
-            if inv.l10n_latam_document_type_id.l10n_ar_letter == 'C':
-                imp_neto = str("%.2f" % inv.amount_untaxed)
+                permiso_existente = ""
+            obs_generales = self.narration
+
+            if self.invoice_payment_term_id:
+                forma_pago = self.invoice_payment_term_id.name
+                obs_comerciales = self.invoice_payment_term_id.name
             else:
-                imp_neto = str("%.2f" % amounts['vat_taxable_amount'])
-            imp_iva = str("%.2f" % amounts['vat_amount'])
-            # se usaba para wsca..
-            # imp_subtotal = str("%.2f" % inv.amount_untaxed)
-            imp_trib = str("%.2f" % amounts['not_vat_taxes_amount'])
-            imp_op_ex = str("%.2f" % amounts['vat_exempt_base_amount'])
-            moneda_id = inv.currency_id.l10n_ar_afip_code
-            moneda_ctz = inv.l10n_ar_currency_rate
-
-            CbteAsoc = inv.get_related_invoices_data()
-
-            # create the invoice internally in the helper
-            if afip_ws == 'wsfe':
-                ws.CrearFactura(
-                    concepto, tipo_doc, nro_doc, doc_afip_code, pos_number,
-                    cbt_desde, cbt_hasta, imp_total, imp_tot_conc, imp_neto,
-                    imp_iva,
-                    imp_trib, imp_op_ex, fecha_cbte, fecha_venc_pago,
-                    fecha_serv_desde, fecha_serv_hasta,
-                    moneda_id, moneda_ctz
-                )
-            # elif afip_ws == 'wsmtxca':
-            #     obs_generales = inv.comment
-            #     ws.CrearFactura(
-            #         concepto, tipo_doc, nro_doc, doc_afip_code, pos_number,
-            #         cbt_desde, cbt_hasta, imp_total, imp_tot_conc, imp_neto,
-            #         imp_subtotal,   # difference with wsfe
-            #         imp_trib, imp_op_ex, fecha_cbte, fecha_venc_pago,
-            #         fecha_serv_desde, fecha_serv_hasta,
-            #         moneda_id, moneda_ctz,
-            #         obs_generales   # difference with wsfe
-            #     )
-            elif afip_ws == 'wsfex':
-                # # foreign trade data: export permit, country code, etc.:
-                if inv.invoice_incoterm_id:
-                    incoterms = inv.invoice_incoterm_id.code
-                    incoterms_ds = inv.invoice_incoterm_id.name
-                    # máximo de 20 caracteres admite
-                    incoterms_ds = incoterms_ds and incoterms_ds[:20]
-                else:
-                    incoterms = incoterms_ds = None
-                # por lo que verificamos, se pide permiso existente solo
-                # si es tipo expo 1 y es factura (codigo 19), para todo el
-                # resto pasamos cadena vacia
-                if int(doc_afip_code) == 19 and tipo_expo == 1:
-                    # TODO investigar si hay que pasar si ("S")
-                    permiso_existente = "N"
-                else:
-                    permiso_existente = ""
-                obs_generales = inv.narration
+                forma_pago = obs_comerciales = None
 
-                if inv.invoice_payment_term_id:
-                    forma_pago = inv.invoice_payment_term_id.name
-                    obs_comerciales = inv.invoice_payment_term_id.name
+            # 1671 Report fecha_pago with format YYYMMDD
+            # 1672 Is required only doc_type 19. concept (2,4)
+            # 1673 If doc_type != 19 should not be reported.
+            # 1674 doc_type 19 concept (2,4). date should be >= invoice
+            # date
+            fecha_pago = datetime.strftime(self.invoice_date_due, '%Y%m%d') \
+                if int(doc_afip_code) == 19 and tipo_expo in [2, 4] and self.invoice_date_due else ''
+
+            idioma_cbte = 1     # invoice language: spanish / español
+
+            # TODO tal vez podemos unificar este criterio con el del
+            # citi que pide el cuit al partner
+            # customer data (foreign trade):
+            nombre_cliente = commercial_partner.name
+            # se debe informar cuit pais o id_impositivo
+            if nro_doc:
+                id_impositivo = nro_doc
+                cuit_pais_cliente = None
+            elif country.code != 'AR' and nro_doc:
+                id_impositivo = None
+                if commercial_partner.is_company:
+                    cuit_pais_cliente = country.cuit_juridica
                 else:
-                    forma_pago = obs_comerciales = None
-
-                # 1671 Report fecha_pago with format YYYMMDD
-                # 1672 Is required only doc_type 19. concept (2,4)
-                # 1673 If doc_type != 19 should not be reported.
-                # 1674 doc_type 19 concept (2,4). date should be >= invoice
-                # date
-                fecha_pago = datetime.strftime(inv.invoice_date_due, '%Y%m%d') \
-                    if int(doc_afip_code) == 19 and tipo_expo in [2, 4] and inv.invoice_date_due else ''
-
-                idioma_cbte = 1     # invoice language: spanish / español
-
-                # TODO tal vez podemos unificar este criterio con el del
-                # citi que pide el cuit al partner
-                # customer data (foreign trade):
-                nombre_cliente = commercial_partner.name
-                # se debe informar cuit pais o id_impositivo
-                if nro_doc:
-                    id_impositivo = nro_doc
-                    cuit_pais_cliente = None
-                elif country.code != 'AR' and nro_doc:
-                    id_impositivo = None
-                    if commercial_partner.is_company:
-                        cuit_pais_cliente = country.cuit_juridica
-                    else:
-                        cuit_pais_cliente = country.cuit_fisica
-                    if not cuit_pais_cliente:
-                        raise UserError(_(
-                            'No vat defined for the partner and also no CUIT '
-                            'set on country'))
-
-                domicilio_cliente = " - ".join([
-                    commercial_partner.name or '',
-                    commercial_partner.street or '',
-                    commercial_partner.street2 or '',
-                    commercial_partner.zip or '',
-                    commercial_partner.city or '',
-                ])
-                pais_dst_cmp = commercial_partner.country_id.l10n_ar_afip_code
-                ws.CrearFactura(
-                    doc_afip_code, pos_number, cbte_nro, fecha_cbte,
-                    imp_total, tipo_expo, permiso_existente, pais_dst_cmp,
-                    nombre_cliente, cuit_pais_cliente, domicilio_cliente,
-                    id_impositivo, moneda_id, moneda_ctz, obs_comerciales,
-                    obs_generales, forma_pago, incoterms,
-                    idioma_cbte, incoterms_ds, fecha_pago,
-                )
-            elif afip_ws == 'wsbfe':
-                zona = 1  # Nacional (la unica devuelta por afip)
-                # los responsables no inscriptos no se usan mas
-                impto_liq_rni = 0.0
-                imp_iibb = amounts['iibb_perc_amount']
-                imp_perc_mun = amounts['mun_perc_amount']
-                imp_internos = amounts[
-                    'intern_tax_amount'] + amounts['other_taxes_amount']
-                imp_perc = amounts[
-                    'vat_perc_amount'] + amounts['profits_perc_amount'] + amounts['other_perc_amount']
-
-                ws.CrearFactura(
-                    tipo_doc, nro_doc, zona, doc_afip_code, pos_number,
-                    cbte_nro, fecha_cbte, imp_total, imp_neto, imp_iva,
-                    imp_tot_conc, impto_liq_rni, imp_op_ex, imp_perc, imp_iibb,
-                    imp_perc_mun, imp_internos, moneda_id, moneda_ctz,
-                    fecha_venc_pago
-                )
+                    cuit_pais_cliente = country.cuit_fisica
+                if not cuit_pais_cliente:
+                    raise UserError(_(
+                        'No vat defined for the partner and also no CUIT '
+                        'set on country'))
 
-            if afip_ws in ['wsfe', 'wsbfe']:
-                if mipyme_fce:
-                    # agregamos cbu para factura de credito electronica
-                    ws.AgregarOpcional(
-                        opcional_id=2101,
-                        valor=inv.invoice_partner_bank_id.acc_number)
-                    # agregamos tipo de transmision si esta definido
-                    transmission_type = self.env['ir.config_parameter'].sudo().get_param(
-                        'l10n_ar_afipws_fe.fce_transmission', '')
-                    if transmission_type:
-                        ws.AgregarOpcional(
-                            opcional_id=27,
-                            valor=transmission_type)
-                elif int(doc_afip_code) in [202, 203, 207, 208, 212, 213]:
-                    valor = inv.afip_fce_es_anulacion and 'S' or 'N'
+            domicilio_cliente = " - ".join([
+                commercial_partner.name or '',
+                commercial_partner.street or '',
+                commercial_partner.street2 or '',
+                commercial_partner.zip or '',
+                commercial_partner.city or '',
+            ])
+            pais_dst_cmp = commercial_partner.country_id.l10n_ar_afip_code
+            ws.CrearFactura(
+                doc_afip_code, pos_number, cbte_nro, fecha_cbte,
+                imp_total, tipo_expo, permiso_existente, pais_dst_cmp,
+                nombre_cliente, cuit_pais_cliente, domicilio_cliente,
+                id_impositivo, moneda_id, moneda_ctz, obs_comerciales,
+                obs_generales, forma_pago, incoterms,
+                idioma_cbte, incoterms_ds, fecha_pago,
+            )
+        elif afip_ws == 'wsbfe':
+            zona = 1  # Nacional (la unica devuelta por afip)
+            # los responsables no inscriptos no se usan mas
+            impto_liq_rni = 0.0
+            imp_iibb = amounts['iibb_perc_amount']
+            imp_perc_mun = amounts['mun_perc_amount']
+            imp_internos = amounts[
+                'intern_tax_amount'] + amounts['other_taxes_amount']
+            imp_perc = amounts[
+                'vat_perc_amount'] + amounts['profits_perc_amount'] + amounts['other_perc_amount']
+
+            ws.CrearFactura(
+                tipo_doc, nro_doc, zona, doc_afip_code, pos_number,
+                cbte_nro, fecha_cbte, imp_total, imp_neto, imp_iva,
+                imp_tot_conc, impto_liq_rni, imp_op_ex, imp_perc, imp_iibb,
+                imp_perc_mun, imp_internos, moneda_id, moneda_ctz,
+                fecha_venc_pago
+            )
+
+        if afip_ws in ['wsfe', 'wsbfe']:
+            if mipyme_fce:
+                # agregamos cbu para factura de credito electronica
+                ws.AgregarOpcional(
+                    opcional_id=2101,
+                    valor=self.invoice_partner_bank_id.acc_number)
+                # agregamos tipo de transmision si esta definido
+                transmission_type = self.env['ir.config_parameter'].sudo().get_param(
+                    'l10n_ar_afipws_fe.fce_transmission', '')
+                if transmission_type:
                     ws.AgregarOpcional(
-                        opcional_id=22,
-                        valor=valor)
+                        opcional_id=27,
+                        valor=transmission_type)
+            elif int(doc_afip_code) in [202, 203, 207, 208, 212, 213]:
+                valor = self.afip_fce_es_anulacion and 'S' or 'N'
+                ws.AgregarOpcional(
+                    opcional_id=22,
+                    valor=valor)
 
-            # TODO ver si en realidad tenemos que usar un vat pero no lo
-            # subimos
+        # TODO ver si en realidad tenemos que usar un vat pero no lo
+        # subimos
+        with profile._stage('AgregarIva/AgregarTributo'):
             if afip_ws not in ['wsfex', 'wsbfe']:
                 vat_taxable = self.env['account.move.line']
                 for line in self.line_ids:
@@ -429,31 +689,32 @@ class AccountMove(models.Model):
                         "%.2f" % tax.price_subtotal,
                     )
 
-            if CbteAsoc:
-                # fex no acepta fecha
-                doc_number_parts = self._l10n_ar_get_document_number_parts(
-                    CbteAsoc.l10n_latam_document_number, CbteAsoc.l10n_latam_document_type_id.code)
-                if afip_ws == 'wsfex':
-                    ws.AgregarCmpAsoc(
-                        CbteAsoc.l10n_latam_document_type_id.document_type_id.code,
-                        doc_number_parts['point_of_sale'],
-                        doc_number_parts['invoice_number'],
-                        self.company_id.vat,
-                    )
-                else:
-                    ws.AgregarCmpAsoc(
-                        CbteAsoc.l10n_latam_document_type_id.code,
-                        doc_number_parts['point_of_sale'],
-                        doc_number_parts['invoice_number'],
-                        self.company_id.vat,
-                        afip_ws != 'wsmtxca' and CbteAsoc.invoice_date.strftime(
-                            '%Y%m%d') or CbteAsoc.invoice_date.strftime('%Y-%m-%d'),
-                    )
+        if CbteAsoc:
+            # fex no acepta fecha
+            doc_number_parts = self._l10n_ar_get_document_number_parts(
+                CbteAsoc.l10n_latam_document_number, CbteAsoc.l10n_latam_document_type_id.code)
+            if afip_ws == 'wsfex':
+                ws.AgregarCmpAsoc(
+                    CbteAsoc.l10n_latam_document_type_id.document_type_id.code,
+                    doc_number_parts['point_of_sale'],
+                    doc_number_parts['invoice_number'],
+                    self.company_id.vat,
+                )
+            else:
+                ws.AgregarCmpAsoc(
+                    CbteAsoc.l10n_latam_document_type_id.code,
+                    doc_number_parts['point_of_sale'],
+                    doc_number_parts['invoice_number'],
+                    self.company_id.vat,
+                    afip_ws != 'wsmtxca' and CbteAsoc.invoice_date.strftime(
+                        '%Y%m%d') or CbteAsoc.invoice_date.strftime('%Y-%m-%d'),
+                )
 
+        with profile._stage('AgregarItem'):
             # analize line items - invoice detail
             # wsfe do not require detail
             if afip_ws != 'wsfe':
-                for line in inv.invoice_line_ids.filtered(lambda x: not x.display_type):
+                for line in self.invoice_line_ids.filtered(lambda x: not x.display_type):
                     codigo = line.product_id.default_code
                     # unidad de referencia del producto si se comercializa
                     # en una unidad distinta a la de consumo
@@ -485,9 +746,9 @@ class AccountMove(models.Model):
                         #     line.uom_id.l10n_ar_afip_code)
                         iva_id = line.vat_tax_id.tax_group_id.l10n_ar_vat_afip_code
                         vat_taxes_amounts = line.vat_tax_id.compute_all(
-                            line.price_unit, inv.currency_id, line.quantity,
+                            line.price_unit, self.currency_id, line.quantity,
                             product=line.product_id,
-                            partner=inv.partner_id)
+                            partner=self.partner_id)
                         imp_iva = sum(
                             [x['amount'] for x in vat_taxes_amounts['taxes']])
                         if afip_ws == 'wsmtxca':
@@ -507,63 +768,274 @@ class AccountMove(models.Model):
                             codigo, ds, qty, umed, precio, "%.2f" % importe,
                             bonif)
 
-            # Request the authorization! (call the AFIP webservice method)
-            vto = None
-            msg = False
-            try:
-                if afip_ws == 'wsfe':
-                    ws.CAESolicitar()
-                    vto = ws.Vencimiento
-                elif afip_ws == 'wsmtxca':
-                    ws.AutorizarComprobante()
-                    vto = ws.Vencimiento
-                elif afip_ws == 'wsfex':
-                    ws.Authorize(inv.id)
-                    vto = ws.FchVencCAE
-                elif afip_ws == 'wsbfe':
-                    ws.Authorize(inv.id)
-                    vto = ws.Vencimiento
-            except SoapFault as fault:
-                msg = 'Falla SOAP %s: %s' % (
-                    fault.faultcode, fault.faultstring)
-            except Exception as e:
-                msg = e
-            except Exception:
-                if ws.Excepcion:
-                    # get the exception already parsed by the helper
-                    msg = ws.Excepcion
-                else:
-                    # avoid encoding problem when raising error
-                    msg = traceback.format_exception_only(
-                        sys.exc_type,
-                        sys.exc_value)[0]
-            if msg:
-                _logger.info(_('AFIP Validation Error. %s' % msg) + ' XML Request: %s XML Response: %s' % (
-                    ws.XmlRequest, ws.XmlResponse))
-                raise UserError(_('AFIP Validation Error. %s' % msg))
-
-            msg = u"\n".join([ws.Obs or "", ws.ErrMsg or ""])
-            if not ws.CAE or ws.Resultado != 'A':
-                raise UserError(_('AFIP Validation Error. %s' % msg))
-            # TODO ver que algunso campos no tienen sentido porque solo se
-            # escribe aca si no hay errores
-            if vto:
-                vto = datetime.strptime(vto, '%Y%m%d').date()
-            _logger.info('CAE solicitado con exito. CAE: %s. Resultado %s' % (
-                ws.CAE, ws.Resultado))
-            inv.write({
-                'afip_auth_mode': 'CAE',
-                'afip_auth_code': ws.CAE,
-                'afip_auth_code_due': vto,
-                'afip_result': ws.Resultado,
-                'afip_message': msg,
-                'afip_xml_request': ws.XmlRequest,
-                'afip_xml_response': ws.XmlResponse,
-            })
-            # si obtuvimos el cae hacemos el commit porque estoya no se puede
-            # volver atras
-            # otra alternativa seria escribir con otro cursor el cae y que
-            # la factura no quede validada total si tiene cae no se vuelve a
-            # solicitar. Lo mismo podriamos usar para grabar los mensajes de
-            # afip de respuesta
-            inv._cr.commit()
+    def _pyafipws_request_authorization(self, ws, afip_ws, invoice_number=False):
+        """
+        Call the AFIP webservice authorization method for the invoice already
+        created on the helper and return the CAE due date.
+        If we don't get an answer from AFIP and invoice_number is given, the
+        request is retried ("afip.ws.retries") but only after checking that
+        the voucher was not authorized, so that it is never authorized twice
+        """
+        self.ensure_one()
+        retries, delay = self.env['afipws.connection']._get_ws_retry_params(afip_ws)
+        for attempt in range(retries + 1):
+            ws._afipws_retry = attempt
+            vto, msg, unavailable = self._pyafipws_call_authorization(ws, afip_ws)
+            if unavailable and not msg:
+                msg = unavailable
+            if not unavailable or not invoice_number or attempt >= retries:
+                break
+            cae = self._pyafipws_query_invoice(ws, afip_ws, invoice_number)
+            if cae:
+                # AFIP authorized it but we didn't get the answer
+                if self._pyafipws_match_voucher(ws, afip_ws, invoice_number):
+                    return self._pyafipws_get_voucher_due_date(ws)
+                break
+            elif cae is None:
+                break
+            _logger.info('No answer from AFIP requesting CAE for invoice %s, retrying' % self.id)
+            time.sleep(delay * 2 ** attempt)
+            self._pyafipws_create_invoice(ws, afip_ws, invoice_number)
+        if msg:
+            _logger.info(_('AFIP Validation Error. %s' % msg) + ' XML Request: %s XML Response: %s' % (
+                ws.XmlRequest, ws.XmlResponse))
+            raise UserError(_('AFIP Validation Error. %s' % msg))
+        return vto
+
+    def _pyafipws_call_authorization(self, ws, afip_ws):
+        """
+        Call the authorization method and return the CAE due date, the error
+        message and, if the request didn't reach AFIP, the transport error
+        (see TRANSPORT_ERRORS and _pyafipws_get_transport_error). Other
+        exceptions are only error messages, the request is not retried
+        """
+        # Request the authorization! (call the AFIP webservice method)
+        vto = None
+        msg = False
+        unavailable = False
+        try:
+            if afip_ws == 'wsfe':
+                ws.CAESolicitar()
+                vto = ws.Vencimiento
+            elif afip_ws == 'wsmtxca':
+                ws.AutorizarComprobante()
+                vto = ws.Vencimiento
+            elif afip_ws == 'wsfex':
+                ws.Authorize(self.id)
+                vto = ws.FchVencCAE
+            elif afip_ws == 'wsbfe':
+                ws.Authorize(self.id)
+                vto = ws.Vencimiento
+        except SoapFault as fault:
+            msg = 'Falla SOAP %s: %s' % (
+                fault.faultcode, fault.faultstring)
+        except TRANSPORT_ERRORS as error:
+            msg = unavailable = error
+        except Exception as error:
+            if ws.Excepcion:
+                # get the exception already parsed by the helper
+                msg = ws.Excepcion
+            else:
+                # avoid encoding problem when raising error
+                msg = traceback.format_exception_only(type(error), error)[0]
+        else:
+            unavailable = self._pyafipws_get_transport_error(ws)
+        return vto, msg, unavailable
+
+    def _pyafipws_query_invoice(self, ws, afip_ws, invoice_number):
+        """
+        Query AFIP for the voucher invoice_number of the invoice point of sale
+        and document type. Return its CAE if it was authorized, False if it
+        doesn't exist or None if we could not get an answer
+        """
+        self.ensure_one()
+        document_type = int(self.l10n_latam_document_type_id.code)
+        pos_number = self.journal_id.l10n_ar_afip_pos_number
+        try:
+            if afip_ws == 'wsfe':
+                cae = ws.CompConsultar(document_type, pos_number, invoice_number)
+            elif afip_ws == 'wsmtxca':
+                cae = ws.ConsultarComprobante(document_type, pos_number, invoice_number)
+            elif afip_ws in ['wsfex', 'wsbfe']:
+                cae = ws.GetCMP(document_type, pos_number, invoice_number)
+            else:
+                return None
+        except Exception as error:
+            _logger.info('Could not query voucher %s on AFIP: %s' % (invoice_number, error))
+            return None
+        if not cae and ws.Excepcion:
+            return None
+        return cae or False
+
+    def _pyafipws_recover_cae(self, ws, afip_ws, invoice_number):
+        """
+        If voucher invoice_number was already authorized on AFIP for this
+        invoice (for eg. the worker crashed before saving the CAE) we adopt
+        its CAE instead of requesting a new number. Return True if adopted
+        """
+        self.ensure_one()
+        if not self._pyafipws_query_invoice(ws, afip_ws, invoice_number) or \
+                not self._pyafipws_match_voucher(ws, afip_ws, invoice_number):
+            return False
+        _logger.info('Invoice %s already authorized on AFIP with number %s, CAE %s recovered' % (
+            self.id, invoice_number, ws.CAE))
+        self._pyafipws_write_cae(
+            ws, self._pyafipws_get_voucher_due_date(ws), result='A',
+            msg=_('CAE recovered from voucher %s already authorized on AFIP') % invoice_number)
+        self.journal_id._set_pyafipws_last_number(self.l10n_latam_document_type_id, invoice_number)
+        return True
+
+    def _pyafipws_match_voucher(self, ws, afip_ws, invoice_number):
+        """
+        Return True if the voucher invoice_number just queried on ws
+        (CompConsultar/GetCMP) is this invoice: the voucher answered by AFIP
+        must have the same data we would send for this invoice (document
+        type, point of sale, date, customer document, currency and amounts,
+        see _pyafipws_get_voucher_fields) and no other invoice can have its
+        CAE
+        """
+        self.ensure_one()
+        cae = ws.CAE
+        voucher_fields = self._pyafipws_get_voucher_fields().get(afip_ws)
+        voucher = self._pyafipws_get_voucher_data(ws, afip_ws)
+        if not voucher_fields or not voucher:
+            return False
+        # the helper could still have other data, we create this invoice again
+        self._pyafipws_create_invoice(ws, afip_ws, invoice_number)
+        invoice = ws.factura
+        normalize = self._pyafipws_normalize_voucher_value
+        for key, tag in voucher_fields.items():
+            if invoice.get(key) in (None, ''):
+                continue
+            if tag not in voucher or normalize(invoice[key]) != normalize(voucher[tag]):
+                _logger.info('Voucher %s on AFIP is not invoice %s, %s is %s instead of %s' % (
+                    invoice_number, self.id, tag, voucher.get(tag), invoice[key]))
+                return False
+        # an identical invoice could already have this voucher
+        return not self.search_count([
+            ('journal_id', '=', self.journal_id.id),
+            ('l10n_latam_document_type_id', '=', self.l10n_latam_document_type_id.id),
+            ('afip_auth_code', '=', cae),
+            ('id', '!=', self.id),
+        ])
+
+    @api.model
+    def _pyafipws_get_voucher_fields(self):
+        """
+        Return, by webservice, the data of the invoice created on the helper
+        (ws.factura keys) and the tags of the voucher queried on AFIP that
+        must be equal to consider that the voucher is the invoice
+        """
+        return {
+            'wsfe': {
+                'tipo_cbte': 'CbteTipo',
+                'punto_vta': 'PtoVta',
+                'cbt_desde': 'CbteDesde',
+                'fecha_cbte': 'CbteFch',
+                'tipo_doc': 'DocTipo',
+                'nro_doc': 'DocNro',
+                'moneda_id': 'MonId',
+                'imp_total': 'ImpTotal',
+                'imp_tot_conc': 'ImpTotConc',
+                'imp_neto': 'ImpNeto',
+                'imp_iva': 'ImpIVA',
+                'imp_trib': 'ImpTrib',
+                'imp_op_ex': 'ImpOpEx',
+            },
+            'wsfex': {
+                'tipo_cbte': 'Cbte_tipo',
+                'punto_vta': 'Punto_vta',
+                'cbte_nro': 'Cbte_nro',
+                'fecha_cbte': 'Fecha_cbte',
+                'id_impositivo': 'Id_impositivo',
+                'cuit_pais_cliente': 'Cuit_pais_cliente',
+                'moneda_id': 'Moneda_Id',
+                'imp_total': 'Imp_total',
+            },
+            'wsbfe': {
+                'tipo_doc': 'Tipo_doc',
+                'nro_doc': 'Nro_doc',
+                'tipo_cbte': 'Tipo_cbte',
+                'punto_vta': 'Punto_vta',
+                'cbte_nro': 'Cbte_nro',
+                'imp_moneda_id': 'Imp_moneda_Id',
+                'imp_total': 'Imp_total',
+                'imp_neto': 'Imp_neto',
+                'impto_liq': 'Impto_liq',
+            },
+        }
+
+    @api.model
+    def _pyafipws_get_voucher_result_tags(self):
+        """ Return, by webservice, the tag of the voucher on the answer of CompConsultar/GetCMP """
+        return {
+            'wsfe': 'ResultGet',
+            'wsfex': 'FEXResultGet',
+            'wsbfe': 'BFEResultGet',
+        }
+
+    @api.model
+    def _pyafipws_get_voucher_data(self, ws, afip_ws):
+        """
+        Return the values of the voucher just queried on ws by tag, from the
+        answer of AFIP. Only the direct children of the voucher are read, so
+        that tags of nested elements (for eg. PtoVta of CbtesAsoc or Id of
+        AlicIva) are not taken as values of the voucher
+        """
+        result_tag = self._pyafipws_get_voucher_result_tags().get(afip_ws)
+        try:
+            root = ElementTree.fromstring(ws.XmlResponse)
+        except Exception as error:
+            _logger.info('Could not parse AFIP answer: %s' % error)
+            return {}
+        result = next((
+            element for element in root.iter() if element.tag.rsplit('}', 1)[-1] == result_tag), None)
+        if result is None:
+            return {}
+        return {
+            element.tag.rsplit('}', 1)[-1]: (element.text or '').strip()
+            for element in result if not len(element)}
+
+    @api.model
+    def _pyafipws_normalize_voucher_value(self, value):
+        value = str(value).strip()
+        try:
+            return round(float(value), 2)
+        except ValueError:
+            return value.upper()
+
+    @api.model
+    def _pyafipws_get_voucher_due_date(self, ws):
+        return ws.Vencimiento or getattr(ws, 'FchVencCAE', None)
+
+    def _pyafipws_get_transport_error(self, ws, error=False):
+        """
+        Return the transport error (raised or catched by pyafipws) if the
+        request didn't reach AFIP. SOAP faults and rejections are answers of
+        AFIP. The circuit breaker of the webservice is updated by the
+        instrumented client (see afipws.call_stat _instrument)
+        """
+        if not error and not ws.CAE and not ws.ErrMsg and not ws.Obs and ws.Excepcion:
+            error = ws.Excepcion
+        return error
+
+    def _pyafipws_write_cae(self, ws, vto, result=False, msg=False):
+        self.ensure_one()
+        msg = msg or u"\n".join([ws.Obs or "", ws.ErrMsg or ""])
+        result = result or ws.Resultado
+        if not ws.CAE or result != 'A':
+            raise UserError(_('AFIP Validation Error. %s' % msg))
+        # TODO ver que algunso campos no tienen sentido porque solo se
+        # escribe aca si no hay errores
+        if vto:
+            vto = datetime.strptime(vto, '%Y%m%d').date()
+        _logger.info('CAE solicitado con exito. CAE: %s. Resultado %s' % (
+            ws.CAE, result))
+        self.write({
+            'afip_auth_mode': 'CAE',
+            'afip_auth_code': ws.CAE,
+            'afip_auth_code_due': vto,
+            'afip_result': result,
+            'afip_message': msg,
+        })
+        self.env['afipws.xml_log'].sudo().log(self, ws.XmlRequest, ws.XmlResponse)
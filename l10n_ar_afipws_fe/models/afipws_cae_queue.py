@@ -0,0 +1,263 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models, api, registry, _
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from queue import Queue
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+# Held while lanes are processed in parallel, so that the connected objects
+# pool slots (see afipws.connection _get_ws_pool_owner) are not shared by two
+# runs on the same worker
+_parallel_lock = threading.Lock()
+
+
+class AfipwsCaeQueue(models.Model):
+    """
+    Invoices waiting for the CAE when "l10n_ar_afipws_fe.cae_async" is
+    enabled. Posting an invoice only adds it here and a scheduled action
+    requests the CAE in background, keeping the order of each point of sale
+    and document type and retrying with exponential backoff if AFIP fails.
+    An invoice that fails too many times blocks the next ones of its point of
+    sale and document type (they would get AFIP numbers that don't match
+    their names) until it is retried, reset to draft or cancelled.
+    """
+    _name = "afipws.cae_queue"
+    _description = "AFIP CAE request queue"
+    _rec_name = "move_id"
+    _order = "id"
+
+    move_id = fields.Many2one(
+        'account.move',
+        'Invoice',
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete='cascade',
+    )
+    journal_id = fields.Many2one(
+        'account.journal',
+        'Journal',
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    company_id = fields.Many2one(
+        'res.company',
+        'Company',
+        required=True,
+        readonly=True,
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ],
+        'State',
+        required=True,
+        readonly=True,
+        index=True,
+        default='pending',
+        help="* Pending: waiting for the CAE.\n* Done: the invoice got its CAE "
+        "or does not need it anymore (reset to draft or cancelled).\n* Failed: "
+        "the CAE could not be obtained after several attempts, the next "
+        "invoices of the same point of sale and document type wait until it is "
+        "retried or the invoice is reset to draft or cancelled",
+    )
+    attempts = fields.Integer(
+        readonly=True,
+    )
+    next_attempt = fields.Datetime(
+        readonly=True,
+    )
+    last_error = fields.Text(
+        readonly=True,
+    )
+
+    @api.model
+    def enqueue(self, invoices):
+        """ Add the invoices to the queue and mark them as pending of authorization """
+        # an invoice reset to draft and posted again keeps its place
+        items = self.search([('move_id', 'in', invoices.ids), ('state', '!=', 'done')])
+        items.write({'state': 'pending', 'attempts': 0, 'next_attempt': False})
+        for inv in invoices - items.mapped('move_id'):
+            self.create({
+                'move_id': inv.id,
+                'journal_id': inv.journal_id.id,
+                'company_id': inv.company_id.id,
+            })
+        invoices.write({'afip_auth_pending': True})
+        _logger.info('%s invoices enqueued for CAE request' % len(invoices))
+
+    def action_retry(self):
+        self.filtered(lambda x: x.state == 'failed').write({
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': False,
+        })
+
+    @api.model
+    def _cron_process_queue(self):
+        """
+        Request the CAE of the pending invoices. AFIP numbers must be
+        sequential by point of sale and document type, so invoices of each
+        lane (company, point of sale and document type) are processed in the
+        order they were enqueued and a lane stops on the first invoice that
+        fails or waits for a retry. A failed invoice blocks its lane until it
+        is retried or the invoice is reset to draft or cancelled.
+        With "l10n_ar_afipws_fe.cae_queue_workers" greater than one the lanes
+        are processed in parallel.
+        """
+        now = fields.Datetime.now()
+        items = self.search([('state', 'in', ['pending', 'failed'])])
+        # invoices that got the CAE by other means or were reset to draft or
+        # cancelled don't block their lane anymore
+        resolved = items.filtered(
+            lambda x: x.move_id.afip_auth_code or x.move_id.state != 'posted')
+        resolved._set_done()
+
+        lanes = OrderedDict()
+        for item in items - resolved:
+            lane_key = (
+                item.company_id.id,
+                item.journal_id.l10n_ar_afip_pos_number,
+                item.move_id.l10n_latam_document_type_id.id)
+            lanes.setdefault(lane_key, self.browse())
+            lanes[lane_key] |= item
+
+        # lanes of services that are down wait until they are available again
+        circuit = self.env['afipws.circuit'].sudo()
+        environment_type = self.env['res.company']._get_environment_type()
+        due_lanes = []
+        for lane in lanes.values():
+            if lane[0].state == 'failed':
+                _logger.warning(
+                    'CAE queue lane blocked by invoice %s: %s' % (
+                        lane[0].move_id.display_name, lane[0].last_error))
+                continue
+            afip_ws = lane[0].journal_id.afip_ws
+            if not circuit.is_available(afip_ws, environment_type):
+                _logger.info('AFIP service %s not available, CAE queue lane paused' % afip_ws)
+                continue
+            due = self.browse()
+            for item in lane:
+                if item.state == 'failed' or (item.next_attempt and item.next_attempt > now):
+                    break
+                due |= item
+            if due:
+                due_lanes.append(due)
+
+        workers = int(self.env['ir.config_parameter'].sudo().get_param(
+            'l10n_ar_afipws_fe.cae_queue_workers', 1))
+        if workers > 1 and len(due_lanes) > 1:
+            self._process_lanes_parallel(due_lanes, workers)
+        else:
+            for due in due_lanes:
+                due._process()
+
+    @api.model
+    def _process_lanes_parallel(self, lanes, workers):
+        """
+        Process each lane on a thread pool, each lane with its own cursor, so
+        that a run takes about the time of the slowest lane instead of the
+        sum of all of them.
+        Each thread takes one of "workers" pool slots while processing a lane
+        so that the connected pyafipws objects are reused by the next lanes
+        and runs instead of connecting again on every new thread
+        """
+        dbname = self._cr.dbname
+        uid = self.env.uid
+        context = self.env.context
+        # release our snapshot and locks before starting the threads
+        self.env.cr.commit()
+
+        # if another run is using the slots on this worker we just use
+        # the threads as owners of the connected objects
+        use_slots = _parallel_lock.acquire(blocking=False)
+        slots = Queue()
+        for slot in range(workers):
+            slots.put(slot)
+
+        def process_lane(item_ids):
+            slot = slots.get() if use_slots else None
+            lane_context = dict(context, afipws_pool_slot=slot) if use_slots else context
+            try:
+                with api.Environment.manage(), registry(dbname).cursor() as cr:
+                    env = api.Environment(cr, uid, lane_context)
+                    env['afipws.cae_queue'].browse(item_ids)._process()
+            finally:
+                if use_slots:
+                    slots.put(slot)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(process_lane, lane.ids) for lane in lanes]
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as error:
+                        _logger.warning('Error processing CAE queue lane: %s' % error)
+        finally:
+            if use_slots:
+                _parallel_lock.release()
+
+    def _process(self):
+        """
+        Request the CAE for the invoices of this queue items (all of the same
+        lane). do_pyafipws_request_cae commits each invoice once it gets
+        its CAE, so on errors we keep those and register the failure on the
+        first invoice without CAE
+        """
+        error = False
+        # on retries the CAE could have been authorized without us getting it
+        recover = any(self.mapped('attempts'))
+        try:
+            self.mapped('move_id').with_context(afip_cae_recover=recover).do_pyafipws_request_cae()
+        except Exception as exc:
+            self.env.cr.rollback()
+            self.invalidate_cache()
+            self.mapped('move_id').invalidate_cache()
+            error = str(exc)
+            _logger.warning('Error requesting CAE from queue: %s' % error)
+
+        for item in self:
+            if item.move_id.afip_auth_code or item.move_id.state != 'posted':
+                item._set_done()
+            else:
+                item._register_failure(error or 'Not authorized')
+                break
+        self.env.cr.commit()
+
+    def _set_done(self):
+        self.write({'state': 'done', 'last_error': False})
+        self.mapped('move_id').write({'afip_auth_pending': False})
+
+    def _register_failure(self, error):
+        self.ensure_one()
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_attempts = int(get_param('l10n_ar_afipws_fe.cae_queue_max_attempts', 10))
+        delay = int(get_param('l10n_ar_afipws_fe.cae_queue_retry_delay', 60))
+        max_delay = int(get_param('l10n_ar_afipws_fe.cae_queue_max_retry_delay', 3600))
+        attempts = self.attempts + 1
+        failed = attempts >= max_attempts
+        self.write({
+            'attempts': attempts,
+            'last_error': error,
+            'state': 'failed' if failed else 'pending',
+            'next_attempt': fields.Datetime.now() + timedelta(
+                seconds=min(delay * 2 ** (attempts - 1), max_delay)),
+        })
+        if failed:
+            _logger.warning('CAE request of invoice %s failed %s times, lane blocked: %s' % (
+                self.move_id.display_name, attempts, error))
+            self.move_id.message_post(body=_(
+                'The CAE could not be obtained after %s attempts. The next invoices of the '
+                'same point of sale and document type will not be requested until this one '
+                'is retried from the CAE queue, reset to draft or cancelled.\nLast error: '
+                '%s') % (attempts, error))
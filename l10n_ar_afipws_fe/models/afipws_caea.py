@@ -0,0 +1,219 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models, api, _
+from odoo.exceptions import UserError
+from datetime import datetime, timedelta
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class AfipwsCaea(models.Model):
+    """
+    CAEA (Código de Autorización Electrónico Anticipado) requested for a
+    company and fortnight. Invoices of journals that use CAEA are authorized
+    locally with the CAEA of its period and are reported to AFIP later
+    (FECAEARegInformativo) by a scheduled action.
+    """
+    _name = "afipws.caea"
+    _description = "AFIP CAEA"
+    _order = "date_from desc"
+
+    name = fields.Char(
+        'CAEA',
+        required=True,
+        readonly=True,
+    )
+    company_id = fields.Many2one(
+        'res.company',
+        'Company',
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    type = fields.Selection(
+        [('production', 'Production'), ('homologation', 'Homologation')],
+        'Type',
+        required=True,
+        readonly=True,
+    )
+    period = fields.Char(
+        required=True,
+        readonly=True,
+        help='Period in YYYYMM format',
+    )
+    order = fields.Selection(
+        [('1', 'First fortnight'), ('2', 'Second fortnight')],
+        required=True,
+        readonly=True,
+    )
+    date_from = fields.Date(
+        'Valid From',
+        readonly=True,
+    )
+    date_to = fields.Date(
+        'Valid To',
+        readonly=True,
+    )
+    date_report_limit = fields.Date(
+        'Report Limit Date',
+        readonly=True,
+    )
+    state = fields.Selection(
+        [('active', 'Active'), ('reported', 'Reported')],
+        required=True,
+        readonly=True,
+        default='active',
+        help="* Active: invoices can be authorized with this CAEA and are "
+        "being reported.\n* Reported: the period is over and all the "
+        "invoices (or the lack of movement) were reported to AFIP",
+    )
+    move_ids = fields.One2many(
+        'account.move',
+        'afip_caea_id',
+        'Invoices',
+        readonly=True,
+    )
+
+    _sql_constraints = [
+        ('period_uniq', 'unique(company_id, type, period, "order")',
+         'There is already a CAEA for this company and period'),
+    ]
+
+    @api.model
+    def _get_period_and_order(self, date):
+        """ Return period (YYYYMM) and order (fortnight) for date """
+        return date.strftime('%Y%m'), '1' if date.day <= 15 else '2'
+
+    @api.model
+    def _get_caea(self, company, date):
+        """
+        Return the CAEA stored for company and date. Used when posting
+        invoices so it should never call AFIP
+        """
+        period, order = self._get_period_and_order(date)
+        caea = self.search([
+            ('company_id', '=', company.id),
+            ('type', '=', company._get_environment_type()),
+            ('period', '=', period),
+            ('order', '=', order),
+        ], limit=1)
+        if not caea:
+            raise UserError(_(
+                'There is no CAEA for company %s and period %s (fortnight %s). '
+                'It should be requested in advance from the journal') % (
+                    company.name, period, order))
+        return caea
+
+    @api.model
+    def request_caea(self, company, date):
+        """
+        Get from AFIP the CAEA of company for the fortnight of date, if it was
+        already requested we query it
+        """
+        environment_type = company._get_environment_type()
+        period, order = self._get_period_and_order(date)
+        caea = self.search([
+            ('company_id', '=', company.id),
+            ('type', '=', environment_type),
+            ('period', '=', period),
+            ('order', '=', order),
+        ], limit=1)
+        if caea:
+            return caea
+
+        ws = company.get_connection('wsfe').connect()
+        code = ws.CAEASolicitar(period, order)
+        if not code:
+            code = ws.CAEAConsultar(period, order)
+        if not code:
+            raise UserError(_(
+                'Could not get CAEA for period %s (fortnight %s). This is what '
+                'we received: %s') % (period, order, " - ".join(
+                    [ws.Excepcion, ws.ErrMsg, ws.Obs])))
+
+        def parse_date(value):
+            return value and datetime.strptime(value, '%Y%m%d').date() or False
+
+        _logger.info('CAEA %s obtained for company %s, period %s and fortnight %s' % (
+            code, company.name, period, order))
+        return self.create({
+            'name': code,
+            'company_id': company.id,
+            'type': environment_type,
+            'period': period,
+            'order': order,
+            'date_from': parse_date(ws.FchVigDesde),
+            'date_to': parse_date(ws.FchVigHasta),
+            'date_report_limit': parse_date(ws.FchTopeInf),
+        })
+
+    @api.model
+    def _cron_request_caea(self):
+        """
+        Request the CAEA of the current and next fortnight for every company
+        with journals that use CAEA. AFIP only allows to request the next one
+        on the five days before it starts so errors are just logged
+        """
+        companies = self.env['account.journal'].search([('afip_caea', '=', True)]).mapped('company_id')
+        today = fields.Date.context_today(self)
+        next_fortnight = today.replace(day=16) if today.day <= 15 else (
+            today.replace(day=28) + timedelta(days=4)).replace(day=1)
+        for company in companies:
+            for date in [today, next_fortnight]:
+                try:
+                    self.request_caea(company, date)
+                    self.env.cr.commit()
+                except Exception as error:
+                    self.env.cr.rollback()
+                    _logger.info('Could not get CAEA for company %s and date %s: %s' % (
+                        company.name, date, error))
+
+    def action_report(self):
+        self.mapped('move_ids')._pyafipws_report_caea_invoices()
+        self._report_without_movement()
+
+    @api.model
+    def _cron_report_caea(self):
+        """
+        Report to AFIP the invoices authorized with CAEA and, once the
+        fortnight is over, the journals without invoices
+        """
+        invoices = self.env['account.move'].search([
+            ('afip_caea_id', '!=', False),
+            ('afip_caea_reported', '=', False),
+            ('state', '=', 'posted'),
+        ])
+        invoices._pyafipws_report_caea_invoices()
+        self.search([
+            ('state', '=', 'active'),
+            ('date_to', '<', fields.Date.context_today(self)),
+        ])._report_without_movement()
+
+    def _report_without_movement(self):
+        """
+        For finished CAEA with all its invoices reported, inform to AFIP the
+        CAEA journals without invoices and set the CAEA as reported
+        """
+        today = fields.Date.context_today(self)
+        for caea in self.filtered(lambda x: x.state == 'active' and x.date_to and x.date_to < today):
+            if caea.move_ids.filtered(lambda x: x.state == 'posted' and not x.afip_caea_reported):
+                continue
+            journals = self.env['account.journal'].search([
+                ('company_id', '=', caea.company_id.id),
+                ('afip_caea', '=', True),
+            ]) - caea.move_ids.mapped('journal_id')
+            try:
+                if journals:
+                    ws = caea.company_id.get_connection('wsfe').connect()
+                    for journal in journals:
+                        ws.CAEASinMovimientoInformar(journal.l10n_ar_afip_pos_number, caea.name)
+                        if ws.Excepcion or ws.ErrMsg:
+                            raise UserError(" - ".join([ws.Excepcion, ws.ErrMsg, ws.Obs]))
+                caea.state = 'reported'
+                self.env.cr.commit()
+            except Exception as error:
+                self.env.cr.rollback()
+                _logger.warning('Could not report CAEA %s without movement: %s' % (caea.name, error))
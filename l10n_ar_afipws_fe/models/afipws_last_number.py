@@ -0,0 +1,84 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models, api
+
+
+class AfipwsLastNumber(models.Model):
+    """
+    Last number authorized on AFIP for each journal and document type so that
+    we don't need to query it before each CAE request. Is advanced after each
+    authorization and synced with AFIP on cold start, on numbering errors and
+    when syncing the journal numbers. Deleting a record forces a sync.
+    """
+    _name = "afipws.last_number"
+    _description = "AFIP last authorized number"
+    _rec_name = "journal_id"
+    _order = "journal_id, document_type_id"
+
+    journal_id = fields.Many2one(
+        'account.journal',
+        'Journal',
+        required=True,
+        readonly=True,
+        ondelete='cascade',
+    )
+    document_type_id = fields.Many2one(
+        'l10n_latam.document.type',
+        'Document Type',
+        required=True,
+        readonly=True,
+        ondelete='cascade',
+    )
+    company_id = fields.Many2one(
+        related='journal_id.company_id',
+    )
+    number = fields.Integer(
+        'Last Number',
+        readonly=True,
+    )
+
+    _sql_constraints = [
+        ('journal_document_type_uniq', 'unique(journal_id, document_type_id)',
+         'There is already a last number for this journal and document type'),
+    ]
+
+    @api.model
+    def _lock_number(self, journal, document_type):
+        """
+        Return the stored last number (or None if we don't have it), locking
+        it until the end of the transaction so that concurrent requests for
+        the same journal and document type are serialized
+        """
+        self._cr.execute("""
+            SELECT number FROM afipws_last_number
+            WHERE journal_id = %s AND document_type_id = %s
+            FOR UPDATE""", (journal.id, document_type.id))
+        row = self._cr.fetchone()
+        return row[0] if row else None
+
+    @api.model
+    def _set_number(self, journal, document_type, number, force=False):
+        """
+        Store number as the last authorized one. If not force, the stored
+        number is only advanced (never moved back)
+        """
+        query = """
+            INSERT INTO afipws_last_number (
+                journal_id, document_type_id, number,
+                create_uid, create_date, write_uid, write_date)
+            VALUES (%(journal)s, %(document_type)s, %(number)s,
+                %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC')
+            ON CONFLICT (journal_id, document_type_id) DO UPDATE
+            SET number = EXCLUDED.number, write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date"""
+        if not force:
+            query += " WHERE afipws_last_number.number < EXCLUDED.number"
+        self._cr.execute(query, {
+            'journal': journal.id,
+            'document_type': document_type.id,
+            'number': number,
+            'uid': self.env.uid,
+        })
+        self.invalidate_cache(['number'])
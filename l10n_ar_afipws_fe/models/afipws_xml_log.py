@@ -0,0 +1,83 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields, models, api
+from datetime import timedelta
+import base64
+import logging
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+
+class AfipwsXmlLog(models.Model):
+    """
+    XML request and response of the AFIP calls of each invoice, stored
+    compressed out of account_move so that invoice reads don't load them.
+    Records are only created and are deleted after
+    "l10n_ar_afipws_fe.xml_log_days" days (0 to keep them).
+    """
+    _name = "afipws.xml_log"
+    _description = "AFIP XML log"
+    _rec_name = "move_id"
+    _order = "id desc"
+
+    move_id = fields.Many2one(
+        'account.move',
+        'Invoice',
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete='cascade',
+    )
+    request_data = fields.Binary(
+        'Compressed Request',
+        attachment=False,
+        readonly=True,
+    )
+    response_data = fields.Binary(
+        'Compressed Response',
+        attachment=False,
+        readonly=True,
+    )
+
+    @api.model
+    def _compress(self, xml):
+        if not xml:
+            return False
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+        return base64.b64encode(zlib.compress(xml))
+
+    @api.model
+    def _decompress(self, data):
+        if not data:
+            return False
+        return zlib.decompress(base64.b64decode(data)).decode('utf-8')
+
+    @api.model
+    def log(self, invoice, xml_request, xml_response):
+        return self.create({
+            'move_id': invoice.id,
+            'request_data': self._compress(xml_request),
+            'response_data': self._compress(xml_response),
+        })
+
+    @api.model
+    def _get_last_logs(self, invoices):
+        """ Return a dict with the last log of each invoice """
+        logs = {}
+        for log in self.search([('move_id', 'in', invoices.ids)]):
+            logs.setdefault(log.move_id.id, log)
+        return logs
+
+    @api.model
+    def _cron_purge(self):
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'l10n_ar_afipws_fe.xml_log_days', 365))
+        if days <= 0:
+            return
+        limit = fields.Datetime.now() - timedelta(days=days)
+        self._cr.execute('DELETE FROM afipws_xml_log WHERE create_date < %s', (limit,))
+        _logger.info('%s AFIP XML logs older than %s days deleted' % (self._cr.rowcount, days))
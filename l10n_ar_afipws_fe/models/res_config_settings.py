@@ -16,3 +16,28 @@ class ResConfigSettings(models.TransientModel):
         help="Este campo sera necesario cuando informes comprobantes del tipo FCE MiPyME",
         config_parameter='l10n_ar_afipws_fe.fce_transmission'
     )
+    l10n_ar_afip_cae_batch = fields.Boolean(
+        'Request CAE in batches',
+        help="Si está marcado, al validar varias facturas del mismo diario y tipo de documento (WSFEv1) se "
+        "solicitan todos los CAE en una única llamada a AFIP",
+        config_parameter='l10n_ar_afipws_fe.cae_batch'
+    )
+    l10n_ar_afip_cae_batch_size = fields.Integer(
+        'CAE batch size',
+        help="Cantidad máxima de comprobantes por solicitud a AFIP (FECompTotXRequest)",
+        config_parameter='l10n_ar_afipws_fe.cae_batch_size',
+        default=250,
+    )
+    l10n_ar_afip_cae_async = fields.Boolean(
+        'Request CAE in background',
+        help="Si está marcado, al validar las facturas se encolan y el CAE se solicita en segundo plano. "
+        "Mientras tanto la factura queda pendiente de autorización",
+        config_parameter='l10n_ar_afipws_fe.cae_async'
+    )
+    l10n_ar_afip_cae_queue_workers = fields.Integer(
+        'CAE queue workers',
+        help="Cantidad de puntos de venta / tipos de documento que se procesan en paralelo al solicitar "
+        "los CAE encolados",
+        config_parameter='l10n_ar_afipws_fe.cae_queue_workers',
+        default=1,
+    )
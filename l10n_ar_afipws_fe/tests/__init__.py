@@ -0,0 +1,9 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from . import test_cae_queue
+from . import test_last_number
+from . import test_standin
+from . import test_voucher_data
+from . import test_call_authorization
@@ -0,0 +1,133 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo.tests.common import TransactionCase, tagged
+from unittest.mock import patch
+
+
+@tagged('post_install', '-at_install')
+class TestCaeQueue(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        # the queue commits after each lane
+        for method in ['commit', 'rollback']:
+            patcher = patch.object(self.cr, method)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.queue = self.env['afipws.cae_queue']
+        self.set_param = self.env['ir.config_parameter'].sudo().set_param
+        self.set_param('l10n_ar_afipws_fe.cae_queue_workers', 1)
+        self.set_param('l10n_ar_afipws_fe.cae_queue_max_attempts', 2)
+
+        user_type = self.env.ref('account.data_account_type_current_assets')
+        self.accounts = self.env['account.account'].create([{
+            'name': 'CAE Queue %s' % code,
+            'code': 'CAEQ%s' % code,
+            'user_type_id': user_type.id,
+        } for code in ['A', 'B']])
+        self.journals = self.env['account.journal'].create([{
+            'name': 'CAE Queue %s' % pos_number,
+            'code': 'CQ%s' % pos_number,
+            'type': 'general',
+            'l10n_ar_afip_pos_number': pos_number,
+        } for pos_number in [1, 2]])
+
+        # moves authorized by the fake request, in call order, and moves AFIP rejects
+        self.requested = []
+        self.rejected = self.env['account.move']
+        patcher = patch.object(
+            type(self.env['account.move']), 'do_pyafipws_request_cae', self._fake_request_cae)
+        self.moves = [self._create_move(self.journals[0]) for _i in range(3)]
+        self.other_move = self._create_move(self.journals[1])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_move(self, journal):
+        move = self.env['account.move'].create({
+            'journal_id': journal.id,
+            'line_ids': [
+                (0, 0, {'account_id': self.accounts[0].id, 'debit': 100.0}),
+                (0, 0, {'account_id': self.accounts[1].id, 'credit': 100.0}),
+            ],
+        })
+        move.post()
+        return move
+
+    def _fake_request_cae(self, moves):
+        """ Authorize the moves in order, stopping on the first rejected one like AFIP does """
+        for move in moves:
+            if move in self.rejected:
+                return
+            self.requested.append(move)
+            move.afip_auth_code = '7' * 14
+
+    def _get_item(self, move):
+        return self.queue.search([('move_id', '=', move.id)])
+
+    def test_lane_order(self):
+        self.queue.enqueue(self.moves[0] | self.moves[1] | self.moves[2] | self.other_move)
+        self.queue._cron_process_queue()
+        self.assertEqual(self.requested, self.moves + [self.other_move])
+        for move in self.moves + [self.other_move]:
+            self.assertEqual(self._get_item(move).state, 'done')
+            self.assertFalse(move.afip_auth_pending)
+
+    def test_failure_retry_later(self):
+        self.rejected = self.moves[1]
+        self.queue.enqueue(self.moves[0] | self.moves[1] | self.moves[2])
+        self.queue._cron_process_queue()
+        self.assertEqual(self.requested, [self.moves[0]])
+        item = self._get_item(self.moves[1])
+        self.assertEqual((item.state, item.attempts), ('pending', 1))
+        self.assertTrue(item.next_attempt)
+        self.assertEqual(self._get_item(self.moves[2]).attempts, 0)
+
+        # the lane waits for the retry delay
+        self.queue._cron_process_queue()
+        self.assertEqual(self.requested, [self.moves[0]])
+
+    def test_failed_blocks_lane(self):
+        self.rejected = self.moves[0]
+        self.queue.enqueue(self.moves[0] | self.moves[1] | self.moves[2] | self.other_move)
+        item = self._get_item(self.moves[0])
+        for _attempt in range(2):
+            item.next_attempt = False
+            self.queue._cron_process_queue()
+        self.assertEqual(item.state, 'failed')
+        self.assertEqual(self.requested, [self.other_move])
+
+        # next invoices of the lane are not requested while it is failed,
+        # even once their retry time passed
+        self.rejected = self.env['account.move']
+        self.queue._cron_process_queue()
+        self.assertEqual(self.requested, [self.other_move])
+        self.assertEqual(self._get_item(self.moves[1]).state, 'pending')
+
+        # retrying the failed one unblocks the lane in order
+        item.action_retry()
+        self.queue._cron_process_queue()
+        self.assertEqual(self.requested, [self.other_move] + self.moves)
+
+    def test_failed_resolved_by_cancel(self):
+        self.rejected = self.moves[0]
+        self.queue.enqueue(self.moves[0] | self.moves[1])
+        item = self._get_item(self.moves[0])
+        item.write({'state': 'failed', 'attempts': 2})
+        self.queue._cron_process_queue()
+        self.assertFalse(self.requested)
+
+        self.moves[0].button_draft()
+        self.moves[0].button_cancel()
+        self.queue._cron_process_queue()
+        self.assertEqual(item.state, 'done')
+        self.assertEqual(self.requested, [self.moves[1]])
+
+    def test_enqueue_again_keeps_place(self):
+        self.queue.enqueue(self.moves[0])
+        item = self._get_item(self.moves[0])
+        item.write({'state': 'failed', 'attempts': 2})
+        self.queue.enqueue(self.moves[0])
+        self.assertEqual(self._get_item(self.moves[0]), item)
+        self.assertEqual((item.state, item.attempts), ('pending', 0))
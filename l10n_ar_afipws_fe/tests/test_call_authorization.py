@@ -0,0 +1,32 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo.tests.common import TransactionCase, tagged
+
+
+class FakeWs(object):
+
+    def __init__(self, error):
+        self.error = error
+        self.CAE = self.ErrMsg = self.Obs = self.Excepcion = ''
+        self.Vencimiento = None
+
+    def CAESolicitar(self):
+        raise self.error
+
+
+@tagged('post_install', '-at_install')
+class TestCallAuthorization(TransactionCase):
+
+    def test_transport_errors(self):
+        move = self.env['account.move']
+        error = TimeoutError('timed out')
+        _vto, msg, unavailable = move._pyafipws_call_authorization(FakeWs(error), 'wsfe')
+        self.assertIs(unavailable, error)
+        self.assertIs(msg, error)
+
+        # other errors are not retried
+        _vto, msg, unavailable = move._pyafipws_call_authorization(FakeWs(ValueError('bad amount')), 'wsfe')
+        self.assertFalse(unavailable)
+        self.assertIn('bad amount', msg)
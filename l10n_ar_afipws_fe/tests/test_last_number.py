@@ -0,0 +1,62 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo.tests.common import TransactionCase, tagged
+from unittest.mock import patch
+
+
+@tagged('post_install', '-at_install')
+class TestLastNumber(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.last_number = self.env['afipws.last_number']
+        self.journal = self.env['account.journal'].create({
+            'name': 'Last Number',
+            'code': 'LN',
+            'type': 'general',
+            'l10n_ar_afip_pos_number': 9,
+            'l10n_ar_afip_pos_system': 'RAW_MAW',
+        })
+        self.document_type = self.env.ref('l10n_ar.dc_a_f')
+        self.afip_number = 41
+        patcher = patch.object(
+            type(self.journal), 'get_pyafipws_last_invoice', self._fake_last_invoice)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queries = 0
+
+    def _fake_last_invoice(self, journal, document_type):
+        self.queries += 1
+        return {'result': self.afip_number}
+
+    def _get_number(self):
+        return self.last_number.search([
+            ('journal_id', '=', self.journal.id),
+            ('document_type_id', '=', self.document_type.id)]).number
+
+    def test_set_number_only_advances(self):
+        self.assertIsNone(self.last_number._lock_number(self.journal, self.document_type))
+        self.last_number._set_number(self.journal, self.document_type, 10)
+        self.assertEqual(self.last_number._lock_number(self.journal, self.document_type), 10)
+        self.last_number._set_number(self.journal, self.document_type, 12)
+        self.assertEqual(self._get_number(), 12)
+        # a late answer of a previous request doesn't move it back
+        self.last_number._set_number(self.journal, self.document_type, 11)
+        self.assertEqual(self._get_number(), 12)
+        self.last_number._set_number(self.journal, self.document_type, 5, force=True)
+        self.assertEqual(self._get_number(), 5)
+
+    def test_last_number_sync(self):
+        # cold start, queried once to AFIP and then taken from the table
+        self.assertEqual(self.journal._get_pyafipws_last_number(self.document_type), 41)
+        self.journal._set_pyafipws_last_number(self.document_type, 42)
+        self.assertEqual(self.journal._get_pyafipws_last_number(self.document_type), 42)
+        self.assertEqual(self.queries, 1)
+
+        # on resync AFIP is the reference, even if it is behind
+        self.afip_number = 40
+        self.assertEqual(self.journal._get_pyafipws_last_number(self.document_type, resync=True), 40)
+        self.assertEqual(self._get_number(), 40)
+        self.assertEqual(self.queries, 2)
@@ -0,0 +1,284 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+"""
+Connections, CAE and CAEA flows against the local AFIP stand-in of benchmarks/afip_standin.py.
+They only run if the AFIP_STANDIN_WSDL_DIR environment variable points to the
+WSDL documents downloaded with "afip_standin.py --fetch-wsdl" and pyOpenSSL
+and pyafipws are installed
+"""
+from odoo import fields, tools
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase, tagged
+from datetime import timedelta
+from http.server import ThreadingHTTPServer
+from unittest import SkipTest
+from unittest.mock import patch
+import importlib.util
+import logging
+import os
+import tempfile
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+STANDIN_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'benchmarks', 'afip_standin.py')
+
+
+def load_standin():
+    spec = importlib.util.spec_from_file_location('afip_standin', STANDIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@tagged('post_install', '-at_install')
+class TestStandIn(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        wsdl_dir = os.environ.get('AFIP_STANDIN_WSDL_DIR')
+        if not wsdl_dir or not os.path.isdir(wsdl_dir) or not os.path.exists(STANDIN_PATH):
+            raise SkipTest('AFIP_STANDIN_WSDL_DIR is not set')
+        try:
+            from OpenSSL import crypto
+        except ImportError:
+            crypto = None
+        if not crypto or not importlib.util.find_spec('pyafipws'):
+            raise SkipTest('pyafipws and pyOpenSSL are needed')
+        super().setUpClass()
+        afip_standin = load_standin()
+        cls.standin = afip_standin.AfipStandIn()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), afip_standin.make_handler(cls.standin, wsdl_dir))
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+        cls.url = 'http://127.0.0.1:%s' % cls.server.server_address[1]
+
+        # self signed certificate for WSAA, the stand-in doesn't validate it
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        cert = crypto.X509()
+        cert.get_subject().CN = 'afip-standin'
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(24 * 60 * 60)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(key, 'sha256')
+        cls.key_path = os.path.join(cls.tmp_dir.name, 'standin.key')
+        cls.cert_path = os.path.join(cls.tmp_dir.name, 'standin.crt')
+        with open(cls.key_path, 'wb') as key_file:
+            key_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        with open(cls.cert_path, 'wb') as cert_file:
+            cert_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.tmp_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        company = self.env.ref('l10n_ar.company_ri', raise_if_not_found=False)
+        self.partner = self.env.ref('l10n_ar.res_partner_adhoc', raise_if_not_found=False)
+        if not company or not self.partner or not company.chart_template_id:
+            self.skipTest('Argentinian demo data is needed')
+        self.env.user.company_ids |= company
+        self.env = self.env(context=dict(self.env.context, allowed_company_ids=[company.id]))
+        self.company = company
+
+        # circuit, statistics and connections use new cursors
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        for method in ['commit', 'rollback']:
+            patcher = patch.object(self.cr, method)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.dict(tools.config.options, {
+            'afip_homo_pkey_file': self.key_path,
+            'afip_homo_cert_file': self.cert_path,
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        connection_cls = type(self.env['afipws.connection'])
+        paths = {'wsfe': '/wsfev1/service.asmx?WSDL', 'wsfex': '/wsfexv1/service.asmx?WSDL'}
+        for method, url in [
+                ('get_afip_login_url', lambda conn, environment_type: self.url + '/ws/services/LoginCms'),
+                ('get_afip_ws_url', lambda conn, afip_ws, environment_type: (
+                    afip_ws in paths and self.url + paths[afip_ws] or False))]:
+            patcher = patch.object(connection_cls, method, url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('afip.ws.env.type', 'homologation')
+        set_param('afip.ws.cache.dir', os.path.join(self.tmp_dir.name, 'cache'))
+        set_param('l10n_ar_afipws_fe.cae_async', '')
+        set_param('l10n_ar_afipws_fe.cae_batch', '')
+        self.env['res.company'].clear_caches()
+
+        with self.standin.lock:
+            for values in [self.standin.calls, self.standin.last_numbers, self.standin.vouchers,
+                           self.standin.caeas]:
+                values.clear()
+            del self.standin.reported[:]
+
+        self.journal, self.caea_journal, self.other_caea_journal = self.env['account.journal'].create([{
+            'name': 'Stand-in POS %s' % pos_number,
+            'code': 'SI%s' % pos_number,
+            'type': 'sale',
+            'company_id': company.id,
+            'l10n_latam_use_documents': True,
+            'l10n_ar_afip_pos_system': 'RAW_MAW',
+            'l10n_ar_afip_pos_number': 9100 + pos_number,
+            'l10n_ar_afip_pos_partner_id': company.partner_id.id,
+            'afip_caea': caea,
+        } for pos_number, caea in [(1, False), (2, True), (3, True)]])
+        self.tax = self.env['account.tax'].search([
+            ('company_id', '=', company.id), ('type_tax_use', '=', 'sale'),
+            ('tax_group_id', '=', self.env.ref('l10n_ar.tax_group_iva_21').id)], limit=1)
+        self.today = fields.Date.context_today(self.env.user)
+
+    def _create_invoice(self, journal, price_unit=100.0):
+        return self.env['account.move'].create({
+            'type': 'out_invoice',
+            'partner_id': self.partner.id,
+            'journal_id': journal.id,
+            'invoice_date': self.today,
+            'invoice_line_ids': [(0, 0, {
+                'name': 'Stand-in',
+                'account_id': journal.default_credit_account_id.id,
+                'quantity': 1.0,
+                'price_unit': price_unit,
+                'tax_ids': [(6, 0, self.tax.ids)],
+            })],
+        })
+
+    def _get_last_number(self, journal, invoice):
+        return self.standin.last_numbers.get(
+            (journal.l10n_ar_afip_pos_number, int(invoice.l10n_latam_document_type_id.code)))
+
+    def _get_invoice_number(self, invoice):
+        return self.env['account.move']._l10n_ar_get_document_number_parts(
+            invoice.l10n_latam_document_number, invoice.l10n_latam_document_type_id.code)['invoice_number']
+
+    def test_connect_cache(self):
+        # a new cache dir so that the first connection downloads the WSDL
+        self.env['ir.config_parameter'].sudo().set_param(
+            'afip.ws.cache.dir', os.path.join(self.tmp_dir.name, 'cold_cache'))
+        connection = self.company.get_connection('wsfe')
+        timings = []
+        for _attempt in range(2):
+            # like a new worker, without connected objects
+            connection._clear_ws_pool()
+            self.standin.calls.clear()
+            start = time.time()
+            ws = connection.connect()
+            timings.append(time.time() - start)
+            self.assertTrue(ws)
+            if not _attempt:
+                self.assertGreaterEqual(self.standin.calls['wsdl'], 1)
+        cold, warm = timings
+        _logger.info('wsfe connect: cold %.3fs, warm %.3fs' % (cold, warm))
+        # the parsed service description is taken from the cache
+        self.assertEqual(self.standin.calls['wsdl'], 0)
+        self.assertTrue(any(name.endswith('.pkl') for name in os.listdir(connection._get_ws_cache_dir())))
+        self.assertLess(warm, cold)
+
+    def test_cae(self):
+        invoice = self._create_invoice(self.journal)
+        invoice.post()
+        self.assertEqual(invoice.afip_auth_mode, 'CAE')
+        self.assertEqual(invoice.afip_result, 'A')
+        self.assertEqual(self._get_last_number(self.journal, invoice), 1)
+        self.assertEqual(self._get_invoice_number(invoice), 1)
+        voucher = self.standin.vouchers[(self.journal.l10n_ar_afip_pos_number, int(
+            invoice.l10n_latam_document_type_id.code), 1)]
+        self.assertEqual(invoice.afip_auth_code, voucher['CodAutorizacion'])
+        self.assertEqual(self.standin.calls['FECAESolicitar'], 1)
+
+        # the last number is kept, AFIP is not queried again
+        invoice = self._create_invoice(self.journal)
+        invoice.post()
+        self.assertEqual(self._get_invoice_number(invoice), 2)
+        self.assertEqual(self.standin.calls['FECompUltimoAutorizado'], 1)
+
+    def test_cae_resync(self):
+        invoice = self._create_invoice(self.journal)
+        invoice.post()
+        # other system authorized some vouchers of the point of sale
+        key = (self.journal.l10n_ar_afip_pos_number, int(invoice.l10n_latam_document_type_id.code))
+        self.standin.last_numbers[key] = 5
+        invoice = self._create_invoice(self.journal)
+        invoice.post()
+        self.assertEqual(invoice.afip_result, 'A')
+        self.assertEqual(self._get_invoice_number(invoice), 6)
+        self.assertEqual(self.standin.calls['FECAESolicitar'], 3)
+
+    def test_cae_recover(self):
+        self._create_invoice(self.journal).post()
+        invoice = self._create_invoice(self.journal, price_unit=250.0)
+        # the voucher is authorized but the answer is lost
+        with patch.object(type(invoice), '_pyafipws_write_cae', side_effect=UserError('Lost answer')):
+            with self.assertRaises(UserError):
+                invoice.post()
+        self.env.cache.invalidate()
+        self.assertFalse(invoice.afip_auth_code)
+        self.assertEqual(self._get_last_number(self.journal, invoice), 2)
+
+        invoice.with_context(afip_cae_recover=True).post()
+        voucher = self.standin.vouchers[(self.journal.l10n_ar_afip_pos_number, int(
+            invoice.l10n_latam_document_type_id.code), 2)]
+        self.assertEqual(invoice.afip_auth_code, voucher['CodAutorizacion'])
+        self.assertEqual(self._get_invoice_number(invoice), 2)
+        self.assertEqual(self.standin.calls['FECAESolicitar'], 2)
+
+        # a voucher of other invoice is not recovered
+        key = (self.journal.l10n_ar_afip_pos_number, int(invoice.l10n_latam_document_type_id.code))
+        self.standin.vouchers[key + (3,)] = dict(voucher, CbteDesde='3', CbteHasta='3', ImpTotal='1.00')
+        self.standin.last_numbers[key] = 3
+        invoice = self._create_invoice(self.journal, price_unit=250.0)
+        invoice.with_context(afip_cae_recover=True).post()
+        self.assertEqual(self._get_invoice_number(invoice), 4)
+        self.assertNotEqual(invoice.afip_auth_code, voucher['CodAutorizacion'])
+
+    def test_caea(self):
+        caea_model = self.env['afipws.caea']
+        caea = caea_model.request_caea(self.company, self.today)
+        self.assertIn(caea.name, self.standin.caeas.values())
+        self.assertLessEqual(caea.date_from, self.today)
+        self.assertGreaterEqual(caea.date_to, self.today)
+        # AFIP gives the CAEA only once, then it is queried
+        code = caea.name
+        caea.unlink()
+        caea = caea_model.request_caea(self.company, self.today)
+        self.assertEqual(caea.name, code)
+        self.assertEqual(self.standin.calls['FECAEAConsultar'], 1)
+
+        # invoices are authorized without calling AFIP
+        self.standin.calls.clear()
+        invoices = self._create_invoice(self.caea_journal) | self._create_invoice(self.caea_journal)
+        invoices.post()
+        self.assertFalse(self.standin.calls)
+        for invoice in invoices:
+            self.assertEqual(invoice.afip_auth_mode, 'CAEA')
+            self.assertEqual(invoice.afip_auth_code, code)
+            self.assertFalse(invoice.afip_caea_reported)
+
+        caea_model._cron_report_caea()
+        self.assertTrue(all(invoices.mapped('afip_caea_reported')))
+        document_type = int(invoices[0].l10n_latam_document_type_id.code)
+        pos_number = self.caea_journal.l10n_ar_afip_pos_number
+        self.assertEqual(self.standin.reported, [
+            (pos_number, document_type, self._get_invoice_number(invoice), code) for invoice in invoices.sorted(
+                key=self._get_invoice_number)])
+
+        # once the fortnight is over the journals without invoices are reported
+        caea.date_to = self.today - timedelta(days=1)
+        caea_model._cron_report_caea()
+        self.assertEqual(caea.state, 'reported')
+        self.assertIn((self.other_caea_journal.l10n_ar_afip_pos_number, None, None, code), self.standin.reported)
@@ -0,0 +1,31 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo.tests.common import TransactionCase, tagged
+
+
+class FakeWs(object):
+
+    def __init__(self, xml_response):
+        self.XmlResponse = xml_response
+
+
+@tagged('post_install', '-at_install')
+class TestVoucherData(TransactionCase):
+
+    def test_wsfe_voucher_data(self):
+        ws = FakeWs("""<?xml version="1.0" encoding="utf-8"?>
+            <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+            <soap:Body><FECompConsultarResponse xmlns="http://ar.gov.afip.dif.FEV1/">
+            <FECompConsultarResult><ResultGet>
+                <CbtesAsoc><CbteAsoc><Tipo>1</Tipo><PtoVta>2</PtoVta><Nro>7</Nro></CbteAsoc></CbtesAsoc>
+                <Iva><AlicIva><Id>5</Id><BaseImp>100</BaseImp><Importe>21</Importe></AlicIva></Iva>
+                <CbteTipo>3</CbteTipo>
+                <PtoVta>9101</PtoVta>
+                <ImpTotal>121</ImpTotal>
+            </ResultGet></FECompConsultarResult>
+            </FECompConsultarResponse></soap:Body></soap:Envelope>""")
+        voucher = self.env['account.move']._pyafipws_get_voucher_data(ws, 'wsfe')
+        self.assertEqual(voucher, {'CbteTipo': '3', 'PtoVta': '9101', 'ImpTotal': '121'})
+        self.assertEqual(self.env['account.move']._pyafipws_get_voucher_data(ws, 'wsfex'), {})
@@ -1,6 +1,6 @@
 {
     "name": "Argentinian Reports (CE)",
-    'version': '13.0.1.0.0',
+    'version': '13.0.1.3.0',
     'category': 'Localization/Argentina',
     'sequence': 14,
     'author': 'ADHOC SA,Moldeo Interactive,Odoo Community Association (OCA)',
@@ -15,6 +15,7 @@
     "data": [
         'report/account_ar_vat_line_view.xml',
         'report/account_vat_ledger_report.xml',
+        'data/ir_cron_data.xml',
         'views/account_vat_report_views.xml',
         'security/ir.model.access.csv',
         'security/security.xml',
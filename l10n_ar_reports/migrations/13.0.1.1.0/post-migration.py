@@ -0,0 +1,36 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import api, SUPERUSER_ID
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """ Move the txt files stored as text on account_vat_ledger to attachments and drop the columns """
+    columns = {
+        'REGINFO_CV_CBTE': ('vouchers_file', 'vouchers_filename', 'Vouchers_%s_%s.txt'),
+        'REGINFO_CV_ALICUOTAS': ('aliquots_file', 'aliquots_filename', 'Alicuots_%s_%s.txt'),
+        'REGINFO_CV_COMPRAS_IMPORTACIONES': (
+            'import_aliquots_file', 'import_aliquots_filename', 'Import_Alicuots_%s_%s.txt'),
+    }
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'account_vat_ledger' AND column_name IN %s""", (tuple(columns),))
+    existing = [x[0] for x in cr.fetchall()]
+    if not existing:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    for column in existing:
+        field_name, filename_field, filename = columns[column]
+        # pylint: disable=sql-injection
+        cr.execute("""SELECT id, "%s" FROM account_vat_ledger WHERE "%s" != ''""" % (column, column))
+        for ledger_id, text in cr.fetchall():
+            ledger = env['account.vat.ledger'].browse(ledger_id)
+            name = filename % (ledger.type, ledger.date_to)
+            if ledger._write_txt_file(field_name, name, text.split('\r\n')):
+                ledger[filename_field] = name
+        _logger.info('TXT files of %s moved to attachments' % column)
+        cr.execute('ALTER TABLE account_vat_ledger DROP COLUMN "%s"' % column)
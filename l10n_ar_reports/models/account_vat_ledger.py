@@ -5,7 +5,33 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError
 import base64
+import itertools
 import re
+import tempfile
+
+
+class TxtFile(object):
+    """
+    Temporary file where the rows of a txt file are written as they are
+    produced, encoded as AFIP expects and separated by CRLF
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.rows = 0
+
+    def write(self, row):
+        # segun vimos aca la afip espera "ISO-8859-1" en vez de utf-8
+        # http://www.planillasutiles.com.ar/2015/08/
+        # como-descargar-los-archivos-de.html
+        data = (self.rows and b'\r\n' or b'') + row.encode('ISO-8859-1')
+        self.file.write(data)
+        self.size += len(data)
+        self.rows += 1
+
+    def close(self):
+        self.file.close()
 
 
 class AccountVatLedger(models.Model):
@@ -89,41 +115,45 @@ class AccountVatLedger(models.Model):
         string="Invoices",
         compute="_compute_invoices"
     )
-    # txt for citi / libro iva fields
+    # txt for citi / libro iva fields, only the first lines of each file are
+    # shown (see _compute_txt_preview)
     REGINFO_CV_ALICUOTAS = fields.Text(
         'REGINFO_CV_ALICUOTAS',
-        readonly=True,
+        compute='_compute_txt_preview',
     )
     REGINFO_CV_COMPRAS_IMPORTACIONES = fields.Text(
         'REGINFO_CV_COMPRAS_IMPORTACIONES',
-        readonly=True,
+        compute='_compute_txt_preview',
     )
     REGINFO_CV_CBTE = fields.Text(
         'REGINFO_CV_CBTE',
-        readonly=True,
+        compute='_compute_txt_preview',
     )
     REGINFO_CV_CABECERA = fields.Text(
         'REGINFO_CV_CABECERA',
         readonly=True,
     )
+    # the files are written to attachments by compute_txt_data
     vouchers_file = fields.Binary(
-        compute='_compute_files',
+        attachment=True,
         readonly=True
     )
     vouchers_filename = fields.Char(
-        compute='_compute_files',
+        readonly=True,
     )
     aliquots_file = fields.Binary(
-        compute='_compute_files',
+        attachment=True,
+        readonly=True,
     )
     aliquots_filename = fields.Char(
-        compute='_compute_files',
+        readonly=True,
     )
     import_aliquots_file = fields.Binary(
-        compute='_compute_files',
+        attachment=True,
+        readonly=True,
     )
     import_aliquots_filename = fields.Char(
-        compute='_compute_files',
+        readonly=True,
     )
     prorate_tax_credit = fields.Boolean(
     )
@@ -143,14 +173,18 @@ class AccountVatLedger(models.Model):
     @api.depends('journal_ids', 'date_from', 'date_to')
     def _compute_invoices(self):
         for rec in self:
-            rec.invoice_ids = rec.env['account.ar.vat.line'].search([
-                ('state', '!=', 'draft'),
-                # ('number', '!=', False),
-                # ('internal_number', '!=', False),
-                ('journal_id', 'in', rec.journal_ids.ids),
-                ('date', '>=', rec.date_from),
-                ('date', '<=', rec.date_to),
-            ])
+            rec.invoice_ids = rec.env['account.ar.vat.line'].search(rec._get_invoices_domain())
+
+    def _get_invoices_domain(self):
+        self.ensure_one()
+        return [
+            ('state', '!=', 'draft'),
+            # ('number', '!=', False),
+            # ('internal_number', '!=', False),
+            ('journal_id', 'in', self.journal_ids.ids),
+            ('date', '>=', self.date_from),
+            ('date', '<=', self.date_to),
+        ]
 
     @api.depends(
         'type',
@@ -212,69 +246,94 @@ class AccountVatLedger(models.Model):
             template = "{:0>%dd}" % (padding)
         return template.format(int(round(abs(amount) * 10**decimals, decimals)))
 
-    @api.depends(
-        'REGINFO_CV_CBTE',
-        'REGINFO_CV_ALICUOTAS',
-        'type',
-        # 'period_id.name'
-    )
-    def _compute_files(self):
+    def _compute_txt_preview(self, lines=100):
+        for rec in self:
+            rec.REGINFO_CV_CBTE = rec._read_txt_file('vouchers_file', lines)
+            rec.REGINFO_CV_ALICUOTAS = rec._read_txt_file('aliquots_file', lines)
+            rec.REGINFO_CV_COMPRAS_IMPORTACIONES = rec._read_txt_file('import_aliquots_file', lines)
+
+    def _get_txt_attachment(self, field_name):
         self.ensure_one()
-        # segun vimos aca la afip espera "ISO-8859-1" en vez de utf-8
-        # http://www.planillasutiles.com.ar/2015/08/
-        # como-descargar-los-archivos-de.html
-        if self.REGINFO_CV_ALICUOTAS:
-            self.aliquots_filename = _('Alicuots_%s_%s.txt') % (
-                self.type,
-                self.date_to,
-                # self.period_id.name
-            )
-            self.aliquots_file = base64.encodestring(
-                self.REGINFO_CV_ALICUOTAS.encode('ISO-8859-1'))
+        return self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name),
+            ('res_id', '=', self.id),
+            ('res_field', '=', field_name),
+        ], limit=1)
+
+    def _read_txt_file(self, field_name, lines):
+        """ Return the first lines of the file of field_name """
+        attachment = self._get_txt_attachment(field_name)
+        if not attachment:
+            return False
+        if attachment.store_fname:
+            with open(attachment._full_path(attachment.store_fname), 'rb') as txt_file:
+                data = b''.join(itertools.islice(txt_file, lines))
         else:
-            self.aliquots_file = False
-            self.aliquots_filename = False
-        if self.REGINFO_CV_COMPRAS_IMPORTACIONES:
-            self.import_aliquots_filename = _('Import_Alicuots_%s_%s.txt') % (
-                self.type,
-                self.date_to,
-                # self.period_id.name
-            )
-            self.import_aliquots_file = base64.encodestring(
-                self.REGINFO_CV_COMPRAS_IMPORTACIONES.encode('ISO-8859-1'))
-        else:
-            self.import_aliquots_file = False
-            self.import_aliquots_filename = False
-        if self.REGINFO_CV_CBTE:
-            self.vouchers_filename = _('Vouchers_%s_%s.txt') % (
-                self.type,
-                self.date_to,
-                # self.period_id.name
-            )
-            self.vouchers_file = base64.encodestring(
-                self.REGINFO_CV_CBTE.encode('ISO-8859-1'))
-        else:
-            self.vouchers_file = False
-            self.vouchers_filename = False
+            data = b''.join(base64.b64decode(attachment.db_datas).splitlines(True)[:lines])
+        return data.decode('ISO-8859-1')
+
+    def _write_txt_file(self, field_name, filename, rows):
+        """ Write rows on the attachment of field_name. Return True if there was any row """
+        txt_file = TxtFile()
+        try:
+            for row in rows:
+                txt_file.write(row)
+            return self._store_txt_file(field_name, filename, txt_file)
+        finally:
+            txt_file.close()
+
+    def _store_txt_file(self, field_name, filename, txt_file):
+        """
+        Store the TxtFile txt_file as the attachment of field_name, replacing
+        the previous one. Rows are kept on the temporary file while they are
+        produced, the content is only loaded to create the attachment.
+        Return True if it has any row
+        """
+        self.ensure_one()
+        attachments = self.env['ir.attachment'].sudo()
+        self._get_txt_attachment(field_name).unlink()
+        self.invalidate_cache([field_name])
+        if not txt_file.size:
+            return False
+        txt_file.file.seek(0)
+        # created through the ORM so that the configured storage is used
+        attachments.create({
+            'name': filename,
+            'res_model': self._name,
+            'res_id': self.id,
+            'res_field': field_name,
+            'mimetype': 'text/plain',
+            'datas': base64.b64encode(txt_file.file.read()),
+        })
+        return True
 
     def compute_txt_data(self):
-        alicuotas = self._get_REGINFO_CV_ALICUOTAS()
-        # sacamos todas las lineas y las juntamos
-        lines = []
-        for k, v in alicuotas.items():
-            lines += v
-        self.REGINFO_CV_ALICUOTAS = '\r\n'.join(lines)
-
-        impo_alicuotas = {}
-        if self.type == 'purchase':
-            impo_alicuotas = self._get_REGINFO_CV_ALICUOTAS(impo=True)
-            # sacamos todas las lineas y las juntamos
-            lines = []
-            for k, v in impo_alicuotas.items():
-                lines += v
-            self.REGINFO_CV_COMPRAS_IMPORTACIONES = '\r\n'.join(lines)
-        alicuotas.update(impo_alicuotas)
-        self._get_REGINFO_CV_CBTE(alicuotas)
+        """
+        Write the txt files on a single pass over the invoices, each invoice
+        gives its aliquots rows (import aliquots for import dispatches on
+        purchases) and then its voucher row
+        """
+        self.ensure_one()
+        files = [
+            ('vouchers_file', 'vouchers_filename', _('Vouchers_%s_%s.txt')),
+            ('aliquots_file', 'aliquots_filename', _('Alicuots_%s_%s.txt')),
+            ('import_aliquots_file', 'import_aliquots_filename', _('Import_Alicuots_%s_%s.txt')),
+        ]
+        txt_files = {field_name: TxtFile() for field_name, _filename_field, _filename in files}
+        try:
+            for inv in self._iter_txt_invoices_data():
+                impo = self.type == 'purchase' and inv['document_type_code'] == '66'
+                alicuotas = self._get_aliquots_rows(inv, impo=impo)
+                for row in alicuotas:
+                    txt_files[impo and 'import_aliquots_file' or 'aliquots_file'].write(row)
+                txt_files['vouchers_file'].write(self._get_voucher_row(inv, len(alicuotas)))
+            for field_name, filename_field, filename in files:
+                filename = filename % (self.type, self.date_to)
+                self[filename_field] = self._store_txt_file(
+                    field_name, filename, txt_files[field_name]) and filename
+        finally:
+            for txt_file in txt_files.values():
+                txt_file.close()
 
     @api.model
     def _get_partner_document_code_and_number(self, partner):
@@ -298,231 +357,385 @@ class AccountVatLedger(models.Model):
 
     @api.model
     def _get_pos_and_invoice_invoice_number(self, invoice):
-        res = invoice._l10n_ar_get_document_number_parts(
-            invoice.l10n_latam_document_number, invoice.l10n_latam_document_type_id.code)
+        res = self.env['account.move']._l10n_ar_get_document_number_parts(
+            invoice['document_number'], invoice['document_type_code'])
         return "{:0>20d}".format(res['invoice_number']), "{:0>5d}".format(res['point_of_sale'])
 
-    def _get_txt_invoices(self):
+    def _get_txt_invoices_query(self):
+        """ Return the query (and its params) of the ids of the invoices of the ledger """
         self.ensure_one()
-        return self.env['account.move'].search([
-            ('id', 'in', self.invoice_ids.mapped('move_id').ids),
-            ('l10n_latam_document_type_id.code', '!=', False)], order='invoice_date asc, name asc, id asc')
+        vat_line = self.env['account.ar.vat.line']
+        query = vat_line._where_calc(self._get_invoices_domain())
+        vat_line._apply_ir_rules(query, 'read')
+        from_clause, where_clause, params = query.get_sql()
+        return 'SELECT "account_ar_vat_line".move_id FROM %s WHERE %s' % (
+            from_clause, where_clause or 'TRUE'), params
+
+    def _iter_txt_invoices_data(self, chunk_size=5000):
+        """
+        Yield, in date and number order, a dict for each invoice to be
+        reported with all the data the txt files need. The data is read and
+        the amounts computed with a few queries for each chunk of invoices,
+        instead of browsing every invoice, so that big ledgers don't need many
+        queries nor memory. Amounts are on company currency and are computed
+        the same way as account.move _l10n_ar_get_amounts and _get_vat
+        """
+        self.ensure_one()
+        invoices_query, params = self._get_txt_invoices_query()
+        self._cr.execute("""
+            SELECT am.id
+            FROM account_move am
+            JOIN l10n_latam_document_type dt ON dt.id = am.l10n_latam_document_type_id
+            WHERE am.id IN (%s) AND dt.code IS NOT NULL
+            ORDER BY am.invoice_date, am.name, am.id""" % invoices_query, params)
+        move_ids = [x[0] for x in self._cr.fetchall()]
+        profits_group = self.env.ref('l10n_ar.tax_group_percepcion_ganancias')
+        for start in range(0, len(move_ids), chunk_size):
+            chunk_ids = move_ids[start:start + chunk_size]
+            self._cr.execute("""
+                SELECT
+                    am.id, am.name, am.type, am.company_id, am.invoice_date, am.invoice_date_due,
+                    am.amount_total_signed AS amount_total, am.l10n_ar_currency_rate AS currency_rate,
+                    rc.l10n_ar_afip_code AS currency_code, am.partner_id, am.commercial_partner_id,
+                    cp.name AS commercial_partner_name, art.code AS partner_responsibility_code,
+                    dt.code AS document_type_code, dt.doc_code_prefix, dt.l10n_ar_letter AS letter,
+                    dt.purchase_aliquots
+                FROM account_move am
+                JOIN l10n_latam_document_type dt ON dt.id = am.l10n_latam_document_type_id
+                LEFT JOIN res_currency rc ON rc.id = am.currency_id
+                LEFT JOIN res_partner rp ON rp.id = am.partner_id
+                LEFT JOIN l10n_ar_afip_responsibility_type art ON art.id = rp.l10n_ar_afip_responsibility_type_id
+                LEFT JOIN res_partner cp ON cp.id = am.commercial_partner_id
+                WHERE am.id IN %s""", (tuple(chunk_ids),))
+            invoices = {x['id']: x for x in self._cr.dictfetchall()}
+            taxes, bases = self._get_txt_amounts(chunk_ids)
+
+            # partners are read together and its document computed only once
+            partners = self.env['res.partner'].browse(
+                {x['partner_id'] for x in invoices.values()} |
+                {x['commercial_partner_id'] for x in invoices.values()})
+            partners = {x.id: x for x in partners}
+            documents = {}
+
+            def get_document(partner_id):
+                if partner_id not in documents:
+                    documents[partner_id] = self._get_partner_document_code_and_number(partners[partner_id])
+                return documents[partner_id]
+
+            for move_id in chunk_ids:
+                invoice = invoices[move_id]
+                invoice['inbound'] = invoice['type'] in ('out_invoice', 'in_refund', 'out_receipt')
+                invoice['amounts'], invoice['aliquots'] = self._get_txt_invoice_amounts(
+                    invoice, taxes.get(move_id, []), bases.get(move_id, {}), profits_group.id)
+                # same as account.move l10n_latam_document_number
+                invoice['document_number'] = invoice['doc_code_prefix'] and invoice['name'].split(
+                    ' ', 1)[-1] or invoice['name']
+                invoice['partner_document'] = get_document(invoice['partner_id'])
+                invoice['commercial_partner_document'] = get_document(invoice['commercial_partner_id'])
+                yield invoice
+
+    @api.model
+    def _get_txt_amounts(self, move_ids):
+        """
+        Return two dicts by move id: its tax lines (tax group, VAT and tribute
+        afip codes and balance, on the order of the move lines) and the sum of
+        its invoice lines by VAT afip code of their taxes (a line is summed
+        once for each code)
+        """
+        taxes = {}
+        self._cr.execute("""
+            SELECT aml.move_id, tg.id, tg.l10n_ar_vat_afip_code, tg.l10n_ar_tribute_afip_code, aml.balance
+            FROM account_move_line aml
+            JOIN account_tax t ON t.id = aml.tax_line_id
+            JOIN account_tax_group tg ON tg.id = t.tax_group_id
+            WHERE aml.move_id IN %s
+            ORDER BY aml.move_id, aml.id""", (tuple(move_ids),))
+        for row in self._cr.fetchall():
+            taxes.setdefault(row[0], []).append(row[1:])
+
+        bases = {}
+        self._cr.execute("""
+            SELECT move_id, vat_code, sum(balance)
+            FROM (
+                SELECT DISTINCT aml.id, aml.move_id, aml.balance, tg.l10n_ar_vat_afip_code AS vat_code
+                FROM account_move_line aml
+                JOIN account_move_line_account_tax_rel amltr ON amltr.account_move_line_id = aml.id
+                JOIN account_tax t ON t.id = amltr.account_tax_id
+                JOIN account_tax_group tg ON tg.id = t.tax_group_id
+                WHERE aml.move_id IN %s AND NOT coalesce(aml.exclude_from_invoice_tab, False)
+                    AND tg.l10n_ar_vat_afip_code IS NOT NULL
+            ) AS base_lines
+            GROUP BY move_id, vat_code""", (tuple(move_ids),))
+        for move_id, vat_code, amount in self._cr.fetchall():
+            bases.setdefault(move_id, {})[vat_code] = amount
+        return taxes, bases
+
+    @api.model
+    def _get_txt_invoice_amounts(self, invoice, taxes, bases, profits_group_id):
+        """
+        Return the amounts of _l10n_ar_get_amounts(company_currency=True) and
+        the aliquots of _get_vat(company_currency=True) (as a list of
+        (afip code, base, amount), one for each VAT tax line) computed from
+        the values of _get_txt_amounts
+        """
+        # balance is negative on inbound moves
+        sign = -1 if invoice['inbound'] else 1
+        amounts = dict.fromkeys([
+            'vat_amount', 'iibb_perc_amount', 'mun_perc_amount', 'intern_tax_amount', 'other_taxes_amount',
+            'profits_perc_amount', 'vat_perc_amount', 'other_perc_amount'], 0.0)
+        tribute_amounts = {
+            '07': 'iibb_perc_amount',
+            '08': 'mun_perc_amount',
+            '04': 'intern_tax_amount',
+            '99': 'other_taxes_amount',
+            '06': 'vat_perc_amount',
+            '09': 'other_perc_amount',
+        }
+        aliquots = []
+        for group_id, vat_code, tribute_code, balance in taxes:
+            amount = sign * balance
+            if vat_code:
+                amounts['vat_amount'] += amount
+            if group_id == profits_group_id:
+                amounts['profits_perc_amount'] += amount
+            # profits perceptions are not reported again as other perceptions
+            if tribute_code in tribute_amounts and not (tribute_code == '09' and group_id == profits_group_id):
+                amounts[tribute_amounts[tribute_code]] += amount
+            if vat_code and vat_code not in ['0', '1', '2'] and balance:
+                aliquots.append((vat_code, sign * bases.get(vat_code, 0.0), amount))
+        amounts['vat_exempt_base_amount'] = sign * bases.get('2', 0.0)
+        amounts['vat_untaxed_base_amount'] = sign * bases.get('1', 0.0)
+
+        # Report vat 0%
+        if bases.get('3'):
+            aliquots.append(('3', sign * bases['3'], 0.0))
+        return amounts, aliquots
 
     def _get_REGINFO_CV_CBTE(self, alicuotas):
+        """
+        Return the vouchers rows, alicuotas is a dict of aliquots rows by
+        invoice as returned by _get_REGINFO_CV_ALICUOTAS
+        """
         self.ensure_one()
         res = []
-        invoices = self._get_txt_invoices()
-        for inv in invoices:
-            # si no existe la factura en alicuotas es porque no tienen ninguna
-            cant_alicuotas = len(alicuotas.get(inv))
-
-            currency_rate = inv.l10n_ar_currency_rate
-            currency_code = inv.currency_id.l10n_ar_afip_code
-
-            invoice_number, pos_number = self._get_pos_and_invoice_invoice_number(inv)
-            doc_code, doc_number = self._get_partner_document_code_and_number(inv.partner_id)
-
-            amounts = inv._l10n_ar_get_amounts(company_currency=True)
-            amount_total = (1 if inv.is_inbound() else -1) * inv.amount_total_signed
-            vat_amount = amounts['vat_amount']
-            vat_exempt_base_amount = amounts['vat_exempt_base_amount']
-            vat_untaxed_base_amount = amounts['vat_untaxed_base_amount']
-            other_taxes_amount = amounts['other_taxes_amount']
-            vat_perc_amount = amounts['vat_perc_amount']
-            iibb_perc_amount = amounts['iibb_perc_amount']
-            mun_perc_amount = amounts['mun_perc_amount']
-            intern_tax_amount = amounts['intern_tax_amount']
-            perc_imp_nacionales_amount = amounts['profits_perc_amount'] + amounts['other_perc_amount']
-
-            if vat_exempt_base_amount:
-                # operacion con zona franca
-                if inv.partner_id.l10n_ar_afip_responsibility_type_id.code == '10':
-                    codigo_operacion = 'Z'
-                # expo al exterior
-                elif inv.l10n_latam_document_type_id.l10n_ar_letter == 'E':
-                    codigo_operacion = 'X'
-                # operacion exenta
-                else:
-                    codigo_operacion = 'E'
-            # despacho de importacion
-            elif inv.l10n_latam_document_type_id.code == '66':
-                codigo_operacion = 'E'
-            # operacion no gravada
-            elif vat_untaxed_base_amount:
-                codigo_operacion = 'N'
-            else:
-                codigo_operacion = ' '
-
-            row = [
-                # Campo 1: Fecha de comprobante
-                inv.invoice_date.strftime('%Y%m%d'),
+        for inv in self._iter_txt_invoices_data():
+            move = self.env['account.move'].browse(inv['id'])
+            res.append(self._get_voucher_row(inv, len(alicuotas.get(move, []))))
+        return res
 
-                # Campo 2: Tipo de Comprobante.
-                "{:0>3d}".format(int(inv.l10n_latam_document_type_id.code)),
+    def _get_voucher_row(self, invoice, cant_alicuotas):
+        """ invoice is a dict of _iter_txt_invoices_data """
+        self.ensure_one()
+        inv = invoice
 
-                # Campo 3: Punto de Venta
-                pos_number,
+        currency_rate = inv['currency_rate']
+        currency_code = inv['currency_code']
 
-                # Campo 4: Número de Comprobante
-                # Si se trata de un comprobante de varias hojas, se deberá
-                # informar el número de documento de la primera hoja, teniendo
-                # en cuenta lo normado en el  artículo 23, inciso a), punto
-                # 6., de la Resolución General N° 1.415, sus modificatorias y
-                # complementarias.
-                # En el supuesto de registrar de manera agrupada por totales
-                # diarios, se deberá consignar el primer número de comprobante
-                # del rango a considerar.
-                invoice_number,
-            ]
+        invoice_number, pos_number = self._get_pos_and_invoice_invoice_number(inv)
+        doc_code, doc_number = inv['partner_document']
+
+        amounts = inv['amounts']
+        amount_total = (1 if inv['inbound'] else -1) * inv['amount_total']
+        vat_amount = amounts['vat_amount']
+        vat_exempt_base_amount = amounts['vat_exempt_base_amount']
+        vat_untaxed_base_amount = amounts['vat_untaxed_base_amount']
+        other_taxes_amount = amounts['other_taxes_amount']
+        vat_perc_amount = amounts['vat_perc_amount']
+        iibb_perc_amount = amounts['iibb_perc_amount']
+        mun_perc_amount = amounts['mun_perc_amount']
+        intern_tax_amount = amounts['intern_tax_amount']
+        perc_imp_nacionales_amount = amounts['profits_perc_amount'] + amounts['other_perc_amount']
+
+        if vat_exempt_base_amount:
+            # operacion con zona franca
+            if inv['partner_responsibility_code'] == '10':
+                codigo_operacion = 'Z'
+            # expo al exterior
+            elif inv['letter'] == 'E':
+                codigo_operacion = 'X'
+            # operacion exenta
+            else:
+                codigo_operacion = 'E'
+        # despacho de importacion
+        elif inv['document_type_code'] == '66':
+            codigo_operacion = 'E'
+        # operacion no gravada
+        elif vat_untaxed_base_amount:
+            codigo_operacion = 'N'
+        else:
+            codigo_operacion = ' '
+
+        row = [
+            # Campo 1: Fecha de comprobante
+            inv['invoice_date'].strftime('%Y%m%d'),
+
+            # Campo 2: Tipo de Comprobante.
+            "{:0>3d}".format(int(inv['document_type_code'])),
+
+            # Campo 3: Punto de Venta
+            pos_number,
+
+            # Campo 4: Número de Comprobante
+            # Si se trata de un comprobante de varias hojas, se deberá
+            # informar el número de documento de la primera hoja, teniendo
+            # en cuenta lo normado en el  artículo 23, inciso a), punto
+            # 6., de la Resolución General N° 1.415, sus modificatorias y
+            # complementarias.
+            # En el supuesto de registrar de manera agrupada por totales
+            # diarios, se deberá consignar el primer número de comprobante
+            # del rango a considerar.
+            invoice_number,
+        ]
 
-            if self.type == 'sale':
-                # Campo 5: Número de Comprobante Hasta.
-                # En el resto de los casos se consignará el dato registrado en el campo 4
-                row.append(invoice_number)
+        if self.type == 'sale':
+            # Campo 5: Número de Comprobante Hasta.
+            # En el resto de los casos se consignará el dato registrado en el campo 4
+            row.append(invoice_number)
+        else:
+            # Campo 5: Despacho de importación
+            if inv['document_type_code'] == '66':
+                row.append((inv['document_number']).rjust(16, '0'))
             else:
-                # Campo 5: Despacho de importación
-                if inv.l10n_latam_document_type_id.code == '66':
-                    row.append((inv.l10n_latam_document_number).rjust(16, '0'))
-                else:
-                    row.append(''.rjust(16, ' '))
+                row.append(''.rjust(16, ' '))
 
-            row += [
-                # Campo 6: Código de documento del comprador.
-                doc_code,
+        row += [
+            # Campo 6: Código de documento del comprador.
+            doc_code,
 
-                # Campo 7: Número de Identificación del comprador
-                doc_number,
+            # Campo 7: Número de Identificación del comprador
+            doc_number,
 
-                # Campo 8: Apellido y Nombre del comprador.
-                inv.commercial_partner_id.name.ljust(30, ' ')[:30],
+            # Campo 8: Apellido y Nombre del comprador.
+            inv['commercial_partner_name'].ljust(30, ' ')[:30],
 
-                # Campo 9: Importe Total de la Operación.
-                self.format_amount(amount_total),
+            # Campo 9: Importe Total de la Operación.
+            self.format_amount(amount_total),
 
-                # Campo 10: Importe total de conceptos que no integran el precio neto gravado
-                self.format_amount(vat_untaxed_base_amount),
-            ]
+            # Campo 10: Importe total de conceptos que no integran el precio neto gravado
+            self.format_amount(vat_untaxed_base_amount),
+        ]
 
-            if self.type == 'sale':
-                row += [
-                    # Campo 11: Percepción a no categorizados
-                    # la figura no categorizado / responsable no inscripto no se usa más
-                    self.format_amount(0.0),
+        if self.type == 'sale':
+            row += [
+                # Campo 11: Percepción a no categorizados
+                # la figura no categorizado / responsable no inscripto no se usa más
+                self.format_amount(0.0),
 
-                    # Campo 12: Importe de operaciones exentas
-                    self.format_amount(vat_exempt_base_amount),
+                # Campo 12: Importe de operaciones exentas
+                self.format_amount(vat_exempt_base_amount),
 
-                    # Campo 13: Importe de percepciones o pagos a cuenta de impuestos Nacionales
-                    self.format_amount(perc_imp_nacionales_amount + vat_perc_amount),
-                ]
-            else:
-                row += [
-                    # Campo 11: Importe de operaciones exentas
-                    self.format_amount(vat_exempt_base_amount),
+                # Campo 13: Importe de percepciones o pagos a cuenta de impuestos Nacionales
+                self.format_amount(perc_imp_nacionales_amount + vat_perc_amount),
+            ]
+        else:
+            row += [
+                # Campo 11: Importe de operaciones exentas
+                self.format_amount(vat_exempt_base_amount),
 
-                    # Campo 12: Importe de percepciones o pagos a cuenta del Impuesto al Valor Agregado
-                    self.format_amount(vat_perc_amount),
+                # Campo 12: Importe de percepciones o pagos a cuenta del Impuesto al Valor Agregado
+                self.format_amount(vat_perc_amount),
 
-                    # Campo 13: Importe de percepciones o pagos a cuenta otros impuestos nacionales
-                    self.format_amount(perc_imp_nacionales_amount),
-                ]
+                # Campo 13: Importe de percepciones o pagos a cuenta otros impuestos nacionales
+                self.format_amount(perc_imp_nacionales_amount),
+            ]
 
-            row += [
+        row += [
 
-                # Campo 14: Importe de percepciones de ingresos brutos
-                self.format_amount(iibb_perc_amount),
+            # Campo 14: Importe de percepciones de ingresos brutos
+            self.format_amount(iibb_perc_amount),
 
-                # Campo 15: Importe de percepciones de impuestos municipales
-                self.format_amount(mun_perc_amount),
+            # Campo 15: Importe de percepciones de impuestos municipales
+            self.format_amount(mun_perc_amount),
 
-                # Campo 16: Importe de impuestos internos
-                self.format_amount(intern_tax_amount),
+            # Campo 16: Importe de impuestos internos
+            self.format_amount(intern_tax_amount),
 
-                # Campo 17: Código de Moneda
-                str(currency_code),
+            # Campo 17: Código de Moneda
+            str(currency_code),
 
-                # Campo 18: Tipo de Cambio
-                # nueva modalidad de currency_rate
-                self.format_amount(currency_rate, padding=10, decimals=6),
+            # Campo 18: Tipo de Cambio
+            # nueva modalidad de currency_rate
+            self.format_amount(currency_rate, padding=10, decimals=6),
 
-                # Campo 19: Cantidad de alícuotas de IVA
-                str(cant_alicuotas),
+            # Campo 19: Cantidad de alícuotas de IVA
+            str(cant_alicuotas),
 
-                # Campo 20: Código de operación.
-                codigo_operacion,
-            ]
+            # Campo 20: Código de operación.
+            codigo_operacion,
+        ]
 
-            if self.type == 'sale':
-                row += [
-                    # Campo 21: Otros Tributos
-                    self.format_amount(other_taxes_amount),
-
-                    # Campo 22: vencimiento comprobante (no figura en
-                    # instructivo pero si en aplicativo) para tique y factura
-                    # de exportacion no se informa, tmb para algunos otros
-                    # pero que tampoco tenemos implementados
-                    (inv.l10n_latam_document_type_id.code in [
-                        '19', '20', '21', '16', '55', '81', '82', '83',
-                        '110', '111', '112', '113', '114', '115', '116',
-                        '117', '118', '119', '120', '201', '202', '203',
-                        '206', '207', '208', '211', '212', '213'] and
-                        '00000000' or
-                        inv.invoice_date_due.strftime('%Y%m%d')),
-                ]
-            else:
-                # Campo 21: Crédito Fiscal Computable
-                if self.prorate_tax_credit:
-                    if self.prorate_type == 'global':
-                        row.append(self.format_amount(0))
-                    else:
-                        # row.append(self.format_amount(0))
-                        # por ahora no implementado pero seria lo mismo que
-                        # sacar si prorrateo y que el cliente entre en el txt
-                        # en cada comprobante y complete cuando es en
-                        # credito fiscal computable
-                        raise ValidationError(_(
-                            'Para utilizar el prorrateo por comprobante:\n'
-                            '1) Exporte los archivos sin la opción "Proratear '
-                            'Crédito de Impuestos"\n2) Importe los mismos '
-                            'en el aplicativo\n3) En el aplicativo de afip, '
-                            'comprobante por comprobante, indique el valor '
-                            'correspondiente en el campo "Crédito Fiscal '
-                            'Computable"'))
+        if self.type == 'sale':
+            row += [
+                # Campo 21: Otros Tributos
+                self.format_amount(other_taxes_amount),
+
+                # Campo 22: vencimiento comprobante (no figura en
+                # instructivo pero si en aplicativo) para tique y factura
+                # de exportacion no se informa, tmb para algunos otros
+                # pero que tampoco tenemos implementados
+                (inv['document_type_code'] in [
+                    '19', '20', '21', '16', '55', '81', '82', '83',
+                    '110', '111', '112', '113', '114', '115', '116',
+                    '117', '118', '119', '120', '201', '202', '203',
+                    '206', '207', '208', '211', '212', '213'] and
+                    '00000000' or
+                    inv['invoice_date_due'].strftime('%Y%m%d')),
+            ]
+        else:
+            # Campo 21: Crédito Fiscal Computable
+            if self.prorate_tax_credit:
+                if self.prorate_type == 'global':
+                    row.append(self.format_amount(0))
                 else:
-                    row.append(self.format_amount(vat_amount))
+                    # row.append(self.format_amount(0))
+                    # por ahora no implementado pero seria lo mismo que
+                    # sacar si prorrateo y que el cliente entre en el txt
+                    # en cada comprobante y complete cuando es en
+                    # credito fiscal computable
+                    raise ValidationError(_(
+                        'Para utilizar el prorrateo por comprobante:\n'
+                        '1) Exporte los archivos sin la opción "Proratear '
+                        'Crédito de Impuestos"\n2) Importe los mismos '
+                        'en el aplicativo\n3) En el aplicativo de afip, '
+                        'comprobante por comprobante, indique el valor '
+                        'correspondiente en el campo "Crédito Fiscal '
+                        'Computable"'))
+            else:
+                row.append(self.format_amount(vat_amount))
 
-                liquido_type = inv.l10n_latam_document_type_id.code in ['033', '058', '059', '060', '063']
-                row += [
-                    # Campo 22: Otros Tributos
-                    self.format_amount(other_taxes_amount),
+            company = self.env['res.company'].browse(inv['company_id'])
+            liquido_type = inv['document_type_code'] in ['033', '058', '059', '060', '063']
+            row += [
+                # Campo 22: Otros Tributos
+                self.format_amount(other_taxes_amount),
 
-                    # TODO still not implemented on this three fields for use case with third pary commisioner
+                # TODO still not implemented on this three fields for use case with third pary commisioner
 
-                    # Campo 23: CUIT Emisor / Corredor
-                    # Se informará sólo si en el campo "Tipo de Comprobante" se consigna '033', '058', '059', '060' ó
-                    # '063'. Si para éstos comprobantes no interviene un tercero en la operación, se consignará la
-                    # C.U.I.T. del informante. Para el resto de los comprobantes se completará con ceros
-                    self.format_amount(liquido_type and inv.company_id.partner_id.ensure_vat() or 0, padding=11),
+                # Campo 23: CUIT Emisor / Corredor
+                # Se informará sólo si en el campo "Tipo de Comprobante" se consigna '033', '058', '059', '060' ó
+                # '063'. Si para éstos comprobantes no interviene un tercero en la operación, se consignará la
+                # C.U.I.T. del informante. Para el resto de los comprobantes se completará con ceros
+                self.format_amount(liquido_type and company.partner_id.ensure_vat() or 0, padding=11),
 
-                    # Campo 24: Denominación Emisor / Corredor
-                    (liquido_type and inv.company_id.name or '').ljust(30, ' ')[:30],
+                # Campo 24: Denominación Emisor / Corredor
+                (liquido_type and company.name or '').ljust(30, ' ')[:30],
 
-                    # Campo 25: IVA Comisión
-                    # Si el campo 23 es distinto de cero se consignará el importe del I.V.A. de la comisión
-                    self.format_amount(0),
-                ]
-            res.append(''.join(row))
-        self.REGINFO_CV_CBTE = '\r\n'.join(res)
+                # Campo 25: IVA Comisión
+                # Si el campo 23 es distinto de cero se consignará el importe del I.V.A. de la comisión
+                self.format_amount(0),
+            ]
+        return ''.join(row)
 
     def _get_tax_row(self, invoice, base, code, tax_amount, impo=False):
+        """ invoice is a dict of _iter_txt_invoices_data """
         self.ensure_one()
         inv = invoice
         invoice_number, pos_number = self._get_pos_and_invoice_invoice_number(inv)
-        doc_code, doc_number = self._get_partner_document_code_and_number(inv.commercial_partner_id)
+        doc_code, doc_number = inv['commercial_partner_document']
         if self.type == 'sale':
             row = [
                 # Campo 1: Tipo de Comprobante
-                "{:0>3d}".format(int(inv.l10n_latam_document_type_id.code)),
+                "{:0>3d}".format(int(inv['document_type_code'])),
 
                 # Campo 2: Punto de Venta
                 pos_number,
@@ -542,7 +755,7 @@ class AccountVatLedger(models.Model):
         elif impo:
             row = [
                 # Campo 1: Despacho de importación.
-                (inv.l10n_latam_document_number or inv.name or '').rjust(16, '0'),
+                (inv['document_number'] or inv['name'] or '').rjust(16, '0'),
 
                 # Campo 2: Importe Neto Gravado
                 self.format_amount(base),
@@ -556,7 +769,7 @@ class AccountVatLedger(models.Model):
         else:
             row = [
                 # Campo 1: Tipo de Comprobante
-                "{:0>3d}".format(int(inv.l10n_latam_document_type_id.code)),
+                "{:0>3d}".format(int(inv['document_type_code'])),
 
                 # Campo 2: Punto de Venta
                 pos_number,
@@ -588,31 +801,34 @@ class AccountVatLedger(models.Model):
         """
         self.ensure_one()
         res = {}
+        for inv in self._iter_txt_invoices_data():
+            if (inv['document_type_code'] == '66') != bool(impo):
+                continue
+            res[self.env['account.move'].browse(inv['id'])] = self._get_aliquots_rows(inv, impo=impo)
+        return res
+
+    def _get_aliquots_rows(self, invoice, impo=False):
+        """ invoice is a dict of _iter_txt_invoices_data """
+        self.ensure_one()
         # only vat taxes with codes 3, 4, 5, 6, 8, 9 segun:
         # http://contadoresenred.com/regimen-de-informacion-de-compras-y-ventas-rg-3685-como-cargar-la-informacion/
         # empezamos a contar los codigos 1 (no gravado) y 2 (exento) si no hay alicuotas, sumamos una de esta con
         # 0, 0, 0 en detalle usamos mapped por si hay afip codes duplicados (ej. manual y auto)
-        if impo:
-            invoices = self._get_txt_invoices().filtered(lambda r: r.l10n_latam_document_type_id.code == '66')
-        else:
-            invoices = self._get_txt_invoices().filtered(lambda r: r.l10n_latam_document_type_id.code != '66')
-        for inv in invoices:
-            lines = []
-            vat_taxes = inv._get_vat(company_currency=True)
-
-            # tipically this is for invoices with zero amount
-            if not vat_taxes and inv.l10n_latam_document_type_id.purchase_aliquots == 'not_zero':
-                lines.append(''.join(self._get_tax_row(inv, 0.0, 3, 0.0, impo=impo)))
-
-            # we group by afip_code
-            for vat_tax in vat_taxes:
-                lines.append(''.join(self._get_tax_row(
-                    inv,
-                    vat_tax['BaseImp'],
-                    vat_tax['Id'],
-                    vat_tax['Importe'],
-                    impo=impo,
-                )))
-
-            res[inv] = lines
-        return res
+        inv = invoice
+        lines = []
+        vat_taxes = inv['aliquots']
+
+        # tipically this is for invoices with zero amount
+        if not vat_taxes and inv['purchase_aliquots'] == 'not_zero':
+            lines.append(''.join(self._get_tax_row(inv, 0.0, 3, 0.0, impo=impo)))
+
+        # we group by afip_code
+        for code, base, amount in vat_taxes:
+            lines.append(''.join(self._get_tax_row(
+                inv,
+                base,
+                code,
+                amount,
+                impo=impo,
+            )))
+        return lines
@@ -1,4 +1,10 @@
-from odoo import tools, models, fields
+from odoo import tools, models, fields, api
+from contextlib import contextmanager
+import hashlib
+import logging
+import zlib
+
+_logger = logging.getLogger(__name__)
 
 
 class AccountArVatLine(models.Model):
@@ -63,11 +69,10 @@ class AccountArVatLine(models.Model):
         self.ensure_one()
         return self.move_id.get_formview_action()
 
-    def init(self):
-        cr = self._cr
-        tools.drop_view_if_exists(cr, self._table)
+    @api.model
+    def _get_query(self):
         # pylint: disable=sql-injection
-        query = """
+        return """
 SELECT
     am.id,
     (CASE WHEN lit.l10n_ar_afip_code = '80' THEN rp.vat ELSE null END) as cuit,
@@ -136,8 +141,273 @@ WHERE
     and am.type in ('out_invoice', 'in_invoice', 'out_refund', 'in_refund')
 GROUP BY
     am.id, art.name, rp.id, lit.id
-ORDER BY
-    am.date, am.name
+"""
+
+    # indexes the lines query needs: (name, table, definition)
+    _source_indexes = [
+        ('account_move_ar_vat_line_index', 'account_move', """(journal_id, date, state)
+            WHERE type IN ('out_invoice', 'in_invoice', 'out_refund', 'in_refund')"""),
+        ('account_move_line_ar_vat_line_tax_index', 'account_move_line', """(move_id, tax_line_id)
+            WHERE tax_line_id IS NOT NULL"""),
+    ]
+
+    def init(self):
+        """
+        account_ar_vat_line is a view of the lines query. If
+        "l10n_ar_reports.vat_line_materialized" is set the lines are kept on
+        a table instead and the view only computes the lines of the moves
+        changed since the last refresh (see _create_materialized). The table
+        is only created and loaded again if its definition changed
         """
+        cr = self._cr
+        self._create_source_indexes()
+        materialized = self.env['ir.config_parameter'].sudo().get_param('l10n_ar_reports.vat_line_materialized')
+        signature = materialized and self._get_materialized_signature()
+        if not signature or signature != self._get_materialized_current_signature():
+            self._drop_materialized()
+        tools.drop_view_if_exists(cr, self._table)
+        # no ORDER BY here, searches are already sorted by _order
+        query = self._get_query()
+        if materialized:
+            if not self._is_materialized():
+                self._create_materialized()
+            query = """
+                SELECT * FROM account_ar_vat_line_store s
+                WHERE NOT EXISTS (SELECT 1 FROM account_ar_vat_line_dirty d WHERE d.move_id = s.id)
+                UNION ALL
+                SELECT * FROM account_ar_vat_line_source
+                WHERE id IN (SELECT move_id FROM account_ar_vat_line_dirty)"""
         sql = """CREATE or REPLACE VIEW %s as (%s)""" % (self._table, query)
         cr.execute(sql)
+
+    @api.model
+    def _create_source_indexes(self):
+        """
+        Partial indexes on account_move and account_move_line to get the
+        invoices of the ledgers (journals, dates and state) and their tax
+        lines. The base lines are joined through the UNIQUE constraint of
+        account_move_line_account_tax_rel that already is a
+        (account_move_line_id, account_tax_id) index
+        """
+        cr = self._cr
+        for name, table, definition in self._source_indexes:
+            cr.execute("CREATE INDEX IF NOT EXISTS %s ON %s %s" % (name, table, definition))
+        cr.execute("""
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = 'account_move_line_account_tax_rel'::regclass
+                AND a.attname = 'account_move_line_id'""")
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX IF NOT EXISTS account_move_line_account_tax_rel_ar_vat_line_index
+                ON account_move_line_account_tax_rel (account_move_line_id, account_tax_id)""")
+
+    @api.model
+    def _get_materialized_ddl(self):
+        """
+        Statements that create account_ar_vat_line_store table, the
+        account_ar_vat_line_source view it is loaded from and the triggers
+        that queue on account_ar_vat_line_dirty the moves whose lines could
+        change. A move is queued once, with the id of the last transaction
+        that changed it, so that a refresh only removes the entries that were
+        not changed again since it read them
+        """
+        invoice_types = "('out_invoice', 'in_invoice', 'out_refund', 'in_refund')"
+        queue = """ON CONFLICT (move_id) DO UPDATE SET seq = EXCLUDED.seq
+            WHERE account_ar_vat_line_dirty.seq != EXCLUDED.seq"""
+        ddl = [
+            "CREATE OR REPLACE VIEW account_ar_vat_line_source AS (%s)" % self._get_query(),
+            "CREATE TABLE account_ar_vat_line_store AS SELECT * FROM account_ar_vat_line_source WITH NO DATA",
+            "CREATE UNIQUE INDEX account_ar_vat_line_store_id_index ON account_ar_vat_line_store (id)",
+            """CREATE INDEX account_ar_vat_line_store_ledger_index
+                ON account_ar_vat_line_store (company_id, journal_id, date, state)""",
+            """CREATE TABLE account_ar_vat_line_dirty (
+                move_id integer PRIMARY KEY, seq bigint NOT NULL DEFAULT txid_current())""",
+            """
+            CREATE OR REPLACE FUNCTION account_ar_vat_line_log() RETURNS trigger AS $$
+            BEGIN
+                IF TG_TABLE_NAME = 'account_move' THEN
+                    INSERT INTO account_ar_vat_line_dirty (move_id)
+                        VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END) %(queue)s;
+                ELSIF TG_TABLE_NAME = 'account_move_line' THEN
+                    IF TG_OP = 'INSERT' THEN
+                        INSERT INTO account_ar_vat_line_dirty (move_id) VALUES (NEW.move_id) %(queue)s;
+                    ELSE
+                        INSERT INTO account_ar_vat_line_dirty (move_id) VALUES (OLD.move_id) %(queue)s;
+                        IF TG_OP = 'UPDATE' AND NEW.move_id != OLD.move_id THEN
+                            INSERT INTO account_ar_vat_line_dirty (move_id) VALUES (NEW.move_id) %(queue)s;
+                        END IF;
+                    END IF;
+                ELSIF TG_TABLE_NAME = 'account_move_line_account_tax_rel' THEN
+                    INSERT INTO account_ar_vat_line_dirty (move_id)
+                        SELECT move_id FROM account_move_line
+                        WHERE id = (CASE WHEN TG_OP = 'DELETE' THEN OLD.account_move_line_id
+                                    ELSE NEW.account_move_line_id END)
+                        %(queue)s;
+                ELSIF TG_TABLE_NAME = 'res_partner' THEN
+                    INSERT INTO account_ar_vat_line_dirty (move_id)
+                        SELECT id FROM account_move WHERE partner_id = NEW.id AND type IN %(invoice_types)s
+                        %(queue)s;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql""" % {'queue': queue, 'invoice_types': invoice_types},
+        ]
+        # (name, table, events, condition): updates are only logged when a
+        # column the lines use changes
+        triggers = [
+            ('delete', 'account_move', 'DELETE', "OLD.type IN %s" % invoice_types),
+            ('update', 'account_move', """UPDATE OF
+                name, type, date, invoice_date, partner_id, journal_id, company_id, state,
+                l10n_ar_afip_responsibility_type_id, l10n_latam_document_type_id""", """
+                (OLD.type IN %s OR NEW.type IN %s) AND (
+                OLD.name IS DISTINCT FROM NEW.name OR OLD.type IS DISTINCT FROM NEW.type
+                OR OLD.date IS DISTINCT FROM NEW.date OR OLD.invoice_date IS DISTINCT FROM NEW.invoice_date
+                OR OLD.partner_id IS DISTINCT FROM NEW.partner_id OR OLD.journal_id IS DISTINCT FROM NEW.journal_id
+                OR OLD.company_id IS DISTINCT FROM NEW.company_id OR OLD.state IS DISTINCT FROM NEW.state
+                OR OLD.l10n_ar_afip_responsibility_type_id IS DISTINCT FROM NEW.l10n_ar_afip_responsibility_type_id
+                OR OLD.l10n_latam_document_type_id IS DISTINCT FROM NEW.l10n_latam_document_type_id)""" % (
+                invoice_types, invoice_types)),
+            # base lines are logged when their taxes are added
+            ('insert', 'account_move_line', 'INSERT', "NEW.tax_line_id IS NOT NULL"),
+            ('delete', 'account_move_line', 'DELETE', False),
+            ('update', 'account_move_line', 'UPDATE OF move_id, balance, tax_line_id', """
+                OLD.move_id IS DISTINCT FROM NEW.move_id OR OLD.balance IS DISTINCT FROM NEW.balance
+                OR OLD.tax_line_id IS DISTINCT FROM NEW.tax_line_id"""),
+            ('insert_delete', 'account_move_line_account_tax_rel', 'INSERT OR DELETE', False),
+            ('update', 'account_move_line_account_tax_rel', 'UPDATE', "OLD IS DISTINCT FROM NEW"),
+            ('update', 'res_partner', 'UPDATE OF name, vat, l10n_latam_identification_type_id', """
+                OLD.name IS DISTINCT FROM NEW.name OR OLD.vat IS DISTINCT FROM NEW.vat
+                OR OLD.l10n_latam_identification_type_id IS DISTINCT FROM NEW.l10n_latam_identification_type_id"""),
+        ]
+        for name, table, events, condition in triggers:
+            ddl.append("""
+                CREATE TRIGGER account_ar_vat_line_log_%s AFTER %s ON %s
+                FOR EACH ROW %s EXECUTE PROCEDURE account_ar_vat_line_log()""" % (
+                name, events, table, condition and 'WHEN (%s)' % condition or ''))
+        return ddl
+
+    @api.model
+    def _get_materialized_signature(self):
+        return hashlib.md5('\n'.join(self._get_materialized_ddl()).encode()).hexdigest()
+
+    @api.model
+    def _get_materialized_current_signature(self):
+        """ Signature of the definition the table was created with (kept as its comment) """
+        self._cr.execute("SELECT obj_description(to_regclass('account_ar_vat_line_store'), 'pg_class')")
+        return self._cr.fetchone()[0]
+
+    @api.model
+    def _create_materialized(self):
+        """
+        Create the table, the view and the triggers of _get_materialized_ddl
+        and load the lines.
+        Changes on taxes, tax groups or responsibility types are not logged,
+        after them the lines should be rebuilt (see _rebuild)
+        """
+        cr = self._cr
+        for statement in self._get_materialized_ddl():
+            cr.execute(statement)
+        cr.execute("COMMENT ON TABLE account_ar_vat_line_store IS %s", (self._get_materialized_signature(),))
+        self._rebuild()
+
+    @api.model
+    def _drop_materialized(self):
+        cr = self._cr
+        # up to 13.0.1.3.0 there was one trigger by table
+        for table in ['account_move', 'account_move_line', 'account_move_line_account_tax_rel', 'res_partner']:
+            cr.execute("DROP TRIGGER IF EXISTS account_ar_vat_line_log ON %s" % table)
+        # the triggers depend on the function
+        cr.execute("DROP FUNCTION IF EXISTS account_ar_vat_line_log() CASCADE")
+        # up to 13.0.1.3.0 the lines were kept on account_ar_vat_line table
+        cr.execute("SELECT relkind FROM pg_class WHERE relname = %s", (self._table,))
+        relkind = cr.fetchone()
+        if relkind and relkind[0] == 'r':
+            cr.execute("DROP TABLE %s" % self._table)
+        cr.execute("DROP TABLE IF EXISTS account_ar_vat_line_dirty, account_ar_vat_line_store CASCADE")
+        tools.drop_view_if_exists(cr, 'account_ar_vat_line_source')
+
+    @api.model
+    def _is_materialized(self):
+        self._cr.execute("SELECT relkind FROM pg_class WHERE relname = 'account_ar_vat_line_store'")
+        relkind = self._cr.fetchone()
+        return bool(relkind and relkind[0] == 'r')
+
+    @api.model
+    def _get_refresh_lock(self):
+        return zlib.crc32(self._table.encode())
+
+    @api.model
+    def _rebuild(self):
+        """
+        Load again all the lines of the table (if materialized). The queued
+        moves this transaction sees are loaded too, the ones of transactions
+        not committed yet are kept for the next refresh
+        """
+        if not self._is_materialized():
+            return
+        cr = self._cr
+        cr.execute("SELECT pg_advisory_xact_lock(%s)", (self._get_refresh_lock(),))
+        cr.execute("SELECT move_id, seq FROM account_ar_vat_line_dirty")
+        entries = cr.fetchall()
+        cr.execute("DELETE FROM account_ar_vat_line_store")
+        cr.execute("INSERT INTO account_ar_vat_line_store SELECT * FROM account_ar_vat_line_source")
+        self._unqueue(cr, entries)
+        cr.execute("ANALYZE account_ar_vat_line_store")
+        _logger.info('%s rebuilt' % self._table)
+
+    @api.model
+    @contextmanager
+    def _refresh_cursor(self):
+        """
+        Cursor to refresh the lines: a new one unless the current cursor is
+        already dedicated to it (context key "ar_vat_line_refresh_cursor")
+        """
+        if self._context.get('ar_vat_line_refresh_cursor'):
+            yield self._cr
+        else:
+            with self.pool.cursor() as cr:
+                # each statement sees what is committed when it starts, so the
+                # lines are loaded with all the changes of the entries read
+                cr.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+                yield cr
+
+    @api.model
+    def _refresh(self):
+        """
+        Move to the table the lines of the moves queued since the last
+        refresh (if materialized). It is done on its own transaction so that
+        the users transactions don't wait for it. Only the queue entries read
+        are removed, the moves queued again meanwhile are kept for the next
+        refresh.
+        If another worker is refreshing we don't wait for it, until then the
+        lines of the queued moves are computed by the view when read
+        """
+        if not self._is_materialized():
+            return
+        with self._refresh_cursor() as cr:
+            cr.execute("SELECT pg_try_advisory_xact_lock(%s)", (self._get_refresh_lock(),))
+            if not cr.fetchone()[0]:
+                return
+            cr.execute("SELECT move_id, seq FROM account_ar_vat_line_dirty")
+            entries = cr.fetchall()
+            if not entries:
+                return
+            move_ids = [x[0] for x in entries]
+            cr.execute("DELETE FROM account_ar_vat_line_store WHERE id = ANY(%s)", (move_ids,))
+            cr.execute("INSERT INTO account_ar_vat_line_store SELECT * FROM account_ar_vat_line_source "
+                       "WHERE id = ANY(%s)", (move_ids,))
+            self._unqueue(cr, entries)
+        _logger.debug('%s lines of %s moves refreshed' % (self._table, len(move_ids)))
+
+    @api.model
+    def _unqueue(self, cr, entries):
+        """
+        Remove the (move_id, seq) entries read from the queue, unless the move
+        was queued again since then
+        """
+        cr.execute("""
+            DELETE FROM account_ar_vat_line_dirty d
+            USING unnest(%s::integer[], %s::bigint[]) AS r (move_id, seq)
+            WHERE d.move_id = r.move_id AND d.seq = r.seq""", (
+            [x[0] for x in entries], [x[1] for x in entries]))
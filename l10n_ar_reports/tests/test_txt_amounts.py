@@ -0,0 +1,124 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo import fields
+from odoo.tests.common import TransactionCase, tagged
+
+
+@tagged('post_install', '-at_install')
+class TestTxtAmounts(TransactionCase):
+    """
+    The amounts and aliquots of the txt files are computed with SQL, they
+    should be the same as account.move _l10n_ar_get_amounts and _get_vat
+    """
+
+    def setUp(self):
+        super().setUp()
+        company = self.env.ref('l10n_ar.company_ri', raise_if_not_found=False)
+        partner = self.env.ref('l10n_ar.res_partner_adhoc', raise_if_not_found=False)
+        if not company or not partner or not company.chart_template_id:
+            self.skipTest('Argentinian demo data is needed')
+        self.env.user.company_ids |= company
+        self.env = self.env(context=dict(self.env.context, allowed_company_ids=[company.id]))
+        self.company = company
+        self.partner = partner
+        self.today = fields.Date.context_today(self.env.user)
+        self.journals = {}
+        for journal_type in ['sale', 'purchase']:
+            self.journals[journal_type] = self.env['account.journal'].search([
+                ('company_id', '=', company.id), ('type', '=', journal_type),
+                ('l10n_latam_use_documents', '=', True)], limit=1)
+            if not self.journals[journal_type]:
+                self.skipTest('There is no %s journal using documents' % journal_type)
+
+        self.usd = self.env.ref('base.USD')
+        self.usd.active = True
+        self.env['res.currency.rate'].create({
+            'name': self.today,
+            'rate': 1 / 80.0,
+            'currency_id': self.usd.id,
+            'company_id': company.id,
+        })
+        self.document_number = 0
+
+    def _get_tax(self, type_tax_use, tax_group):
+        tax = self.env['account.tax'].search([
+            ('company_id', '=', self.company.id), ('type_tax_use', '=', type_tax_use),
+            ('tax_group_id', '=', self.env.ref('l10n_ar.%s' % tax_group).id)], limit=1)
+        if not tax:
+            self.skipTest('There is no %s tax of group %s' % (type_tax_use, tax_group))
+        return tax
+
+    def _create_invoice(self, move_type, lines, currency=False):
+        journal = self.journals['sale' if move_type.startswith('out_') else 'purchase']
+        account = journal.default_credit_account_id if move_type.startswith('out_') else \
+            journal.default_debit_account_id
+        values = {
+            'type': move_type,
+            'partner_id': self.partner.id,
+            'journal_id': journal.id,
+            'invoice_date': self.today,
+            'currency_id': (currency or self.company.currency_id).id,
+            'invoice_line_ids': [(0, 0, {
+                'name': 'Line %s' % i,
+                'account_id': account.id,
+                'quantity': 1.0,
+                'price_unit': price_unit,
+                'tax_ids': [(6, 0, taxes.ids)],
+            }) for i, (price_unit, taxes) in enumerate(lines)],
+        }
+        if move_type.startswith('in_'):
+            self.document_number += 1
+            values['l10n_latam_document_number'] = '9999-%08d' % self.document_number
+        invoice = self.env['account.move'].create(values)
+        invoice.post()
+        return invoice
+
+    def _assert_txt_amounts(self, ledger_type, invoices):
+        ledger = self.env['account.vat.ledger'].create({
+            'company_id': self.company.id,
+            'type': ledger_type,
+            'date_from': self.today,
+            'date_to': self.today,
+            'journal_ids': [(6, 0, self.journals[ledger_type].ids)],
+            'first_page': 1,
+        })
+        self.env['base'].flush()
+        data = {x['id']: x for x in ledger._iter_txt_invoices_data()}
+        for invoice in invoices:
+            self.assertIn(invoice.id, data)
+            amounts = invoice._l10n_ar_get_amounts(company_currency=True)
+            for key, amount in data[invoice.id]['amounts'].items():
+                self.assertAlmostEqual(amount, amounts[key], places=2, msg='%s of %s' % (key, invoice.name))
+            vat = invoice._get_vat(company_currency=True)
+            self.assertEqual(
+                [x[0] for x in data[invoice.id]['aliquots']], [x['Id'] for x in vat], invoice.name)
+            for (_code, base, amount), expected in zip(data[invoice.id]['aliquots'], vat):
+                self.assertAlmostEqual(base, expected['BaseImp'], places=2, msg=invoice.name)
+                self.assertAlmostEqual(amount, expected['Importe'], places=2, msg=invoice.name)
+
+    def test_sale_amounts(self):
+        vat_21 = self._get_tax('sale', 'tax_group_iva_21')
+        vat_105 = self._get_tax('sale', 'tax_group_iva_105')
+        exempt = self._get_tax('sale', 'tax_group_iva_exento')
+        lines = [(1000.0, vat_21), (500.0, vat_105), (333.33, vat_21), (200.0, exempt)]
+        invoices = self._create_invoice('out_invoice', lines)
+        invoices |= self._create_invoice('out_invoice', lines, currency=self.usd)
+        invoices |= self._create_invoice('out_refund', lines[:2])
+        invoices |= self._create_invoice('out_refund', lines[:2], currency=self.usd)
+        self._assert_txt_amounts('sale', invoices)
+
+    def test_purchase_amounts(self):
+        vat_21 = self._get_tax('purchase', 'tax_group_iva_21')
+        vat_105 = self._get_tax('purchase', 'tax_group_iva_105')
+        exempt = self._get_tax('purchase', 'tax_group_iva_exento')
+        vat_perception = self._get_tax('purchase', 'tax_group_percepcion_iva')
+        profits_perception = self._get_tax('purchase', 'tax_group_percepcion_ganancias')
+        lines = [
+            (1000.0, vat_21 | vat_perception), (500.0, vat_105 | profits_perception), (200.0, exempt)]
+        invoices = self._create_invoice('in_invoice', lines)
+        invoices |= self._create_invoice('in_invoice', lines, currency=self.usd)
+        invoices |= self._create_invoice('in_refund', lines)
+        invoices |= self._create_invoice('in_refund', lines[:1], currency=self.usd)
+        self._assert_txt_amounts('purchase', invoices)
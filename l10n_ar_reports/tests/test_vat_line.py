@@ -0,0 +1,101 @@
+##############################################################################
+# For copyright and license notices, see __manifest__.py file in module root
+# directory
+##############################################################################
+from odoo.tests.common import TransactionCase, tagged
+from unittest.mock import patch
+
+
+@tagged('post_install', '-at_install')
+class TestVatLineMaterialized(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.move = self.env['account.move'].search([
+            ('type', 'in', ['out_invoice', 'in_invoice']), ('state', '=', 'posted'),
+            ('line_ids.tax_line_id', '!=', False)], limit=1)
+        if not self.move:
+            self.skipTest('A posted invoice with taxes is needed')
+        self.env['ir.config_parameter'].sudo().set_param('l10n_ar_reports.vat_line_materialized', '1')
+        # the refresh runs on the test transaction
+        self.vat_line = self.env['account.ar.vat.line'].with_context(ar_vat_line_refresh_cursor=True)
+        self.env['base'].flush()
+        self.vat_line.init()
+
+    def _get_dirty(self):
+        self.env['base'].flush()
+        self.cr.execute("SELECT move_id FROM account_ar_vat_line_dirty")
+        return {x[0] for x in self.cr.fetchall()}
+
+    def _get_total(self, table):
+        self.cr.execute("SELECT total FROM %s WHERE id = %%s" % table, (self.move.id,))
+        return self.cr.fetchone()[0]
+
+    def test_triggers(self):
+        self.assertTrue(self.vat_line._is_materialized())
+        self.assertFalse(self._get_dirty())
+
+        # updates that don't change the columns of the lines are not logged
+        self.cr.execute("UPDATE account_move SET invoice_date = invoice_date WHERE id = %s", (self.move.id,))
+        tax_line = self.move.line_ids.filtered('tax_line_id')[0]
+        self.cr.execute("UPDATE account_move_line SET balance = balance WHERE id = %s", (tax_line.id,))
+        self.assertFalse(self._get_dirty())
+
+        self.cr.execute("UPDATE account_move SET invoice_date = invoice_date + 1 WHERE id = %s", (self.move.id,))
+        self.assertEqual(self._get_dirty(), {self.move.id})
+        self.cr.execute("DELETE FROM account_ar_vat_line_dirty")
+
+        self.cr.execute("UPDATE account_move_line SET balance = balance + 1 WHERE id = %s", (tax_line.id,))
+        self.assertEqual(self._get_dirty(), {self.move.id})
+        self.cr.execute("DELETE FROM account_ar_vat_line_dirty")
+
+        base_line = self.move.invoice_line_ids.filtered('tax_ids')[0]
+        self.cr.execute("""
+            DELETE FROM account_move_line_account_tax_rel
+            WHERE account_move_line_id = %s""", (base_line.id,))
+        self.assertEqual(self._get_dirty(), {self.move.id})
+        self.cr.execute("DELETE FROM account_ar_vat_line_dirty")
+
+        self.move.partner_id.name = '%s (changed)' % self.move.partner_id.name
+        self.assertIn(self.move.id, self._get_dirty())
+
+    def test_queue_once(self):
+        self.cr.execute("UPDATE account_move_line SET balance = balance + 1 WHERE move_id = %s", (self.move.id,))
+        self.cr.execute("UPDATE account_move SET invoice_date = invoice_date + 1 WHERE id = %s", (self.move.id,))
+        self.cr.execute("SELECT move_id, seq FROM account_ar_vat_line_dirty")
+        entries = self.cr.fetchall()
+        self.assertEqual([x[0] for x in entries], [self.move.id])
+
+        # a move queued again after being read is kept
+        self.cr.execute("UPDATE account_ar_vat_line_dirty SET seq = seq - 1")
+        self.vat_line._unqueue(self.cr, entries)
+        self.assertEqual(self._get_dirty(), {self.move.id})
+        self.vat_line._unqueue(self.cr, [(self.move.id, entries[0][1] - 1)])
+        self.assertFalse(self._get_dirty())
+
+    def test_init_keeps_table(self):
+        self.cr.execute("UPDATE account_ar_vat_line_store SET total = total + 1 WHERE id = %s", (self.move.id,))
+        stored_total = self._get_total('account_ar_vat_line_store')
+        # same definition, the lines are not loaded again
+        self.vat_line.init()
+        self.assertEqual(self._get_total('account_ar_vat_line_store'), stored_total)
+
+        query = self.vat_line._get_query()
+        with patch.object(type(self.vat_line), '_get_query', lambda model: query + '-- changed\n'):
+            self.vat_line.init()
+        self.assertEqual(self._get_total('account_ar_vat_line_store'), self._get_total('account_ar_vat_line_source'))
+
+    def test_refresh(self):
+        self.assertEqual(self._get_total('account_ar_vat_line_store'), self._get_total('account_ar_vat_line_source'))
+        tax_line = self.move.line_ids.filtered('tax_line_id')[0]
+        self.cr.execute("UPDATE account_move_line SET balance = balance + 10 WHERE id = %s", (tax_line.id,))
+        source_total = self._get_total('account_ar_vat_line_source')
+
+        # the lines of the queued moves are computed when read
+        self.assertNotEqual(self._get_total('account_ar_vat_line_store'), source_total)
+        self.assertEqual(self._get_total('account_ar_vat_line'), source_total)
+
+        self.vat_line._refresh()
+        self.assertFalse(self._get_dirty())
+        self.assertEqual(self._get_total('account_ar_vat_line_store'), source_total)
+        self.assertEqual(self._get_total('account_ar_vat_line'), source_total)